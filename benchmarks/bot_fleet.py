@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+"""Bot fleet throughput: many `Session` bots in one process against a server.
+
+Starts ``pypes_server/main.py`` in a subprocess, connects ``--bots`` sessions
+through `Fleet` and spreads them over ``--rooms`` rooms. The bots then send
+``--rate`` messages per second between them for ``--seconds``, and every
+delivery is counted by an ``on_message`` callback. Reports handshakes per
+second, messages sent and delivered per second, lost deliveries and the CPU
+time the fleet process spent per delivered message.
+
+Usage::
+
+    python benchmarks/bot_fleet.py --bots 2000 --rooms 100 --rate 500
+"""
+import argparse
+import asyncio
+import os
+import subprocess
+import sys
+import time
+
+ROOT = os.path.join(os.path.dirname(__file__), "..", "src")
+SERVER_DIR = os.path.join(ROOT, "pypes_server")
+sys.path.insert(0, os.path.join(ROOT, "pypes_client"))
+
+from protocol import Protocol  # noqa: E402
+from session import Fleet  # noqa: E402
+
+
+async def wait_for_port(port):
+    for _ in range(100):
+        try:
+            _, writer = await asyncio.open_connection("127.0.0.1", port)
+            writer.close()
+            return
+        except OSError:
+            await asyncio.sleep(0.05)
+    raise RuntimeError("Server did not start")
+
+
+async def run(args):
+    delivered = 0
+
+    def count(session, message):
+        nonlocal delivered
+        if message.type == Protocol.MESSAGE:
+            delivered += 1
+
+    await wait_for_port(args.port)
+    fleet = Fleet("127.0.0.1", args.port, on_message=count, binary=not args.json)
+    started = time.perf_counter()
+    bots = await fleet.spawn(args.bots, "Bot", args.concurrency)
+    connect_time = time.perf_counter() - started
+    rooms = ["bots{}".format(i % args.rooms) for i in range(len(bots))]
+    for bot, room in zip(bots, rooms):
+        await bot.command("JOIN", room)
+    members = len(bots) / args.rooms
+    await asyncio.sleep(1)
+
+    delivered = 0
+    sent = 0
+    tick = 0.01
+    cpu = time.process_time()
+    started = time.perf_counter()
+    while time.perf_counter() - started < args.seconds:
+        due = int((time.perf_counter() - started) * args.rate) - sent
+        for _ in range(due):
+            i = sent % len(bots)
+            bots[i].send_nowait(Protocol.MESSAGE, message="message {}".format(sent), room=rooms[i])
+            sent += 1
+        await asyncio.sleep(tick)
+    elapsed = time.perf_counter() - started
+    # Let the last broadcasts arrive
+    last = -1
+    while last != delivered:
+        last = delivered
+        await asyncio.sleep(0.5)
+    cpu = time.process_time() - cpu
+    await fleet.close()
+
+    expected = sent * members
+    print("bots connected      {:>10} of {}".format(len(bots), args.bots))
+    print("handshakes/s        {:>10.0f}".format(len(bots) / connect_time))
+    print("sent/s              {:>10.0f}".format(sent / elapsed))
+    print("delivered/s         {:>10.0f}".format(delivered / elapsed))
+    print("lost deliveries     {:>9.2f}%".format(100 * (1 - delivered / expected) if expected else 0))
+    print("fleet cpu/delivery  {:>8.1f}us".format(cpu / max(1, delivered) * 1e6))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--bots", type=int, default=2000)
+    parser.add_argument("--rooms", type=int, default=100, help="rooms the bots are spread over")
+    parser.add_argument("--rate", type=float, default=500, help="messages per second across the fleet")
+    parser.add_argument("--seconds", type=float, default=10)
+    parser.add_argument("--concurrency", type=int, default=200, help="handshakes in flight")
+    parser.add_argument("--json", action="store_true", help="use the JSON codec instead of binary")
+    parser.add_argument("--port", type=int, default=42174)
+    args = parser.parse_args()
+    server = subprocess.Popen(
+        [sys.executable, "main.py", "127.0.0.1", "--port", str(args.port),
+         "--max-connections", str(args.bots + 10), "--backlog", "1024",
+         "--rate-limit", "MESSAGE=0", "--rate-limit", "COMMAND=0", "--broadcast-rate", "0",
+         "--log-level", "WARNING"],
+        cwd=SERVER_DIR,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    try:
+        asyncio.run(run(args))
+    finally:
+        server.terminate()
+        server.wait()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+"""Broadcast delivery latency with a share of deliberately slow readers.
+
+Starts a server on localhost, connects a number of clients that complete the
+regular handshake, and lets one of them broadcast timestamped messages. A
+fraction of the clients never read from their socket. The script reports the
+delivery latency percentiles measured by the clients that do read.
+
+Usage::
+
+    python benchmarks/broadcast_latency.py --clients 1000 --slow 0.01
+"""
+import argparse
+import asyncio
+import json
+import os
+import socket
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src", "pypes_server"))
+
+from protocol import Protocol  # noqa: E402
+from server import Server  # noqa: E402
+
+
+async def send(writer, typ, **payload):
+    data = json.dumps({"type": typ, "payload": payload}).encode("utf8")
+    writer.write(len(data).to_bytes(4, "little") + data)
+    await writer.drain()
+
+
+async def recv(reader):
+    size = int.from_bytes(await reader.readexactly(4), "little")
+    message = json.loads(await reader.readexactly(size))
+    return message["type"], message.get("payload")
+
+
+async def connect(port, name, slow=False):
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    if slow:
+        sock = writer.get_extra_info("socket")
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+    while True:
+        typ, _ = await recv(reader)
+        if typ == Protocol.SERVER_HELLO:
+            await send(writer, Protocol.CLIENT_NAME, name=name)
+        elif typ == Protocol.SERVER_WELCOME:
+            break
+    # Skip the welcome info
+    await recv(reader)
+    return reader, writer
+
+
+async def listen(reader, expected, latencies):
+    received = 0
+    while received < expected:
+        typ, data = await recv(reader)
+        if typ != Protocol.MESSAGE:
+            continue
+        sent = float(data["message"].split(" ", 1)[0])
+        latencies.append(time.perf_counter() - sent)
+        received += 1
+
+
+def percentile(values, pct):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+
+async def run(args):
+    # A single sender floods the room, so the rate limits are off
+    server = Server(
+        "127.0.0.1", args.clients + 1, port=args.port, rate_limits={}, broadcast_rate=0
+    )
+    serving = asyncio.create_task(server.begin_serving())
+    await asyncio.sleep(0.1)
+
+    slow_count = int(args.clients * args.slow)
+    clients = []
+    for i in range(args.clients):
+        clients.append(await connect(args.port, "user%d" % i, slow=i < slow_count))
+    sender_reader, sender_writer = clients[-1]
+
+    latencies = []
+    listeners = [
+        asyncio.create_task(listen(reader, args.messages, latencies))
+        for reader, _ in clients[slow_count:]
+    ]
+    padding = "x" * args.size
+    started = time.perf_counter()
+    for _ in range(args.messages):
+        await send(
+            sender_writer,
+            Protocol.MESSAGE,
+            message="{} {}".format(time.perf_counter(), padding),
+        )
+        await asyncio.sleep(args.interval)
+    await asyncio.wait_for(asyncio.gather(*listeners), args.timeout)
+    elapsed = time.perf_counter() - started
+
+    print("clients:        %d (%d slow)" % (args.clients, slow_count))
+    print("messages:       %d x %d bytes" % (args.messages, args.size))
+    print("deliveries:     %d in %.2fs" % (len(latencies), elapsed))
+    for pct in (50, 90, 99, 99.9):
+        print("p%-5s latency: %.2f ms" % (pct, percentile(latencies, pct) * 1000))
+
+    for _, writer in clients:
+        writer.close()
+    serving.cancel()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--clients", type=int, default=1000)
+    parser.add_argument("--slow", type=float, default=0.01, help="share of slow readers")
+    parser.add_argument("--messages", type=int, default=200)
+    parser.add_argument("--size", type=int, default=2000, help="message padding in bytes")
+    parser.add_argument("--interval", type=float, default=0.005)
+    parser.add_argument("--timeout", type=float, default=120)
+    parser.add_argument("--port", type=int, default=42169)
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
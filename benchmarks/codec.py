@@ -0,0 +1,49 @@
+#!/usr/bin/env python3
+"""Bytes on the wire and encode/decode cost per codec.
+
+Encodes and decodes a typical MESSAGE broadcast with every codec the server
+supports.
+
+Usage::
+
+    python benchmarks/codec.py --messages 200000
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src", "pypes_server"))
+
+from codec import CODECS  # noqa: E402
+from protocol import Protocol  # noqa: E402
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--messages", type=int, default=200000)
+    parser.add_argument("--text", default="Hello there, how is everyone doing today?")
+    args = parser.parse_args()
+
+    payload = {"message": args.text, "sender": "Guest42", "color": "4682b4"}
+    print("%-8s %8s %12s %12s" % ("codec", "bytes", "encode", "decode"))
+    for name, codec in CODECS.items():
+        encoded = codec.encode(Protocol.MESSAGE, payload)
+        view = memoryview(encoded)
+        assert codec.decode(view) == (Protocol.MESSAGE, payload)
+
+        started = time.perf_counter()
+        for _ in range(args.messages):
+            codec.encode(Protocol.MESSAGE, payload)
+        encode = (time.perf_counter() - started) / args.messages
+
+        started = time.perf_counter()
+        for _ in range(args.messages):
+            codec.decode(view)
+        decode = (time.perf_counter() - started) / args.messages
+
+        print("%-8s %8d %9.2f us %9.2f us" % (name, len(encoded), encode * 1e6, decode * 1e6))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+"""Connection storm throughput per event loop implementation.
+
+Starts ``pypes_server/main.py`` in a subprocess once per event loop, then
+opens a burst of concurrent connections that each complete the handshake and
+disconnect. Reports completed handshakes per second and handshake latency.
+
+Usage::
+
+    python benchmarks/connection_storm.py --loops asyncio uvloop --connections 5000
+"""
+import argparse
+import asyncio
+import os
+import subprocess
+import sys
+import time
+
+SERVER_DIR = os.path.join(os.path.dirname(__file__), "..", "src", "pypes_server")
+sys.path.insert(0, SERVER_DIR)
+
+from frame import Frame, FrameDecoder  # noqa: E402
+from protocol import Protocol  # noqa: E402
+
+
+async def handshake(port, latencies):
+    started = time.perf_counter()
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    decoder = FrameDecoder()
+    try:
+        while True:
+            messages = decoder.decode()
+            if not messages:
+                data = await reader.read(0x10000)
+                if not data:
+                    raise ConnectionResetError("Server closed the connection")
+                decoder.feed(data)
+                continue
+            for typ, _ in messages:
+                if typ == Protocol.SERVER_HELLO:
+                    writer.write(Frame(Protocol.CLIENT_NAME, name="Guest").encode())
+                elif typ == Protocol.SERVER_WELCOME:
+                    latencies.append(time.perf_counter() - started)
+                    return
+    finally:
+        writer.close()
+
+
+async def storm(port, connections, concurrency):
+    latencies = []
+    failures = 0
+    limit = asyncio.Semaphore(concurrency)
+
+    async def one():
+        nonlocal failures
+        async with limit:
+            try:
+                await handshake(port, latencies)
+            except OSError:
+                failures += 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*(one() for _ in range(connections)))
+    return time.perf_counter() - started, sorted(latencies), failures
+
+
+async def wait_for_port(port):
+    for _ in range(100):
+        try:
+            _, writer = await asyncio.open_connection("127.0.0.1", port)
+            writer.close()
+            return
+        except OSError:
+            await asyncio.sleep(0.05)
+    raise RuntimeError("Server did not start")
+
+
+def run_loop(name, args):
+    server = subprocess.Popen(
+        [sys.executable, "main.py", "127.0.0.1", "--port", str(args.port), "--loop", name,
+         "--backlog", str(args.backlog)],
+        cwd=SERVER_DIR,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    try:
+        asyncio.run(wait_for_port(args.port))
+        elapsed, latencies, failures = asyncio.run(
+            storm(args.port, args.connections, args.concurrency)
+        )
+    finally:
+        server.terminate()
+        server.wait()
+    p50 = latencies[len(latencies) // 2] * 1000
+    p99 = latencies[int(len(latencies) * 0.99)] * 1000
+    print(
+        "%-8s %10.0f %9.2f ms %9.2f ms %8d"
+        % (name, len(latencies) / elapsed, p50, p99, failures)
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--loops", nargs="+", default=["asyncio", "uvloop"])
+    parser.add_argument("--connections", type=int, default=5000)
+    parser.add_argument("--concurrency", type=int, default=500)
+    parser.add_argument("--backlog", type=int, default=1024)
+    parser.add_argument("--port", type=int, default=42173)
+    args = parser.parse_args()
+    print("%-8s %10s %12s %12s %8s" % ("loop", "conn/s", "p50", "p99", "failed"))
+    for name in args.loops:
+        run_loop(name, args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+"""Inbound decoding throughput for pipelined client bursts.
+
+Feeds a stream reader with bursts of pipelined MESSAGE frames, delivered in
+socket sized chunks, and decodes them with the old ``read(4)``/``read(size)``
+pair and with `FrameDecoder`.
+
+Usage::
+
+    python benchmarks/decoder.py --frames 200000 --chunk 65536
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src", "pypes_server"))
+
+from frame import Frame, FrameDecoder  # noqa: E402
+from protocol import Protocol  # noqa: E402
+
+
+def make_reader(stream, chunk):
+    reader = asyncio.StreamReader(limit=len(stream) + 1)
+    for offset in range(0, len(stream), chunk):
+        reader.feed_data(stream[offset : offset + chunk])
+    reader.feed_eof()
+    return reader
+
+
+async def read_pairs(reader, count):
+    for _ in range(count):
+        header = await reader.read(4)
+        size = int.from_bytes(header, "little")
+        message = json.loads(await reader.read(size))
+        message["type"], message.get("payload")
+
+
+async def read_decoder(reader, count, chunk):
+    decoder = FrameDecoder()
+    decoded = 0
+    while decoded < count:
+        decoder.feed(await reader.read(chunk))
+        decoded += len(decoder.decode())
+
+
+async def run(args):
+    frame = Frame(Protocol.MESSAGE, message="Hello there, how is everyone doing today?")
+    data = frame.encode()
+    stream = data * args.frames
+
+    reader = make_reader(stream, args.chunk)
+    started = time.perf_counter()
+    await read_pairs(reader, args.frames)
+    old = time.perf_counter() - started
+
+    reader = make_reader(stream, args.chunk)
+    started = time.perf_counter()
+    await read_decoder(reader, args.frames, args.chunk)
+    new = time.perf_counter() - started
+
+    print("frames:     %d x %d bytes" % (args.frames, len(data)))
+    print("read pairs: %8.0f frames/s" % (args.frames / old))
+    print("decoder:    %8.0f frames/s" % (args.frames / new))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--frames", type=int, default=200000)
+    parser.add_argument("--chunk", type=int, default=65536)
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
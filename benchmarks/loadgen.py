@@ -0,0 +1,280 @@
+#!/usr/bin/env python3
+"""Headless load generator for a pypes server.
+
+Opens many simulated sessions against a localhost server. Each session performs
+the real SERVER_HELLO/CLIENT_NAME/SERVER_WELCOME handshake. The sessions then
+send a configurable mix of MESSAGE, TELL and COMMAND frames at a fixed total
+rate. The report covers connect rate, handshake latency, end-to-end broadcast
+latency percentiles and server memory.
+
+By default the server is started from ``src/pypes_server/main.py`` on a spare
+port and stopped afterwards. Pass ``--port`` with ``--server-pid`` to target a
+server that is already running.
+
+Usage::
+
+    python benchmarks/loadgen.py --sessions 2000 --rate 200 --duration 20
+    python benchmarks/loadgen.py --server-args "--workers 4" --mix message=80,tell=10,command=10
+"""
+import argparse
+import asyncio
+import os
+import random
+import shlex
+import subprocess
+import sys
+import time
+
+SERVER_DIR = os.path.join(os.path.dirname(__file__), "..", "src", "pypes_server")
+sys.path.insert(0, SERVER_DIR)
+
+from codec import CODECS, JSON  # noqa: E402
+from frame import Frame, FrameDecoder  # noqa: E402
+from protocol import Protocol  # noqa: E402
+
+READ_SIZE = 0x10000
+COMMANDS = ("help", "color")
+
+
+class Session:
+    """A single simulated client.
+
+    Observers decode everything they receive and record broadcast latency.
+    Every other session drains its socket without decoding, so the load
+    generator spends its CPU on sending rather than on parsing.
+    """
+
+    def __init__(self, index: int, observer: bool):
+        self.index = index
+        self.observer = observer
+        self.name = ""
+        self.codec = JSON
+        self.reader = None
+        self.writer = None
+
+    async def connect(self, port: int, codec: str) -> float:
+        """Connect and complete the handshake. Returns the handshake duration"""
+        started = time.perf_counter()
+        self.reader, self.writer = await asyncio.open_connection("127.0.0.1", port)
+        decoder = FrameDecoder()
+        self.decoder = decoder
+        while True:
+            # Decode one frame at a time, the codec changes after the welcome
+            messages = decoder.decode(1)
+            if not messages:
+                data = await self.reader.read(READ_SIZE)
+                if not data:
+                    raise ConnectionResetError("Server closed the connection")
+                decoder.feed(data)
+                continue
+            typ, data = messages[0]
+            if typ == Protocol.SERVER_HELLO:
+                self.writer.write(
+                    Frame(Protocol.CLIENT_NAME, name="load", codec=codec).encode()
+                )
+            elif typ == Protocol.SERVER_WELCOME:
+                self.name = data["name"]
+                self.codec = decoder.codec = CODECS.get(data.get("codec"), JSON)
+                return time.perf_counter() - started
+
+    def send(self, typ: str, **payload):
+        self.writer.write(Frame(typ, **payload).encode(self.codec))
+
+    async def listen(self, stats: "Stats"):
+        """Read until the connection closes, recording broadcast latency if observing"""
+        try:
+            while True:
+                data = await self.reader.read(READ_SIZE)
+                if not data:
+                    return
+                if not self.observer:
+                    continue
+                self.decoder.feed(data)
+                now = time.perf_counter()
+                for typ, payload in self.decoder.decode():
+                    if typ == Protocol.MESSAGE and payload["message"].startswith("t="):
+                        sent = float(payload["message"][2:].split(" ", 1)[0])
+                        stats.broadcast.append(now - sent)
+        except (ConnectionError, OSError):
+            stats.disconnects += 1
+
+    def close(self):
+        if self.writer:
+            self.writer.close()
+
+
+class Stats:
+    def __init__(self):
+        self.handshake: list[float] = []
+        self.broadcast: list[float] = []
+        self.connect_failures = 0
+        self.disconnects = 0
+        self.sent = {Protocol.MESSAGE: 0, Protocol.TELL: 0, Protocol.COMMAND: 0}
+
+
+def percentiles(values: list[float], *pcts: float) -> str:
+    if not values:
+        return "n/a"
+    values = sorted(values)
+    return "  ".join(
+        "p{}={:.2f}ms".format(pct, values[min(len(values) - 1, int(len(values) * pct / 100))] * 1000)
+        for pct in pcts
+    )
+
+
+def parse_mix(text: str) -> tuple[list[str], list[float]]:
+    kinds = {"message": Protocol.MESSAGE, "tell": Protocol.TELL, "command": Protocol.COMMAND}
+    types, weights = [], []
+    for part in text.split(","):
+        kind, weight = part.split("=")
+        types.append(kinds[kind.strip().lower()])
+        weights.append(float(weight))
+    return types, weights
+
+
+def server_rss(pid: int) -> str:
+    """Return the resident memory of a process and its children, read from /proc"""
+    total = 0
+    pending = [pid]
+    try:
+        while pending:
+            current = pending.pop()
+            with open("/proc/{}/status".format(current)) as status:
+                for line in status:
+                    if line.startswith("VmRSS:"):
+                        total += int(line.split()[1])
+            children = "/proc/{0}/task/{0}/children".format(current)
+            if os.path.exists(children):
+                with open(children) as f:
+                    pending.extend(int(child) for child in f.read().split())
+    except OSError:
+        return "n/a"
+    return "{:.1f} MB".format(total / 1024)
+
+
+async def connect_all(args, stats: Stats) -> list[Session]:
+    sessions = []
+    limit = asyncio.Semaphore(args.concurrency)
+
+    async def open_session(index):
+        session = Session(index, observer=index < args.observers)
+        async with limit:
+            try:
+                stats.handshake.append(await session.connect(args.port, args.codec))
+                sessions.append(session)
+            except OSError:
+                stats.connect_failures += 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*(open_session(i) for i in range(args.sessions)))
+    elapsed = time.perf_counter() - started
+    print("connected:  {} sessions in {:.2f}s ({:.0f}/s), {} failed".format(
+        len(sessions), elapsed, len(sessions) / elapsed, stats.connect_failures))
+    print("handshake:  " + percentiles(stats.handshake, 50, 90, 99))
+    return sessions
+
+
+async def drive(args, sessions: list[Session], stats: Stats):
+    types, weights = parse_mix(args.mix)
+    padding = "x" * args.size
+    interval = 1 / args.rate
+    deadline = time.perf_counter() + args.duration
+    next_send = time.perf_counter()
+    while next_send < deadline:
+        session = random.choice(sessions)
+        typ = random.choices(types, weights)[0]
+        if typ == Protocol.MESSAGE:
+            session.send(typ, message="t={} {}".format(time.perf_counter(), padding))
+        elif typ == Protocol.TELL:
+            session.send(typ, target=random.choice(sessions).name, message=padding)
+        else:
+            session.send(typ, cmd=random.choice(COMMANDS), args=[])
+        stats.sent[typ] += 1
+        next_send += interval
+        delay = next_send - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+
+async def run(args, server_pid):
+    stats = Stats()
+    if server_pid:
+        print("server RSS: {} before connecting".format(server_rss(server_pid)))
+    sessions = await connect_all(args, stats)
+    if not sessions:
+        return
+    if server_pid:
+        print("server RSS: {} with {} sessions".format(server_rss(server_pid), len(sessions)))
+    listeners = [asyncio.create_task(session.listen(stats)) for session in sessions]
+    started = time.perf_counter()
+    await drive(args, sessions, stats)
+    elapsed = time.perf_counter() - started
+    # Give the last broadcasts time to arrive
+    await asyncio.sleep(args.settle)
+    sent = sum(stats.sent.values())
+    print("sent:       {} frames in {:.1f}s ({:.0f}/s) {}".format(
+        sent, elapsed, sent / elapsed,
+        " ".join("{}={}".format(typ, count) for typ, count in stats.sent.items())))
+    print("broadcast:  {} deliveries to {} observers".format(
+        len(stats.broadcast), min(args.observers, len(sessions))))
+    print("latency:    " + percentiles(stats.broadcast, 50, 90, 99, 99.9))
+    print("dropped:    {} sessions disconnected".format(stats.disconnects))
+    if server_pid:
+        print("server RSS: {} under load".format(server_rss(server_pid)))
+    for session in sessions:
+        session.close()
+    for listener in listeners:
+        listener.cancel()
+
+
+async def wait_for_port(port):
+    for _ in range(100):
+        try:
+            _, writer = await asyncio.open_connection("127.0.0.1", port)
+            writer.close()
+            return
+        except OSError:
+            await asyncio.sleep(0.05)
+    raise RuntimeError("Server did not start on port {}".format(port))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sessions", type=int, default=1000)
+    parser.add_argument("--concurrency", type=int, default=200, help="handshakes in flight at once")
+    parser.add_argument("--observers", type=int, default=50, help="sessions that measure latency")
+    parser.add_argument("--rate", type=float, default=100, help="frames per second across all sessions")
+    parser.add_argument("--duration", type=float, default=10, help="seconds to send for")
+    parser.add_argument("--settle", type=float, default=1, help="seconds to wait for stragglers")
+    parser.add_argument("--mix", default="message=90,tell=5,command=5")
+    parser.add_argument("--size", type=int, default=64, help="message padding in bytes")
+    parser.add_argument("--codec", choices=list(CODECS), default=JSON.name)
+    parser.add_argument("--port", type=int, help="target a running server on this port")
+    parser.add_argument("--server-pid", type=int, help="pid of the running server, for RSS")
+    parser.add_argument("--server-args", default="", help="extra arguments for main.py")
+    args = parser.parse_args()
+
+    server = None
+    server_pid = args.server_pid
+    if args.port is None:
+        args.port = 42174
+        server = subprocess.Popen(
+            [sys.executable, "main.py", "127.0.0.1", "--port", str(args.port)]
+            + ["--max-connections", str(args.sessions)]
+            + shlex.split(args.server_args),
+            cwd=SERVER_DIR,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+        server_pid = server.pid
+    try:
+        asyncio.run(wait_for_port(args.port))
+        asyncio.run(run(args, server_pid))
+    finally:
+        if server:
+            server.terminate()
+            server.wait()
+
+
+if __name__ == "__main__":
+    main()
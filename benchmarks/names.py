@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+"""Username allocation cost as the number of users asking for the same name grows.
+
+Every curses client asks for ``Guest``, so each handshake has to find a free
+``GuestN``. This compares the suffix scan the server used before against
+`UserDirectory`, by registering users through `Server.accept_user` exactly as
+the handshake does. The reported cost is per handshake, for the last
+``--window`` users registered at each size.
+
+Usage::
+
+    python benchmarks/names.py --sizes 1000 10000 50000
+"""
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+SERVER_DIR = os.path.join(os.path.dirname(__file__), "..", "src", "pypes_server")
+sys.path.insert(0, SERVER_DIR)
+
+from server import Server  # noqa: E402
+
+
+class ScanServer(Server):
+    """The server with the previous allocator: try name1, name2, ... in order"""
+
+    async def accept_user(self, user, requested):
+        name = requested
+        suffix = 0
+        while name in self.users:
+            suffix += 1
+            name = requested + str(suffix)
+        self.users.add(name, user)
+        return name
+
+
+async def fill(server_class, size: int, window: int) -> tuple[float, float]:
+    """Register `size` Guests. Returns the total time and the mean cost of the last `window`"""
+    server = server_class("127.0.0.1")
+    started = time.perf_counter()
+    for _ in range(size - window):
+        await server.accept_user(object(), "Guest")
+    window_started = time.perf_counter()
+    for _ in range(window):
+        await server.accept_user(object(), "Guest")
+    finished = time.perf_counter()
+    return finished - started, (finished - window_started) / window
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 50000])
+    parser.add_argument("--window", type=int, default=1000, help="users averaged at each size")
+    parser.add_argument("--skip-scan", action="store_true", help="only run the directory")
+    args = parser.parse_args()
+
+    print("{:>8}  {:>10}  {:>14}  {:>10}  {:>14}".format(
+        "users", "scan total", "scan/handshake", "dir total", "dir/handshake"))
+    for size in args.sizes:
+        window = min(args.window, size)
+        if args.skip_scan:
+            scan = "{:>10}  {:>14}".format("-", "-")
+        else:
+            scan_total, scan_each = asyncio.run(fill(ScanServer, size, window))
+            scan = "{:>9.2f}s  {:>12.1f}us".format(scan_total, scan_each * 1e6)
+        dir_total, dir_each = asyncio.run(fill(Server, size, window))
+        print("{:>8}  {}  {:>9.3f}s  {:>12.2f}us".format(size, scan, dir_total, dir_each * 1e6))
+
+
+if __name__ == "__main__":
+    main()
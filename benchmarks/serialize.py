@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+"""Per-message CPU cost of broadcast serialization.
+
+Compares encoding the MESSAGE payload once per recipient (the old
+``UserClient.send`` path) against building a single `Frame` and writing the
+same bytes to every recipient.
+
+Usage::
+
+    python benchmarks/serialize.py --recipients 100 1000 10000
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src", "pypes_server"))
+
+from frame import Frame  # noqa: E402
+from protocol import Protocol  # noqa: E402
+
+
+class NullWriter:
+    def write(self, data):
+        pass
+
+    def is_closing(self):
+        return False
+
+
+def per_recipient(writers, payload):
+    for writer in writers:
+        serialized = json.dumps({"type": Protocol.MESSAGE, "payload": payload}).encode("utf8")
+        writer.write(int.to_bytes(len(serialized), 4, "little"))
+        writer.write(serialized)
+
+
+def serialize_once(writers, payload):
+    frame = Frame(Protocol.MESSAGE, **payload)
+    for writer in writers:
+        writer.write(frame.encode())
+
+
+def measure(fn, writers, payload, repeat):
+    started = time.perf_counter()
+    for _ in range(repeat):
+        fn(writers, payload)
+    return (time.perf_counter() - started) / repeat
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--recipients", type=int, nargs="+", default=[100, 1000, 10000])
+    parser.add_argument("--messages", type=int, default=200)
+    args = parser.parse_args()
+
+    payload = {"message": "Hello there, " * 8, "sender": "Guest42", "color": "4682b4"}
+    print("%10s %14s %14s %8s" % ("recipients", "per-recipient", "once", "speedup"))
+    for count in args.recipients:
+        writers = [NullWriter() for _ in range(count)]
+        repeat = max(1, args.messages * 1000 // count)
+        old = measure(per_recipient, writers, payload, repeat)
+        new = measure(serialize_once, writers, payload, repeat)
+        print("%10d %11.1f us %11.1f us %7.1fx" % (count, old * 1e6, new * 1e6, old / new))
+
+
+if __name__ == "__main__":
+    main()
@@ -1 +1 @@
-from . import client, chatwin, cursesclient, protocol, inputfield
+from . import client, chatwin, codec, cursesclient, frame, protocol, inputfield
@@ -1,70 +1,162 @@
 import curses
+import itertools
+from collections import deque
+
+from wrapping import WrapCache, display_width, pad, truncate
+
+# Wrapped lines kept in the scrollback. Older entries are forgotten
+SCROLLBACK_LINES = 5000
+BANNER_MARGIN = 10
+
+
+class Entry:
+    """A message or banner in the scrollback, with its rows for the last width drawn.
+
+    :param sender: The sender shown in the name column, or None for a banner
+    :type sender: Optional[str]
+    :param text: The message text
+    :type text: str
+    :param color: The curses color pair of the sender
+    :type color: int
+    """
+
+    __slots__ = ("id", "sender", "text", "color", "width", "rows")
+
+    ids = itertools.count()
+
+    def __init__(self, sender, text, color=0):
+        self.id = next(Entry.ids)
+        self.sender = sender
+        self.text = text
+        self.color = color
+        self.width = None
+        self.rows = ()
 
 
 class ChatWin:
-    def __init__(self, width, height, name_col_width=20):
-        self.width = width
-        self.height = height
+    """Scrollback of received messages, drawn into a boxed window.
+
+    Entries are kept in a ring buffer capped at `max_lines` wrapped lines, and
+    only the lines inside the viewport are drawn, so memory and the cost of a
+    redraw stay the same however long the session runs. An entry is wrapped
+    when it is first drawn at a width, so a resize only rewraps what is shown
+    or scrolled past. Wrapped text is also kept in `wraps` for recent widths,
+    so resizing back to an earlier size rewraps nothing.
+
+    :param width: Width of the window including the border
+    :type width: int
+    :param height: Height of the window including the border
+    :type height: int
+    :param name_col_width: Width of the sender column
+    :type name_col_width: int
+    :param max_lines: Wrapped lines kept in the scrollback
+    :type max_lines: int
+    """
+
+    def __init__(self, width, height, name_col_width=20, max_lines=SCROLLBACK_LINES):
         self.name_col = name_col_width
-        self.msg_width = width - name_col_width - 5
+        self.max_lines = max_lines
+        self.entries = deque()
+        # Lines of all entries, each counted at the width it was last wrapped for
+        self.lines = 0
+        # Lines between the bottom of the viewport and the newest line
+        self.offset = 0
+        self.changed = True
+        self.wraps = WrapCache()
         self.win = curses.newwin(height, width, 0, 0)
-        self.pad = curses.newpad(1000, width - 2)
-        self.win.box()
-        self.win.refresh()
-        self.current_y = 0
-        self.current_line = 0
-        self.pad.move(0, 0)
-
-    def text_wrap(self, text, max_width):
-        lines = []
-        for para in text.split("\n"):
-            current_line = ""
-            for word in para.strip().split():
-                if len(current_line) + len(word) >= max_width:
-                    lines.append(current_line.strip())
-                    current_line = ""
-                current_line += word + " "
-            lines.append(current_line.strip())
-        return lines
+        self.resize(width, height)
+
+    @property
+    def page(self):
+        """Number of lines in the viewport"""
+        return max(1, self.height - 2)
+
+    def resize(self, width, height):
+        """Fit the window to a new terminal size. Entries are rewrapped as they are drawn"""
+        self.width = width
+        self.height = height
+        self.msg_width = max(1, width - self.name_col - 5)
+        self.win.resize(height, width)
+        self.changed = True
+
+    def wrap(self, entry):
+        """Return the rows of an entry at the current width, as (text, attribute, name color) tuples"""
+        if entry.width == self.width:
+            return entry.rows
+        if entry.sender is None:
+            banner_width = max(1, self.width - 2 * BANNER_MARGIN - 2)
+            rows = [(" " * BANNER_MARGIN + "┌" + "─" * banner_width + "┐", curses.A_BOLD, None)]
+            for line in self.wraps.wrap(entry.id, entry.text, banner_width):
+                text = "│" + pad(line, banner_width, "^") + "│"
+                rows.append((" " * BANNER_MARGIN + text, curses.A_BOLD, None))
+            rows.append((" " * BANNER_MARGIN + "└" + "─" * banner_width + "┘", curses.A_BOLD, None))
+            rows.append(("", 0, None))
+        else:
+            lines = self.wraps.wrap(entry.id, entry.text, self.msg_width)
+            sender = pad(truncate(entry.sender, self.name_col), self.name_col, ">")
+            rows = [(sender + "│ " + lines[0], 0, entry.color)]
+            indent = " " * self.name_col + "│ "
+            for line in lines[1:]:
+                rows.append((indent + line, 0, None))
+        self.lines += len(rows) - len(entry.rows)
+        entry.width = self.width
+        entry.rows = tuple(rows)
+        return entry.rows
+
+    def append(self, entry):
+        rows = self.wrap(entry)
+        self.entries.append(entry)
+        if self.offset:
+            # Keep the viewport on what the user scrolled to
+            self.offset += len(rows)
+        while self.lines > self.max_lines and len(self.entries) > 1:
+            self.lines -= len(self.entries.popleft().rows)
+        self.offset = min(self.offset, max(0, self.lines - self.page))
+        self.changed = True
 
     def add_entry(self, sender, message, color):
-        y, x = self.pad.getyx()
-        lines = self.text_wrap(message, self.msg_width)
-        formatted = "{:>{width}}│ {}".format(
-            sender[: self.name_col], lines[0], width=self.name_col
-        )
-        self.pad.addstr(formatted)
-        self.pad.chgat(y, 0, self.name_col, curses.color_pair(color))
-        self.pad.move(y + 1, 0)
-        for i, line in enumerate(lines[1:]):
-            formatted = "{:>{width}}│ {}".format(" ", line, width=self.name_col)
-            self.pad.move(y + 1 + i, 0)
-            self.pad.addstr(formatted)
-
-        self.current_line += len(lines)
-        if self.current_line >= self.height - 2:
-            self.current_y += 1
-        self.refresh
+        self.append(Entry(sender, message, color))
 
     def add_banner(self, text):
-        y, _ = self.pad.getyx()
-        margin = 10
-        banner_width = self.width - 2 * margin - 2
-        lines = ["┌" + "─" * banner_width + "┐"]
-        for line in self.text_wrap(text, banner_width):
-            lines.append("│{txt:^{width}}│".format(txt=line, width=banner_width))
-            # lines.append("{txt}".format(txt=line, width=banner_width))
-        lines.append("└" + "─" * banner_width + "┘")
-        lines.append("\n")
-        for i, line in enumerate(lines):
-            self.pad.move(y + i + 1, 0)
-            self.pad.addstr(line, curses.A_BOLD)
-        self.current_line += len(lines)
-        if self.current_line >= self.height - 2:
-            self.current_y += 1
-        self.refresh
+        self.append(Entry(None, text))
 
-    def refresh(self):
+    def scroll(self, lines):
+        """Scroll towards older lines, or towards newer ones if `lines` is negative"""
+        offset = min(max(0, self.offset + lines), max(0, self.lines - self.page))
+        if offset != self.offset:
+            self.offset = offset
+            self.changed = True
+
+    def visible_rows(self):
+        """Return the rows inside the viewport, oldest first"""
+        rows = []
+        skip = self.offset
+        wanted = self.page
+        for entry in reversed(self.entries):
+            entry_rows = self.wrap(entry)
+            if skip >= len(entry_rows):
+                skip -= len(entry_rows)
+                continue
+            end = len(entry_rows) - skip
+            skip = 0
+            rows[:0] = entry_rows[max(0, end - (wanted - len(rows))) : end]
+            if len(rows) >= wanted:
+                break
+        return rows
+
+    def draw(self):
+        self.win.erase()
         self.win.box()
+        for y, (text, attribute, color) in enumerate(self.visible_rows(), 1):
+            text = truncate(text, self.width - 3)
+            self.win.addstr(y, 1, text, attribute)
+            if color is not None:
+                self.win.chgat(y, 1, min(self.name_col, display_width(text)), curses.color_pair(color))
+        if self.offset:
+            self.win.addstr(0, 2, " ↑ {} ".format(self.offset)[: self.width - 4], curses.A_REVERSE)
+        self.changed = False
+
+    def refresh(self):
+        if self.changed:
+            self.draw()
         self.win.noutrefresh()
-        self.pad.refresh(self.current_y, 0, 1, 3, self.height - 3, self.width - 2)
@@ -37,18 +37,6 @@ def goto_cur(y, x):
     sys.stdout.write(f"\x1b[{y};{x}H")
 
 
-class Protocol:
-    DROP = "DROP"
-    MESSAGE = "MESSAGE"
-    COMMAND = "COMMAND"
-    SERVER_HELLO = "SERVER_HELLO"
-    SERVER_WELCOME = "SERVER_WELCOME"
-    CLIENT_NAME = "CLIENT_NAME"
-    SERVER_INFO = "SERVER_INFO"
-    SERVER_BANNER = "SERVER_INFO"
-    TELL = "TELL"
-
-
 class Client:
     def __init__(self, ip_addr, name):
         self.name = name
@@ -2,18 +2,25 @@
 import asyncio
 import curses
 import curses.ascii
-import json
+import os
+import signal
 import sys
 from asyncio.streams import StreamReader, StreamWriter
+from collections import deque
 from curses import ERR, wrapper
 from typing import Any, Optional, Tuple
 
 from chatwin import ChatWin
+from codec import CODECS, JSON, BinaryCodec
+from frame import FrameDecoder, FrameError
 from inputfield import InputField
 from protocol import Protocol
+from render import RenderScheduler
+from session import encode
 
 PORT = 42069
 DEBUG_MODE = False
+READ_SIZE = 0x10000
 
 B2C = 1000 / 255
 C2B = 255 / 1000
@@ -50,13 +57,27 @@ def rgb2curs(r:int, g:int, b:int):
     return int(r * B2C), int(g * B2C), int(b * B2C)
 
 
+def new_event_loop() -> asyncio.AbstractEventLoop:
+    """Create an event loop, using uvloop if it is installed
+
+    Returns:
+        asyncio.AbstractEventLoop: The new event loop
+    """
+    try:
+        import uvloop
+
+        return uvloop.new_event_loop()
+    except ImportError:
+        return asyncio.new_event_loop()
+
+
 class MainWin:
     """The main curses window.
 
     Contains the in- and out streams that interact with the socket, and is
     responsible for handling the communication with the server.  Actual display
     and user input is handled by the child components `MainWin.input_field` and
-    `MainWin.output_field`.
+    `MainWin.output_field`, which are repainted in batches by `MainWin.render`.
 
     Args:
         display (screen): The main curses display. Dependency injected by the curses wrapper.
@@ -70,17 +91,36 @@ class MainWin:
         self.reader: StreamReader
         self.writer: StreamWriter
         self.display.nodelay(True)
+        # Deliver PageUp, PageDown and resizes as single key codes
+        self.display.keypad(True)
         self.display.clear()
         self.colors = dict()
+        self.codec = JSON
+        self.authenticated = False
+        self.decoder = FrameDecoder()
+        self.inbox = deque()
+        self.keys: asyncio.Queue
         height, width = self.display.getmaxyx()
 
         self.input_field = InputField(width - 2, 3, height - 3, 0)
         self.output_field = ChatWin(width - 2, height - 4)
+        self.render = RenderScheduler()
+        self.render.add(self.output_field)
+        # Added last, so the cursor stays in the input field
+        self.render.add(self.input_field)
 
     def run(self):
-        loop = asyncio.get_event_loop()
+        loop = new_event_loop()
+        asyncio.set_event_loop(loop)
+        # Created once the loop is set, as queues bind to the current loop before Python 3.10
+        self.keys = asyncio.Queue()
         loop.create_task(self.connect())
         loop.create_task(self.poll_input())
+        # Wake up only when a key is pressed or the terminal is resized
+        loop.add_reader(sys.stdin.fileno(), self.read_keys)
+        if hasattr(signal, "SIGWINCH"):
+            loop.add_signal_handler(signal.SIGWINCH, self.resize_terminal)
+        loop.call_soon(self.render.flush)
         loop.run_forever()
 
     def get_or_create_color(self, color):
@@ -106,24 +146,37 @@ class MainWin:
             self.display.addstr("failed auth")
             exit(1)
         while True:
-            if not self.reader.at_eof():
-                typ, dat = await self.recv()
-                self.handle_message(typ, dat)
-            else:
-                await asyncio.sleep(0.1)
+            typ, dat = await self.recv()
+            if typ is None:
+                self.output_field.add_banner("Forbindelsen til serveren blev lukket")
+                self.render.mark(self.output_field)
+                return
+            if typ == Protocol.PING:
+                await self.send(Protocol.PONG)
+                continue
+            self.handle_message(typ, dat)
 
-    async def poll_input(self):
-        """Try to read user input, yielding control back to the event loop if none is
-        available."""
+    def read_keys(self):
+        """Queue every key press waiting on stdin. Called by the event loop when stdin is readable"""
         while True:
             try:
                 char = self.display.getch()
-            except:
+            except curses.error:
                 char = ERR
-            if char is not ERR:
-                await self.handle_input(char)
-            else:
-                await asyncio.sleep(0.1)
+            if char == ERR:
+                return
+            self.keys.put_nowait(char)
+
+    def resize_terminal(self):
+        """Handle SIGWINCH, which replaces the handler curses would resize the screen in"""
+        size = os.get_terminal_size(sys.stdout.fileno())
+        curses.resizeterm(size.lines, size.columns)
+        self.resize()
+
+    async def poll_input(self):
+        """Handle the queued key presses in order, waiting for more if there are none"""
+        while True:
+            await self.handle_input(await self.keys.get())
 
     async def handle_input(self, char:int):
         """Handle received keyboard input.
@@ -135,20 +188,45 @@ class MainWin:
         :param char: The keycode for the pressed key.
         :type char: int
         """
+        if char == curses.KEY_RESIZE:
+            self.resize()
+            return
+        if char in (curses.KEY_PPAGE, curses.KEY_NPAGE, curses.KEY_END):
+            page = self.output_field.page - 1
+            if char == curses.KEY_END:
+                self.output_field.scroll(-self.output_field.offset)
+            else:
+                self.output_field.scroll(page if char == curses.KEY_PPAGE else -page)
+            self.render.mark(self.output_field)
+            return
         if char in (curses.KEY_BACKSPACE, "\b", "\x08", "\x7f", curses.ascii.BS): 
             self.input_field.backspace()
         elif char == 10:
             message = self.input_field.flush_input()
-            if message.startswith("/"):
-                split = message[1:].split()
-                cmd = split[0]
-                args = split[1:]
-                await self.send(Protocol.COMMAND, cmd=cmd, args=args)
-            else:
-                await self.send(Protocol.MESSAGE, message=message)
-        else:
+            try:
+                if message.startswith("/"):
+                    split = message[1:].split()
+                    cmd = split[0]
+                    args = split[1:]
+                    await self.send(Protocol.COMMAND, cmd=cmd, args=args)
+                else:
+                    await self.send(Protocol.MESSAGE, message=message)
+            except FrameError:
+                self.output_field.add_banner("Beskeden er for lang og blev ikke sendt")
+                self.render.mark(self.output_field)
+        elif char < curses.KEY_MIN:
             self.input_field.add_char(char)
-        self.input_field.refresh()
+        self.render.mark(self.input_field)
+
+    def resize(self):
+        """Lay the components out for the new terminal size"""
+        height, width = self.display.getmaxyx()
+        self.display.erase()
+        self.display.noutrefresh()
+        self.output_field.resize(width - 2, height - 4)
+        self.input_field.resize(width - 2, height - 3)
+        self.render.mark(self.output_field)
+        self.render.mark(self.input_field)
 
     def handle_message(self, typ:str, data:Optional[Any]=None):
         """handle a server message
@@ -158,67 +236,84 @@ class MainWin:
         :param data: the `payload` component of the received message, defaults to None
         :type data: Optional[Any], optional
         """
-        if typ == Protocol.MESSAGE:
+        if typ in (Protocol.MESSAGE, Protocol.HISTORY):
             sender = data.get("sender")
+            if data.get("room"):
+                sender = "#{} {}".format(data["room"], sender)
             msg = data.get("message")
             color = self.get_or_create_color(data.get("color"))
             self.output_field.add_entry(sender, msg, color)
-            self.input_field.refresh()
-            self.output_field.refresh()
-        elif typ == Protocol.SERVER_INFO:
+            self.render.mark(self.output_field)
+        elif typ in (Protocol.SERVER_INFO, Protocol.DROP):
             msg = data.get("message")
             self.output_field.add_banner(msg)
-            self.output_field.refresh()
+            self.render.mark(self.output_field)
 
     async def recv(self):
-        header = await self.reader.read(4)
-        size = int.from_bytes(header, "little")
-        if size > 0xFFF:
-            # drop connection. beyond size limit
-            ...
-        data = await self.reader.read(size)
-        try:
-            message = json.loads(data)
-            return message.get("type"), message.get("payload")
-        except:
-            print("could not deserialize data:", data)
-            return None, None
+        """Receive the next message from the server
+
+        Frames are decoded incrementally, so a single read can satisfy several
+        calls when the server pipelines messages.
+
+        :return: the `type` and `payload` of the message, or (None, None) if
+            the connection was closed or the server sent an invalid frame
+        :rtype: Tuple[Optional[str], Optional[Any]]
+        """
+        while not self.inbox:
+            try:
+                # Until the handshake completes, the next frame may switch codec
+                limit = None if self.authenticated else 1
+                self.inbox.extend(self.decoder.decode(limit))
+            except FrameError:
+                self.writer.close()
+                return None, None
+            if self.inbox:
+                break
+            data = await self.reader.read(READ_SIZE)
+            if not data:
+                return None, None
+            self.decoder.feed(data)
+        return self.inbox.popleft()
 
     async def send(self, typ:str, **kwargs):
         """Send a message to the server
 
         Every key/value pair in `kwargs` will be added as a field in the `payload` of the final message.
+        The length header and the message are written in a single buffer.
 
         :param typ: The protocol message type
         :type typ: str
+        :raises FrameError: If the message is over the size limit. Nothing is sent,
+            as the server would drop the connection
         """
-        message = {"type": typ}
-        if kwargs:
-            message["payload"] = kwargs
-        data = json.dumps(message).encode("utf8")
-        size = len(data)
-        if size > 0xFFF:
-            # throw error. size limit exeeded
-            ...
-        self.writer.write(int.to_bytes(size, 4, "little"))
-        await self.writer.drain()
-        self.writer.write(data)
+        self.writer.write(encode(self.codec, typ, kwargs))
         await self.writer.drain()
 
     async def authenticate(self, name:str) -> bool:
         """Perform the handshake with the server
 
+        Asks for the binary codec if the server offers it, and switches to
+        whichever codec the server confirms once the handshake is complete.
+
         :param name: the requested name.
         :type name: str
         :return: success status of the handshake
         :rtype: bool
         """
         while True:
-            typ, _ = await self.recv()
+            typ, data = await self.recv()
+            if typ is None or typ == Protocol.DROP:
+                return False
             if typ == Protocol.SERVER_HELLO:
-                await self.send(Protocol.CLIENT_NAME, name=name)
+                offered = (data or {}).get("codecs", [])
+                if BinaryCodec.name in offered:
+                    await self.send(Protocol.CLIENT_NAME, name=name, codec=BinaryCodec.name)
+                else:
+                    await self.send(Protocol.CLIENT_NAME, name=name)
                 continue
             if typ == Protocol.SERVER_WELCOME:
+                self.codec = self.decoder.codec = CODECS.get(data.get("codec"), JSON)
+                self.authenticated = True
                 return True
 
 
@@ -0,0 +1,73 @@
+from typing import Any, Optional
+
+from codec import JSON
+
+MAX_FRAME_SIZE = 0xFFF
+
+
+class FrameError(Exception):
+    """Raised when the server sends a frame that is oversized or cannot be decoded"""
+
+
+class FrameDecoder:
+    """Incrementally decodes frames from a byte stream.
+
+    Data read from the socket is fed to the decoder as it arrives, regardless of
+    where frames begin and end. `decode` then returns every complete frame in
+    the buffer and keeps any trailing partial frame until more data arrives.
+    Message objects are decoded straight from views into the buffer, without
+    copying each frame out first.
+
+    Attributes:
+        max_size: The largest accepted frame size, excluding the header
+        codec:    The codec message objects are decoded with
+    """
+
+    def __init__(self, max_size: int = MAX_FRAME_SIZE):
+        """Initialize a decoder with an empty buffer.
+
+        Args:
+            max_size (int): The largest accepted frame size, excluding the header
+        """
+        self.max_size = max_size
+        self.codec = JSON
+        self.buffer = bytearray()
+
+    def feed(self, data: bytes):
+        """Append data received from the stream to the buffer"""
+        self.buffer += data
+
+    def decode(self, limit: Optional[int] = None) -> list[tuple[str, Any]]:
+        """Decode every complete frame in the buffer
+
+        Args:
+            limit (int): Decode at most this many frames and leave the rest in
+                the buffer. Used while the codec may still change, e.g. during
+                the handshake.
+
+        Returns:
+            A list of (type, data) tuples, which represents the extracted `type`
+            and `payload` fields of each decoded message object.
+
+        Raises:
+            FrameError: If a frame exceeds `max_size` or does not hold a valid
+                message object. The stream cannot be recovered after this.
+        """
+        messages = []
+        offset = 0
+        available = len(self.buffer)
+        with memoryview(self.buffer) as view:
+            while available - offset >= 4 and len(messages) != limit:
+                size = int.from_bytes(view[offset : offset + 4], "little")
+                if size > self.max_size:
+                    raise FrameError("Frame of {} bytes exceeds size limit".format(size))
+                end = offset + 4 + size
+                if end > available:
+                    break
+                try:
+                    messages.append(self.codec.decode(view[offset + 4 : end]))
+                except (ValueError, TypeError, KeyError) as e:
+                    raise FrameError("Malformed frame: {}".format(e)) from e
+                offset = end
+        del self.buffer[:offset]
+        return messages
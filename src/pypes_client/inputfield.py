@@ -17,6 +17,10 @@ class InputField:
         self.current_input = ""
 
     def add_char(self, char):
+        height, width = self.pad.getmaxyx()
+        if self.pad.getyx()[1] >= width - 1:
+            # Grow the pad, so a long paste is kept whole
+            self.pad.resize(height, width * 2)
         self.pad.addch(char)
         y, x = self.pad.getyx()
         self.current_row += 1
@@ -41,7 +45,13 @@ class InputField:
         self.pad.move(y, x - 1)
         self.current_input = self.current_input[:-1]
 
+    def resize(self, width, y):
+        """Move the field to row `y` of a resized terminal, and fit it to `width`"""
+        self.width = width
+        self.y = y
+        self.win = curses.newwin(self.height, width, y, self.x)
+
     def refresh(self):
         self.win.box()
         self.win.noutrefresh()
-        self.pad.refresh(0, self.current_x, self.y + 1, 1, self.y + 2, self.width - 2)
+        self.pad.noutrefresh(0, self.current_x, self.y + 1, 1, self.y + 2, self.width - 2)
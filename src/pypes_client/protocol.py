@@ -11,4 +11,8 @@ class Protocol:
     SERVER_INFO    = "SERVER_INFO"
     SERVER_BANNER  = "SERVER_BANNER"
     CLIENT_NAME    = "CLIENT_NAME"
-    CLIENT_CMD     = "CLIENT_CMD"
\ No newline at end of file
+    CLIENT_CMD     = "CLIENT_CMD"
+    TELL           = "TELL"
+    HISTORY        = "HISTORY"
+    PING           = "PING"
+    PONG           = "PONG"
\ No newline at end of file
@@ -0,0 +1,59 @@
+import asyncio
+import curses
+import time
+from typing import Optional
+
+# Shortest time between two repaints, in seconds
+FRAME_INTERVAL = 1 / 30
+
+
+class RenderScheduler:
+    """Batches repaints of the curses components into frames.
+
+    Instead of refreshing the screen whenever something changes, components
+    are marked dirty, and at most once per `interval` every dirty component
+    copies itself to the virtual screen with ``noutrefresh``, followed by a
+    single ``curses.doupdate()``. A burst of messages therefore costs one
+    repaint per frame, however many arrive.
+
+    Components are repainted in the order they were added, so the last one
+    added ends up owning the cursor. It is repainted with every frame.
+
+    :param interval: Shortest time between two repaints, in seconds
+    :type interval: float
+    """
+
+    def __init__(self, interval: float = FRAME_INTERVAL):
+        self.interval = interval
+        self.components = []
+        self.dirty = set()
+        self.last = 0.0
+        self.handle: Optional[asyncio.Handle] = None
+
+    def add(self, component):
+        """Register a component. It must have a ``refresh`` method using ``noutrefresh``"""
+        self.components.append(component)
+        self.dirty.add(component)
+
+    def mark(self, component):
+        """Mark a component as changed, scheduling a repaint if none is pending"""
+        self.dirty.add(component)
+        if self.handle is None:
+            delay = self.last + self.interval - time.monotonic()
+            loop = asyncio.get_running_loop()
+            if delay > 0:
+                self.handle = loop.call_later(delay, self.flush)
+            else:
+                self.handle = loop.call_soon(self.flush)
+
+    def flush(self):
+        """Repaint every dirty component now"""
+        self.handle = None
+        if not self.dirty:
+            return
+        for component in self.components:
+            if component in self.dirty or component is self.components[-1]:
+                component.refresh()
+        self.dirty.clear()
+        curses.doupdate()
+        self.last = time.monotonic()
@@ -0,0 +1,360 @@
+import asyncio
+import inspect
+from asyncio.streams import StreamReader, StreamWriter
+from collections import deque
+from typing import Any, Awaitable, Callable, NamedTuple, Optional, Union
+
+from codec import CODECS, JSON, BinaryCodec
+from frame import MAX_FRAME_SIZE, FrameDecoder, FrameError
+from protocol import Protocol
+
+PORT = 42069
+READ_SIZE = 0x10000
+
+
+class Message(NamedTuple):
+    """A message received from the server"""
+
+    type: str
+    data: Any
+
+
+class HandshakeError(ConnectionError):
+    """Raised when the server drops or closes the connection during the handshake"""
+
+
+def encode(codec, typ: str, payload: Optional[dict] = None) -> bytes:
+    """Encode a message object, including its length header
+
+    :param codec: The codec to encode with
+    :param typ: The protocol message type
+    :type typ: str
+    :param payload: The payload of the message
+    :type payload: Optional[dict]
+    :raises FrameError: If the message is over the size limit, or cannot be encoded
+    :rtype: bytes
+    """
+    try:
+        data = codec.encode(typ, payload)
+    except (ValueError, TypeError) as e:
+        raise FrameError("Cannot encode {}: {}".format(typ, e)) from e
+    if len(data) > MAX_FRAME_SIZE:
+        raise FrameError("Frame of {} bytes exceeds size limit".format(len(data)))
+    return len(data).to_bytes(4, "little") + data
+
+
+class Session:
+    """A headless connection to a Pypes server, for bots and integrations.
+
+    `connect` performs the handshake, and PING is answered on its own.
+    Messages are delivered to `on_message` if given, which is called with the
+    session and the `Message`, and awaited if it returns an awaitable. The next
+    message is not read until it returns, so a slow callback slows down the
+    session rather than queueing without bound. Without a callback, messages
+    are queued for `recv` and ``async for``::
+
+        async with Session("127.0.0.1", name="AlertBot") as bot:
+            await bot.say("Deploy finished")
+            async for message in bot:
+                if message.type == Protocol.TELL:
+                    await bot.tell(message.data["sender"], "pong")
+
+    :param host: The server address
+    :type host: str
+    :param port: The server port
+    :type port: int
+    :param name: The name to ask for. The server may hand out another one
+    :type name: str
+    :param on_message: Called with the session and every received message
+    :type on_message: Optional[Callable]
+    :param binary: Ask for the binary codec if the server offers it
+    :type binary: bool
+
+    After a lost connection, `reconnect` resumes the session with the token
+    from the welcome, keeping the name, color and rooms, and the server sends
+    only the broadcasts missed since `last_seq`.
+    """
+
+    def __init__(
+        self,
+        host: str,
+        port: int = PORT,
+        name: str = "Bot",
+        on_message: Optional[Callable[["Session", Message], Union[None, Awaitable]]] = None,
+        binary: bool = True,
+    ):
+        self.host = host
+        self.port = port
+        self.requested_name = name
+        self.name: Optional[str] = None
+        self.color: Optional[str] = None
+        self.token: Optional[str] = None
+        self.last_seq: Optional[int] = None
+        self.resumed = False
+        self.on_message = on_message
+        self.binary = binary
+        self.codec = JSON
+        self.decoder = FrameDecoder()
+        self.reader: Optional[StreamReader] = None
+        self.writer: Optional[StreamWriter] = None
+        self.pending = deque()
+        # Created by `connect`, as queues bind to the current loop before Python 3.10
+        self.inbox: Optional[asyncio.Queue] = None
+        self.task: Optional[asyncio.Task] = None
+        self.closed = False
+
+    async def connect(self, timeout: Optional[float] = 10.0) -> "Session":
+        """Connect and perform the handshake, then start delivering messages
+
+        :param timeout: Seconds the connection and handshake may take
+        :type timeout: Optional[float]
+        :raises HandshakeError: If the server refuses the session
+        :raises OSError: If the server cannot be reached
+        :return: The session, to allow ``session = await Session(...).connect()``
+        """
+        if self.inbox is None:
+            self.inbox = asyncio.Queue()
+        self.reader, self.writer = await asyncio.wait_for(
+            asyncio.open_connection(self.host, self.port), timeout
+        )
+        try:
+            await asyncio.wait_for(self.handshake(), timeout)
+        except BaseException:
+            self.writer.close()
+            self.closed = True
+            raise
+        self.task = asyncio.get_running_loop().create_task(self.listen())
+        return self
+
+    async def handshake(self):
+        while True:
+            try:
+                typ, data = await self.read_message(limit=1)
+            except ConnectionResetError as e:
+                raise HandshakeError(str(e)) from e
+            if typ == Protocol.SERVER_HELLO:
+                offered = (data or {}).get("codecs", [])
+                # Not the assigned name: if the token is not honoured, e.g. by another worker,
+                # the parked session still holds it, and asking for it would add a suffix
+                hello = dict(name=self.requested_name)
+                if self.binary and BinaryCodec.name in offered:
+                    hello["codec"] = BinaryCodec.name
+                if self.token:
+                    hello["token"] = self.token
+                    if self.last_seq is not None:
+                        hello["seq"] = self.last_seq
+                self.send_nowait(Protocol.CLIENT_NAME, **hello)
+            elif typ == Protocol.SERVER_WELCOME:
+                self.codec = self.decoder.codec = CODECS.get(data.get("codec"), JSON)
+                self.name = data.get("name", self.requested_name)
+                self.color = data.get("color")
+                self.token = data.get("token")
+                self.resumed = bool(data.get("resumed"))
+                if not self.resumed or self.last_seq is None:
+                    self.last_seq = data.get("seq")
+                return
+            elif typ == Protocol.DROP:
+                raise HandshakeError((data or {}).get("message", "Dropped by the server"))
+
+    async def read_message(self, limit: Optional[int] = None) -> tuple:
+        """Return the next message from the stream, reading only when none is buffered
+
+        :raises ConnectionResetError: If the connection is closed
+        :raises FrameError: If the server sends an invalid frame
+        """
+        while not self.pending:
+            self.pending.extend(self.decoder.decode(limit))
+            if self.pending:
+                break
+            data = await self.reader.read(READ_SIZE)
+            if not data:
+                raise ConnectionResetError("Connection closed by the server")
+            self.decoder.feed(data)
+        return self.pending.popleft()
+
+    async def listen(self):
+        """Deliver messages until the connection closes. Runs in `task`"""
+        try:
+            while True:
+                typ, data = await self.read_message()
+                if typ == Protocol.PING:
+                    self.send_nowait(Protocol.PONG)
+                    continue
+                if typ == Protocol.MESSAGE and "seq" in data:
+                    self.last_seq = max(self.last_seq or 0, data["seq"])
+                message = Message(typ, data)
+                if self.on_message is None:
+                    self.inbox.put_nowait(message)
+                    continue
+                result = self.on_message(self, message)
+                if inspect.isawaitable(result):
+                    await result
+        except (ConnectionError, FrameError):
+            pass
+        finally:
+            self.closed = True
+            self.writer.close()
+            self.inbox.put_nowait(None)
+
+    async def reconnect(self, timeout: Optional[float] = 10.0) -> "Session":
+        """Connect again after the connection was lost, resuming the session if the server still has it
+
+        Messages not yet taken from the inbox are kept. Whether the session
+        was resumed is in `resumed`. If not, the server handed out a name
+        and color as for a new session.
+
+        :param timeout: Seconds the connection and handshake may take
+        :type timeout: Optional[float]
+        :raises HandshakeError: If the server refuses the session
+        :raises OSError: If the server cannot be reached
+        """
+        await self.close()
+        queued = []
+        while self.inbox is not None and not self.inbox.empty():
+            message = self.inbox.get_nowait()
+            if message is not None:
+                queued.append(message)
+        for message in queued:
+            self.inbox.put_nowait(message)
+        self.codec = JSON
+        self.decoder = FrameDecoder()
+        self.pending.clear()
+        self.task = None
+        self.closed = False
+        return await self.connect(timeout)
+
+    def send_nowait(self, typ: str, **payload):
+        """Queue a message for the server without waiting for it to be flushed
+
+        :raises ConnectionError: If the session is closed
+        """
+        self.write(encode(self.codec, typ, payload))
+
+    def write(self, frame: bytes):
+        """Queue an already encoded frame, see `encode`"""
+        if self.writer.is_closing():
+            raise ConnectionResetError("Session is closed")
+        self.writer.write(frame)
+
+    async def send(self, typ: str, **payload):
+        """Send a message to the server, waiting while the socket buffer is full"""
+        self.send_nowait(typ, **payload)
+        await self.writer.drain()
+
+    async def say(self, message: str, room: Optional[str] = None):
+        """Broadcast a chat message, to `room` or to the room joined last"""
+        if room:
+            await self.send(Protocol.MESSAGE, message=message, room=room)
+        else:
+            await self.send(Protocol.MESSAGE, message=message)
+
+    async def tell(self, target: str, message: str):
+        """Send a private message to a user"""
+        await self.send(Protocol.TELL, target=target, message=message)
+
+    async def command(self, cmd: str, *args):
+        """Run a chat command, e.g. ``await session.command("JOIN", "ops")``"""
+        await self.send(Protocol.COMMAND, cmd=cmd, args=[str(arg) for arg in args])
+
+    async def recv(self) -> Message:
+        """Return the next message, when there is no `on_message` callback
+
+        :raises ConnectionResetError: If the session closed, or was never connected
+        """
+        if self.inbox is None:
+            raise ConnectionResetError("Session is not connected")
+        message = await self.inbox.get()
+        if message is None:
+            # Leave the end marker for the next caller
+            self.inbox.put_nowait(None)
+            raise ConnectionResetError("Session is closed")
+        return message
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self) -> Message:
+        try:
+            return await self.recv()
+        except ConnectionResetError:
+            raise StopAsyncIteration
+
+    async def close(self):
+        """Close the connection and stop delivering messages"""
+        self.closed = True
+        if self.writer is not None:
+            self.writer.close()
+        if self.task is not None:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+
+    async def __aenter__(self) -> "Session":
+        return await self.connect()
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+
+class Fleet:
+    """Many sessions to the same server, run in one process.
+
+    Codecs hold no per session state, so every session shares the same codec
+    objects, and `send_all` encodes a message once per codec no matter how
+    many sessions it is written to.
+
+    :param host: The server address
+    :type host: str
+    :param port: The server port
+    :type port: int
+    :param on_message: Passed to every session, see `Session`
+    :type on_message: Optional[Callable]
+    :param binary: Ask for the binary codec if the server offers it
+    :type binary: bool
+    """
+
+    def __init__(self, host: str, port: int = PORT, on_message=None, binary: bool = True):
+        self.host = host
+        self.port = port
+        self.on_message = on_message
+        self.binary = binary
+        self.sessions: list[Session] = []
+
+    async def spawn(self, count: int, name: str = "Bot", concurrency: int = 100) -> list:
+        """Connect `count` sessions, at most `concurrency` handshakes at a time
+
+        Sessions that fail to connect are left out.
+
+        :return: The sessions that connected
+        :rtype: List[Session]
+        """
+        limit = asyncio.Semaphore(concurrency)
+
+        async def one():
+            async with limit:
+                session = Session(self.host, self.port, name, self.on_message, self.binary)
+                try:
+                    return await session.connect()
+                except (OSError, asyncio.TimeoutError):
+                    return None
+
+        connected = [s for s in await asyncio.gather(*(one() for _ in range(count))) if s]
+        self.sessions += connected
+        return connected
+
+    def send_all(self, typ: str, **payload):
+        """Queue the same message on every open session, encoding it once per codec"""
+        frames = {}
+        for session in self.sessions:
+            if session.closed:
+                continue
+            frame = frames.get(session.codec.name)
+            if frame is None:
+                frame = frames[session.codec.name] = encode(session.codec, typ, payload)
+            session.write(frame)
+
+    async def close(self):
+        await asyncio.gather(*(session.close() for session in self.sessions))
+        self.sessions.clear()
+
+    def __len__(self):
+        return len(self.sessions)
@@ -0,0 +1,143 @@
+import unicodedata
+from collections import OrderedDict
+from functools import lru_cache
+
+# Wrapped texts kept by a WrapCache
+CACHE_SIZE = 8192
+
+
+@lru_cache(maxsize=4096)
+def char_width(char: str) -> int:
+    """Return the number of terminal cells a character takes up
+
+    East Asian wide and fullwidth characters take two cells, combining marks
+    and other zero width characters none.
+
+    :param char: A single character
+    :type char: str
+    :rtype: int
+    """
+    if unicodedata.combining(char) or unicodedata.category(char) in ("Mn", "Me", "Cf"):
+        return 0
+    return 2 if unicodedata.east_asian_width(char) in ("W", "F") else 1
+
+
+def display_width(text: str) -> int:
+    """Return the number of terminal cells a string takes up"""
+    if text.isascii():
+        return len(text)
+    return sum(map(char_width, text))
+
+
+def truncate(text: str, width: int) -> str:
+    """Cut a string down to at most `width` cells"""
+    if text.isascii():
+        return text[:width]
+    used = 0
+    for i, char in enumerate(text):
+        used += char_width(char)
+        if used > width:
+            return text[:i]
+    return text
+
+
+def pad(text: str, width: int, align: str = "<") -> str:
+    """Pad a string with spaces to `width` cells, aligned ``<``, ``>`` or ``^``"""
+    missing = width - display_width(text)
+    if missing <= 0:
+        return text
+    if align == ">":
+        return " " * missing + text
+    if align == "^":
+        return " " * (missing // 2) + text + " " * (missing - missing // 2)
+    return text + " " * missing
+
+
+def split_word(word: str, width: int) -> list:
+    """Split a word wider than `width` cells into pieces that fit"""
+    pieces = []
+    start = used = 0
+    for i, char in enumerate(word):
+        cells = char_width(char)
+        if used + cells > width and i > start:
+            pieces.append(word[start:i])
+            start, used = i, 0
+        used += cells
+    pieces.append(word[start:])
+    return pieces
+
+
+def wrap(text: str, width: int) -> tuple:
+    """Wrap text into lines of at most `width` cells, breaking at whitespace
+
+    Every paragraph starts a new line and yields at least one line, possibly
+    empty. Words wider than a line are broken up. Runs in time linear in the
+    length of the text, as lines are joined once rather than grown.
+
+    :param text: The text to wrap
+    :type text: str
+    :param width: Cells per line
+    :type width: int
+    :return: The lines
+    :rtype: Tuple[str, ...]
+    """
+    width = max(1, width)
+    lines = []
+    for paragraph in text.split("\n"):
+        line = []
+        used = 0
+        for word in paragraph.split():
+            cells = display_width(word)
+            if cells > width:
+                pieces = split_word(word, width)
+                word = pieces.pop()
+                cells = display_width(word)
+                for piece in pieces:
+                    if line:
+                        lines.append(" ".join(line))
+                    line, used = [piece], width
+            if line and used + 1 + cells > width:
+                lines.append(" ".join(line))
+                line, used = [], 0
+            used += cells + (1 if line else 0)
+            line.append(word)
+        lines.append(" ".join(line))
+    return tuple(lines)
+
+
+class WrapCache:
+    """Least recently used cache of wrapped texts, by text id and width.
+
+    Rewrapping a scrollback for a width seen before, e.g. when a terminal is
+    resized back and forth, then costs a dict lookup per entry.
+
+    :param size: Wrapped texts kept before the least recently used is evicted
+    :type size: int
+    """
+
+    def __init__(self, size: int = CACHE_SIZE):
+        self.size = size
+        self.wrapped = OrderedDict()
+
+    def wrap(self, key, text: str, width: int) -> tuple:
+        """Return `text` wrapped to `width` cells, wrapping it only if not cached
+
+        :param key: Identifies the text, e.g. a message id. Must not be reused for another text
+        :param text: The text to wrap
+        :type text: str
+        :param width: Cells per line
+        :type width: int
+        :rtype: Tuple[str, ...]
+        """
+        cache_key = (key, width)
+        lines = self.wrapped.get(cache_key)
+        if lines is not None:
+            self.wrapped.move_to_end(cache_key)
+            return lines
+        lines = self.wrapped[cache_key] = wrap(text, width)
+        if len(self.wrapped) > self.size:
+            self.wrapped.popitem(last=False)
+        return lines
+
+    def __len__(self):
+        return len(self.wrapped)
@@ -0,0 +1,242 @@
+import asyncio
+import os
+import socket
+from asyncio.streams import StreamReader, StreamWriter
+from typing import Any, Optional
+
+from codec import JSON
+from directory import UserDirectory
+from frame import FrameDecoder, FrameError
+from logs import get_logger
+
+logger = get_logger("bus")
+
+READ_SIZE = 0x10000
+# Bus frames wrap whole protocol messages, so they get more room than client frames
+MAX_BUS_FRAME_SIZE = 0xFFFF
+# Largest number of bytes the hub buffers for a worker before giving up on it
+MAX_RELAY_BUFFER = 0x1000000
+
+
+class Bus:
+    """Identifiers for messages on the inter-process bus."""
+
+    HELLO     = "BUS_HELLO"
+    REPLY     = "BUS_REPLY"
+    CLAIM     = "BUS_CLAIM"
+    RENAME    = "BUS_RENAME"
+    RELEASE   = "BUS_RELEASE"
+    BROADCAST = "BUS_BROADCAST"
+    TELL      = "BUS_TELL"
+    DELIVERED = "BUS_DELIVERED"
+
+
+def encode(typ: str, **payload) -> bytes:
+    """Encode a bus message with its length header"""
+    body = JSON.encode(typ, payload)
+    return len(body).to_bytes(4, "little") + body
+
+
+async def read_messages(reader: StreamReader):
+    """Yield every message read from a bus stream until it is closed"""
+    decoder = FrameDecoder(MAX_BUS_FRAME_SIZE)
+    while True:
+        data = await reader.read(READ_SIZE)
+        if not data:
+            return
+        decoder.feed(data)
+        for message in decoder.decode():
+            yield message
+
+
+class BusHub:
+    """Connects the worker processes of a multi-process server.
+
+    Runs in the parent process and listens on a Unix socket that every worker
+    connects to. The hub relays broadcasts between workers and owns the user
+    directory, so names stay unique across workers and TELLs can be routed to
+    the worker that holds the recipient.
+
+    Attributes:
+        path:    The path of the Unix socket
+        workers: Maps worker ids to the stream connected to that worker
+        owners:  Maps every connected username to the id of the worker holding it
+        tells:   Maps worker ids to the (worker, id) of the TELL requests
+                 relayed to that worker and not yet delivered
+    """
+
+    def __init__(self, path: str):
+        """Initialize the hub
+
+        Args:
+            path (str): The path of the Unix socket to listen on
+        """
+        self.path = path
+        self.sock: Optional[socket.socket] = None
+        self.workers: dict[int, StreamWriter] = {}
+        self.owners = UserDirectory()
+        self.tells: dict[int, set[tuple[int, int]]] = {}
+
+    def listen(self):
+        """Bind the hub's socket
+
+        Done before the workers are started, so they can connect right away,
+        and before any event loop exists in the parent process.
+        """
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.bind(self.path)
+        self.sock.listen(socket.SOMAXCONN)
+
+    async def serve(self):
+        """Serve the workers until cancelled"""
+        server = await asyncio.start_unix_server(self.worker_handler, sock=self.sock)
+        async with server:
+            await server.serve_forever()
+
+    def close(self):
+        """Close the hub's socket and remove it from the file system"""
+        if self.sock is not None:
+            self.sock.close()
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+    def relay(self, worker: int, data: bytes):
+        """Write a relayed message to a worker
+
+        The hub does not wait for workers to read. A worker that falls more
+        than `MAX_RELAY_BUFFER` bytes behind has missed too much to stay in
+        step with the others, and is disconnected, which stops it.
+        """
+        stream = self.workers[worker]
+        if stream.transport.get_write_buffer_size() + len(data) > MAX_RELAY_BUFFER:
+            logger.error("Worker %s is more than %d bytes behind on the bus. Disconnecting.", worker, MAX_RELAY_BUFFER)
+            self.workers.pop(worker)
+            stream.transport.abort()
+            return
+        stream.write(data)
+
+    def reply(self, worker: int, **payload):
+        """Send a reply to a worker, if it is still connected"""
+        stream = self.workers.get(worker)
+        if stream is not None:
+            stream.write(encode(Bus.REPLY, **payload))
+
+    async def worker_handler(self, reader: StreamReader, writer: StreamWriter):
+        """Serve requests from a single worker"""
+        worker = None
+        try:
+            async for typ, data in read_messages(reader):
+                if typ == Bus.HELLO:
+                    worker = data["worker"]
+                    self.workers[worker] = writer
+                    logger.info("Worker %s joined the bus", worker)
+                elif typ == Bus.CLAIM:
+                    name = self.owners.allocate(data["name"], worker)
+                    writer.write(encode(Bus.REPLY, id=data["id"], name=name))
+                elif typ == Bus.RENAME:
+                    ok = self.owners.rename(data["old"], data["new"], worker)
+                    writer.write(encode(Bus.REPLY, id=data["id"], ok=ok))
+                elif typ == Bus.RELEASE:
+                    self.owners.release(data["name"], worker)
+                elif typ == Bus.BROADCAST:
+                    relayed = encode(Bus.BROADCAST, **data)
+                    for other in [other for other in self.workers if other != worker]:
+                        self.relay(other, relayed)
+                elif typ == Bus.TELL:
+                    # The sender is answered once the owner of the recipient reports the delivery
+                    owner = self.owners.get(data["target"])
+                    if owner not in self.workers:
+                        writer.write(encode(Bus.REPLY, id=data["id"], ok=False))
+                        continue
+                    self.tells.setdefault(owner, set()).add((worker, data["id"]))
+                    self.relay(owner, encode(Bus.TELL, origin=worker, **data))
+                elif typ == Bus.DELIVERED:
+                    self.tells.get(worker, set()).discard((data["origin"], data["id"]))
+                    self.reply(data["origin"], id=data["id"], ok=data["ok"])
+        except (ConnectionError, FrameError) as e:
+            logger.warning("Lost worker %s: %s", worker, e)
+        finally:
+            logger.info("Worker %s left the bus", worker)
+            self.workers.pop(worker, None)
+            for origin, id in self.tells.pop(worker, ()):
+                self.reply(origin, id=id, ok=False)
+            for name in [name for name, owner in self.owners.items() if owner == worker]:
+                self.owners.release(name)
+            writer.close()
+
+
+class BusClient:
+    """A worker's connection to the `BusHub`.
+
+    Requests that need an answer from the hub, like claiming a name, are
+    matched with their reply by id. Broadcasts and TELLs relayed from other
+    workers are handed to the server.
+
+    Attributes:
+        path:   The path of the hub's Unix socket
+        worker: The id of this worker
+        server: The server that relayed messages are delivered to
+    """
+
+    def __init__(self, path: str, worker: int, server):
+        """Initialize a bus client
+
+        Args:
+            path (str): The path of the hub's Unix socket
+            worker (int): The id of this worker
+            server (Server): The server that relayed messages are delivered to
+        """
+        self.path = path
+        self.worker = worker
+        self.server = server
+        self.writer: Optional[StreamWriter] = None
+        self.pending: dict[int, asyncio.Future] = {}
+        self.last_id = 0
+
+    async def connect(self):
+        """Connect to the hub and start listening for relayed messages"""
+        reader, self.writer = await asyncio.open_unix_connection(self.path)
+        self.send(Bus.HELLO, worker=self.worker)
+        self.task = asyncio.create_task(self.listen(reader))
+
+    def send(self, typ: str, **payload):
+        """Send a message to the hub without waiting for a reply"""
+        self.writer.write(encode(typ, **payload))
+
+    async def request(self, typ: str, **payload) -> dict[str, Any]:
+        """Send a message to the hub and wait for its reply
+
+        Raises:
+            ConnectionError: If the connection to the hub is lost
+        """
+        self.last_id += 1
+        future = asyncio.get_running_loop().create_future()
+        self.pending[self.last_id] = future
+        self.send(typ, id=self.last_id, **payload)
+        return await future
+
+    async def listen(self, reader: StreamReader):
+        """Dispatch messages from the hub until the connection is lost"""
+        try:
+            async for typ, data in read_messages(reader):
+                if typ == Bus.REPLY:
+                    future = self.pending.pop(data["id"], None)
+                    if future and not future.done():
+                        future.set_result(data)
+                elif typ == Bus.BROADCAST:
+                    self.server.deliver(data["type"], data["payload"])
+                elif typ == Bus.TELL:
+                    ok = self.server.deliver_tell(data["target"], data["payload"])
+                    self.send(Bus.DELIVERED, origin=data["origin"], id=data["id"], ok=ok)
+        except (ConnectionError, FrameError) as e:
+            logger.error("Lost connection to the bus: %s", e)
+        finally:
+            logger.error("Worker %s disconnected from the bus. Stopping.", self.worker)
+            for future in self.pending.values():
+                if not future.done():
+                    future.set_exception(ConnectionResetError("Bus connection lost"))
+            self.pending.clear()
+            # Without the bus, names and broadcasts can no longer be shared
+            self.server.stop()
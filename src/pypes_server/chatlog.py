@@ -0,0 +1,386 @@
+import bisect
+import mmap
+import os
+import queue
+import struct
+import threading
+import time
+from typing import Any, Collection, Optional
+
+from codec import JSON
+from frame import Frame
+from logs import get_logger
+from rooms import DEFAULT_ROOM
+
+logger = get_logger("chatlog")
+
+# Record: sequence number, then the JSON encoded frame including its length header
+RECORD_HEADER = struct.Struct("<QI")
+# Index entry: offset of a record in the segment
+INDEX_ENTRY = struct.Struct("<Q")
+LOG_SUFFIX = ".log"
+INDEX_SUFFIX = ".idx"
+# Largest number of frames queued for the writer thread
+MAX_QUEUED = 0x10000
+
+
+class ChatLog:
+    """Persistent, append-only log of broadcasts.
+
+    Every broadcast is given a sequence number and appended to the current
+    segment file, along with its offset in a separate index file. Segments are
+    named after the sequence number of their first record, and a new segment is
+    started once the current one passes `segment_bytes`.
+
+    Appending only queues the frame; a background thread writes queued frames
+    in batches and calls ``fsync`` at most every `fsync_interval` seconds.
+    Reads map the segment and index files with mmap and decode one record at
+    a time, so deep history queries never load the whole log. Sequence numbers
+    may have gaps, so records are found by a binary search over their
+    sequence numbers rather than by their position in the segment.
+    Reads block on disk access, so callers on the event loop should run them
+    in an executor.
+
+    At most `MAX_QUEUED` frames wait for the writer thread. Frames appended
+    beyond that, or after the writer stopped on an error, are dropped and
+    counted, leaving a gap in the log.
+
+    Attributes:
+        directory:      The directory holding the segment files
+        segment_bytes:  Size at which a new segment is started
+        fsync_interval: Largest number of seconds between fsyncs
+        next_seq:       The sequence number given to the next broadcast
+        failed:         Whether the writer thread stopped on an error
+        dropped:        Number of frames dropped without being written
+    """
+
+    def __init__(self, directory: str, segment_bytes: int = 0x1000000, fsync_interval: float = 1.0):
+        """Open the log, recovering the sequence number from existing segments
+
+        Args:
+            directory (str): The directory holding the segment files. Created if missing.
+            segment_bytes (int): Size at which a new segment is started
+            fsync_interval (float): Largest number of seconds between fsyncs
+        """
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.fsync_interval = fsync_interval
+        os.makedirs(directory, exist_ok=True)
+        self.lock = threading.Lock()
+        self.segments = sorted(
+            int(name[: -len(LOG_SUFFIX)])
+            for name in os.listdir(directory)
+            if name.endswith(LOG_SUFFIX)
+        )
+        self.next_seq = self.recover()
+        self.queue: queue.Queue = queue.Queue(MAX_QUEUED)
+        self.failed = False
+        self.dropped = 0
+        self.thread = threading.Thread(target=self.run, name="chatlog", daemon=True)
+        self.thread.start()
+
+    def path(self, base: int, suffix: str) -> str:
+        return os.path.join(self.directory, "{:020d}{}".format(base, suffix))
+
+    def recover(self) -> int:
+        """Repair the segments left by a crash and return the next sequence number
+
+        A missing index is rebuilt from its segment, and the last segment is
+        made to match its index, see `repair`. The next sequence number
+        follows the last record on disk, or is the base of the last segment if
+        it holds no records.
+        """
+        if not self.segments:
+            return 1
+        for base in self.segments[:-1]:
+            if not os.path.exists(self.path(base, INDEX_SUFFIX)):
+                self.repair(base)
+        last = self.repair(self.segments[-1])
+        return self.segments[-1] if last is None else last + 1
+
+    def repair(self, base: int) -> Optional[int]:
+        """Make the index of a segment match its log, and trim a partially written tail
+
+        Index entries are written after their records, so a crash can leave
+        entries for records that never made it to disk, and whole records
+        without an entry. Entries are dropped back to the last one pointing at
+        a whole record, the whole records after it are indexed, and anything
+        beyond them is trimmed. A missing index is rebuilt the same way.
+
+        Returns:
+            (int) The sequence number of the last record, None if the segment holds none
+        """
+        index_path = self.path(base, INDEX_SUFFIX)
+        with open(self.path(base, LOG_SUFFIX), "r+b") as log, open(
+            index_path, "r+b" if os.path.exists(index_path) else "w+b"
+        ) as index:
+            log_size = os.fstat(log.fileno()).st_size
+            entries = os.fstat(index.fileno()).st_size // INDEX_ENTRY.size
+            count = entries
+            last = None
+            end = 0
+            while count and last is None:
+                index.seek((count - 1) * INDEX_ENTRY.size)
+                (offset,) = INDEX_ENTRY.unpack(index.read(INDEX_ENTRY.size))
+                record = read_header(log, offset, log_size, base)
+                if record is None:
+                    count -= 1
+                else:
+                    last, end = record
+            added = []
+            while True:
+                record = read_header(log, end, log_size, base if last is None else last + 1)
+                if record is None:
+                    break
+                added.append(INDEX_ENTRY.pack(end))
+                last, end = record
+            if count != entries or added:
+                logger.warning(
+                    "Repaired chat log segment %d: dropped %d index entries, indexed %d records",
+                    base,
+                    entries - count,
+                    len(added),
+                )
+            index.truncate(count * INDEX_ENTRY.size)
+            index.seek(count * INDEX_ENTRY.size)
+            index.write(b"".join(added))
+            if end < log_size:
+                logger.warning("Trimmed %d bytes from chat log segment %d", log_size - end, base)
+            log.truncate(end)
+        return last
+
+    def append(self, frame: Frame) -> int:
+        """Queue a broadcast frame to be written to the log
+
+        Args:
+            frame (Frame): The frame to record. If its payload has a `seq`, the
+                frame is recorded under that sequence number, which must be
+                higher than any recorded before
+
+        Returns:
+            (int) The sequence number given to the frame, even if it is dropped
+        """
+        seq = frame.payload.get("seq", self.next_seq)
+        self.next_seq = seq + 1
+        if self.failed:
+            self.dropped += 1
+            return seq
+        try:
+            self.queue.put_nowait((seq, frame.encode(JSON)))
+        except queue.Full:
+            if not self.dropped % MAX_QUEUED:
+                logger.warning("Chat log writer is %d frames behind. Dropping broadcasts.", MAX_QUEUED)
+            self.dropped += 1
+        return seq
+
+    def run(self):
+        """Write queued frames in batches until `close` is called"""
+        log = index = None
+        size = 0
+        last_sync = time.monotonic()
+        dirty = False
+        if self.segments:
+            base = self.segments[-1]
+            log = open(self.path(base, LOG_SUFFIX), "ab")
+            index = open(self.path(base, INDEX_SUFFIX), "ab")
+            size = log.tell()
+        try:
+            while True:
+                try:
+                    batch = [self.queue.get(timeout=self.fsync_interval)]
+                except queue.Empty:
+                    batch = []
+                while True:
+                    try:
+                        batch.append(self.queue.get_nowait())
+                    except queue.Empty:
+                        break
+                closing = None in batch
+                entries = []
+                for item in batch:
+                    if item is None:
+                        continue
+                    seq, data = item
+                    if log is None or size >= self.segment_bytes:
+                        if log is not None:
+                            self.flush(log, index, entries)
+                            entries = []
+                            os.fsync(log.fileno())
+                            os.fsync(index.fileno())
+                            log.close()
+                            index.close()
+                        log = open(self.path(seq, LOG_SUFFIX), "ab")
+                        index = open(self.path(seq, INDEX_SUFFIX), "ab")
+                        size = 0
+                        with self.lock:
+                            self.segments.append(seq)
+                    log.write(RECORD_HEADER.pack(seq, len(data)))
+                    log.write(data)
+                    entries.append(INDEX_ENTRY.pack(size))
+                    size += RECORD_HEADER.size + len(data)
+                    dirty = True
+                if entries:
+                    self.flush(log, index, entries)
+                now = time.monotonic()
+                if dirty and (closing or now - last_sync >= self.fsync_interval):
+                    os.fsync(log.fileno())
+                    os.fsync(index.fileno())
+                    last_sync = now
+                    dirty = False
+                if closing:
+                    return
+        except OSError as e:
+            self.failed = True
+            logger.error("Chat log stopped: %s. Broadcasts are no longer recorded.", e)
+        finally:
+            if log is not None:
+                log.close()
+                index.close()
+
+    def flush(self, log, index, entries: list[bytes]):
+        """Make written records visible to readers. Records are flushed before their index entries"""
+        log.flush()
+        index.write(b"".join(entries))
+        index.flush()
+
+    def before(self, seq: int, count: int, room: Optional[str] = None) -> list[tuple[int, str, Any]]:
+        """Read the most recent records older than a sequence number
+
+        Blocks on disk access. Records are read and decoded one at a time,
+        newest first, until `count` of them have been found.
+
+        Args:
+            seq (int): Only records with a lower sequence number are returned
+            count (int): Largest number of records returned
+            room (str): Only return broadcasts to this room
+
+        Returns:
+            Up to `count` (seq, type, payload) tuples, oldest first
+        """
+        with self.lock:
+            segments = list(self.segments)
+        records = []
+        rooms = None if room is None else (room,)
+        position = bisect.bisect_left(segments, seq) - 1
+        while position >= 0 and len(records) < count:
+            records.extend(self.read_segment(segments[position], seq, count - len(records), rooms))
+            position -= 1
+        records.reverse()
+        return records
+
+    def after(self, seq: int, count: int, rooms: Optional[Collection[str]] = None) -> list[tuple[int, str, Any]]:
+        """Read the oldest records newer than a sequence number
+
+        Blocks on disk access. Used to catch up a resumed session on what it
+        missed. Records still queued for the writer thread are not seen.
+
+        Args:
+            seq (int): Only records with a higher sequence number are returned
+            count (int): Largest number of records returned
+            rooms (Collection): Only return broadcasts to these rooms
+
+        Returns:
+            Up to `count` (seq, type, payload) tuples, oldest first
+        """
+        with self.lock:
+            segments = list(self.segments)
+        records = []
+        position = max(0, bisect.bisect_right(segments, seq) - 1)
+        while position < len(segments) and len(records) < count:
+            records.extend(self.read_segment(segments[position], seq, count - len(records), rooms, forward=True))
+            position += 1
+        return records
+
+    def read_segment(
+        self,
+        base: int,
+        seq: int,
+        count: int,
+        rooms: Optional[Collection[str]] = None,
+        forward: bool = False,
+    ) -> list[tuple[int, str, Any]]:
+        """Read up to `count` records of a segment, beyond sequence number `seq`
+
+        Reads the records older than `seq`, newest first, or with `forward`
+        the records newer than `seq`, oldest first.
+        """
+        with open(self.path(base, INDEX_SUFFIX), "rb") as index_file, open(
+            self.path(base, LOG_SUFFIX), "rb"
+        ) as log_file:
+            index_size = os.fstat(index_file.fileno()).st_size
+            entries = index_size // INDEX_ENTRY.size
+            if not entries:
+                return []
+            with mmap.mmap(index_file.fileno(), 0, access=mmap.ACCESS_READ) as index, mmap.mmap(
+                log_file.fileno(), 0, access=mmap.ACCESS_READ
+            ) as log:
+                records = []
+                step = 1 if forward else -1
+                # The first record newer than `seq`, the last one older than it
+                position = search(index, log, entries, seq + 1 if forward else seq)
+                if not forward:
+                    position -= 1
+                while 0 <= position < entries and len(records) < count:
+                    (offset,) = INDEX_ENTRY.unpack_from(index, position * INDEX_ENTRY.size)
+                    record_seq, size = RECORD_HEADER.unpack_from(log, offset)
+                    start = offset + RECORD_HEADER.size + 4
+                    with memoryview(log)[start : start + size - 4] as body:
+                        typ, payload = JSON.decode(body)
+                    position += step
+                    if rooms is None or payload.get("room", DEFAULT_ROOM) in rooms:
+                        records.append((record_seq, typ, payload))
+                return records
+
+    def close(self):
+        """Write everything still queued, fsync and stop the writer thread"""
+        if self.thread.is_alive():
+            self.queue.put(None)
+        self.thread.join()
+
+
+def search(index, log, entries: int, seq: int) -> int:
+    """Return the position of the first record of a segment with a sequence number of at least `seq`
+
+    Args:
+        index: The mapped index file of the segment
+        log: The mapped log file of the segment
+        entries (int): The number of records in the segment
+        seq (int): The sequence number to search for
+
+    Returns:
+        (int) The position, `entries` if every record is older
+    """
+    low, high = 0, entries
+    while low < high:
+        middle = (low + high) // 2
+        (offset,) = INDEX_ENTRY.unpack_from(index, middle * INDEX_ENTRY.size)
+        record_seq, _ = RECORD_HEADER.unpack_from(log, offset)
+        if record_seq < seq:
+            low = middle + 1
+        else:
+            high = middle
+    return low
+
+
+def read_header(log, offset: int, log_size: int, first: int) -> Optional[tuple[int, int]]:
+    """Read the header of a record, checking that the whole record is on disk
+
+    Args:
+        log: The log file of the segment
+        offset (int): The offset of the record
+        log_size (int): The size of the log file
+        first (int): The lowest sequence number the record may have
+
+    Returns:
+        (tuple) The sequence number of the record and the offset after it,
+        or None if there is no whole record at the offset
+    """
+    if offset + RECORD_HEADER.size + 4 > log_size:
+        return None
+    log.seek(offset)
+    seq, size = RECORD_HEADER.unpack(log.read(RECORD_HEADER.size))
+    end = offset + RECORD_HEADER.size + size
+    # The record holds a frame, which starts with its own length header
+    if seq < first or end > log_size or int.from_bytes(log.read(4), "little") != size - 4:
+        return None
+    return seq, end
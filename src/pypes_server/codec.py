@@ -0,0 +1,226 @@
+import json
+import struct
+from typing import Any, Optional, Tuple
+
+from protocol import Protocol
+
+# Wire ids are positions in these tables, so entries must only ever be appended.
+TYPES = (
+    Protocol.DROP,
+    Protocol.MESSAGE,
+    Protocol.COMMAND,
+    Protocol.SERVER_HELLO,
+    Protocol.SERVER_WELCOME,
+    Protocol.SERVER_INFO,
+    Protocol.SERVER_BANNER,
+    Protocol.CLIENT_NAME,
+    Protocol.CLIENT_CMD,
+    Protocol.TELL,
+    Protocol.HISTORY,
+    Protocol.PING,
+    Protocol.PONG,
+)
+KEYS = (
+    "message",
+    "sender",
+    "color",
+    "name",
+    "cmd",
+    "args",
+    "target",
+    "codecs",
+    "codec",
+    "seq",
+    "room",
+    "token",
+    "resumed",
+)
+
+ESCAPE = 0xFF
+INT_MIN, INT_MAX = -(1 << 63), (1 << 63) - 1
+NONE, FALSE, TRUE, INT, FLOAT, STR, LIST, DICT = range(8)
+
+_u16 = struct.Struct("<H")
+_i64 = struct.Struct("<q")
+_f64 = struct.Struct("<d")
+
+
+def _str(data: memoryview, pos: int, size: int) -> str:
+    """Decode `size` bytes of UTF-8 at `pos`, which must all be present"""
+    if pos + size > len(data):
+        raise IndexError("String runs past the end of the frame")
+    return str(data[pos : pos + size], "utf8")
+
+
+class JsonCodec:
+    """Encodes message objects as JSON. Every client understands this codec."""
+
+    name = "json"
+
+    def encode(self, typ: str, payload: Optional[dict]) -> bytes:
+        message = {"type": typ}
+        if payload:
+            message["payload"] = payload
+        return json.dumps(message).encode("utf8")
+
+    def decode(self, data: memoryview) -> Tuple[str, Any]:
+        message = json.loads(str(data, "utf8"))
+        return message["type"], message.get("payload")
+
+
+class BinaryCodec:
+    """Compact binary encoding of message objects.
+
+    The message type and payload keys are sent as single byte indices into
+    `TYPES` and `KEYS`. Names missing from the tables are escaped with ``0xFF``
+    followed by their length prefixed UTF-8 name. Each payload value is a one
+    byte tag followed by its data; strings and lists carry a 2 byte length.
+    Values that do not fit, such as integers outside 64 bits, raise ValueError.
+
+    .. code-block:: text
+
+        type | key tag value | key tag value | ...
+    """
+
+    name = "binary"
+
+    def __init__(self, types=TYPES, keys=KEYS):
+        self.types = types
+        self.keys = keys
+        self.type_ids = {name: bytes((i,)) for i, name in enumerate(types)}
+        self.key_ids = {name: bytes((i,)) for i, name in enumerate(keys)}
+        # Most payload values are strings, so store key id and tag together
+        self.str_keys = {name: bytes((i, STR)) for i, name in enumerate(keys)}
+
+    def _name(self, out: bytearray, name: str, ids: dict):
+        encoded = ids.get(name)
+        if encoded is None:
+            raw = name.encode("utf8")
+            if len(raw) > 0xFF:
+                raise ValueError("Name too long: {}".format(name[:20]))
+            out.append(ESCAPE)
+            out.append(len(raw))
+            out += raw
+        else:
+            out += encoded
+
+    def _value(self, out: bytearray, value):
+        if isinstance(value, str):
+            raw = value.encode("utf8")
+            out.append(STR)
+            out += _u16.pack(len(raw))
+            out += raw
+        elif value is None:
+            out.append(NONE)
+        elif value is True:
+            out.append(TRUE)
+        elif value is False:
+            out.append(FALSE)
+        elif isinstance(value, int):
+            if not INT_MIN <= value <= INT_MAX:
+                raise ValueError("Integer out of range")
+            out.append(INT)
+            out += _i64.pack(value)
+        elif isinstance(value, float):
+            out.append(FLOAT)
+            out += _f64.pack(value)
+        elif isinstance(value, (list, tuple)):
+            out.append(LIST)
+            out += _u16.pack(len(value))
+            for item in value:
+                self._value(out, item)
+        elif isinstance(value, dict):
+            out.append(DICT)
+            out += _u16.pack(len(value))
+            for key, item in value.items():
+                self._name(out, key, self.key_ids)
+                self._value(out, item)
+        else:
+            raise ValueError("Cannot encode {}".format(type(value).__name__))
+
+    def encode(self, typ: str, payload: Optional[dict]) -> bytes:
+        out = bytearray()
+        self._name(out, typ, self.type_ids)
+        try:
+            if payload:
+                for key, value in payload.items():
+                    if type(value) is str and key in self.str_keys:
+                        raw = value.encode("utf8")
+                        out += self.str_keys[key]
+                        out += _u16.pack(len(raw))
+                        out += raw
+                    else:
+                        self._name(out, key, self.key_ids)
+                        self._value(out, value)
+        except struct.error as e:
+            # A string or list longer than its 2 byte length allows
+            raise ValueError("Value too large: {}".format(e)) from e
+        return bytes(out)
+
+    def _read_name(self, data: memoryview, pos: int, table) -> Tuple[str, int]:
+        index = data[pos]
+        if index != ESCAPE:
+            return table[index], pos + 1
+        size = data[pos + 1]
+        return _str(data, pos + 2, size), pos + 2 + size
+
+    def _read_value(self, data: memoryview, pos: int) -> Tuple[Any, int]:
+        tag = data[pos]
+        pos += 1
+        if tag == STR:
+            (size,) = _u16.unpack_from(data, pos)
+            pos += 2
+            return _str(data, pos, size), pos + size
+        if tag == NONE:
+            return None, pos
+        if tag == TRUE:
+            return True, pos
+        if tag == FALSE:
+            return False, pos
+        if tag == INT:
+            return _i64.unpack_from(data, pos)[0], pos + 8
+        if tag == FLOAT:
+            return _f64.unpack_from(data, pos)[0], pos + 8
+        if tag == LIST:
+            (count,) = _u16.unpack_from(data, pos)
+            pos += 2
+            items = []
+            for _ in range(count):
+                item, pos = self._read_value(data, pos)
+                items.append(item)
+            return items, pos
+        if tag == DICT:
+            (count,) = _u16.unpack_from(data, pos)
+            pos += 2
+            items = {}
+            for _ in range(count):
+                key, pos = self._read_name(data, pos, self.keys)
+                items[key], pos = self._read_value(data, pos)
+            return items, pos
+        raise ValueError("Unknown value tag {}".format(tag))
+
+    def decode(self, data: memoryview) -> Tuple[str, Any]:
+        try:
+            typ, pos = self._read_name(data, 0, self.types)
+            payload = None
+            end = len(data)
+            if pos < end:
+                payload = {}
+                keys = self.keys
+                while pos < end:
+                    index = data[pos]
+                    if index != ESCAPE and data[pos + 1] == STR:
+                        (size,) = _u16.unpack_from(data, pos + 2)
+                        pos += 4
+                        payload[keys[index]] = _str(data, pos, size)
+                        pos += size
+                    else:
+                        key, pos = self._read_name(data, pos, keys)
+                        payload[key], pos = self._read_value(data, pos)
+        except (IndexError, struct.error) as e:
+            raise ValueError("Truncated binary frame") from e
+        return typ, payload
+
+
+CODECS = {codec.name: codec for codec in (BinaryCodec(), JsonCodec())}
+JSON = CODECS[JsonCodec.name]
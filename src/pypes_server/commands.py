@@ -0,0 +1,228 @@
+import asyncio
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Callable, Optional
+
+from logs import get_logger
+from protocol import Protocol
+
+logger = get_logger("commands")
+
+# Where an offloaded command runs
+THREAD = "thread"
+PROCESS = "process"
+
+REQUIRED = object()
+# Commands on the event loop taking longer than this are logged
+SLOW_COMMAND = 0.05
+
+
+class CommandError(Exception):
+    """Raised by a command to tell the user why it failed. The message is sent as SERVER_INFO"""
+
+
+class Param:
+    """A declared command argument.
+
+    Attributes:
+        name:    Shown in the usage text
+        convert: Called with the raw argument. May raise ValueError
+        default: Used when the argument is left out. Required if not given
+    """
+
+    __slots__ = ("name", "convert", "default")
+
+    def __init__(self, name: str, convert: Callable[[str], Any] = str, default: Any = REQUIRED):
+        self.name = name
+        self.convert = convert
+        self.default = default
+
+    @property
+    def required(self) -> bool:
+        return self.default is REQUIRED
+
+    def __str__(self):
+        return "<{}>".format(self.name) if self.required else "[{}]".format(self.name)
+
+
+class Command:
+    """A registered command and its timing statistics.
+
+    Attributes:
+        name:    The command name, in upper case
+        handler: The function implementing the command
+        params:  The declared arguments, required ones first
+        offload: None to run `handler` on the event loop, or ``thread`` or
+                 ``process`` to run it in an executor
+        bind:    For offloaded commands, called on the event loop with the
+                 client to produce the leading arguments of `handler`
+        reply:   For offloaded commands, coroutine called on the event loop
+                 with the client and the result of `handler`
+        secret:  Whether the arguments must be kept out of the log, e.g. a password
+        calls:   Number of times the command ran
+        seconds: Total time spent in the command
+        slowest: Longest time a single call took
+    """
+
+    __slots__ = (
+        "name",
+        "handler",
+        "params",
+        "offload",
+        "bind",
+        "reply",
+        "secret",
+        "calls",
+        "seconds",
+        "slowest",
+    )
+
+    def __init__(
+        self,
+        name: str,
+        handler: Callable,
+        params: tuple = (),
+        offload: Optional[str] = None,
+        bind: Optional[Callable] = None,
+        reply: Optional[Callable] = None,
+        secret: bool = False,
+    ):
+        self.name = name
+        self.handler = handler
+        self.params = params
+        self.offload = offload
+        self.bind = bind
+        self.reply = reply
+        self.secret = secret
+        self.calls = 0
+        self.seconds = 0.0
+        self.slowest = 0.0
+
+    @property
+    def usage(self) -> str:
+        return " ".join(["/" + self.name] + [str(param) for param in self.params])
+
+    def parse(self, args: list) -> list:
+        """Convert raw arguments according to `params`
+
+        Raises:
+            CommandError: If arguments are missing, surplus or malformed
+        """
+        if len(args) > len(self.params):
+            raise CommandError("Brug: " + self.usage)
+        values = []
+        for i, param in enumerate(self.params):
+            if i >= len(args):
+                if param.required:
+                    raise CommandError("Brug: " + self.usage)
+                values.append(param.default)
+                continue
+            try:
+                values.append(param.convert(str(args[i])))
+            except ValueError:
+                raise CommandError("ugyldigt format: {}".format(param.name))
+        return values
+
+
+class CommandRegistry:
+    """Table of the commands users can run.
+
+    Commands are looked up in a dict built at registration time, which holds
+    the upper and lower case spelling of every name, so the common cases need
+    no string conversion. Handlers are coroutines called with the client and
+    the converted arguments, and run on the event loop. They should only do
+    cheap work there.
+
+    CPU heavy commands are registered with `offload`. Their handler is then a
+    plain function that runs in the loop's default executor (``thread``) or
+    in a process pool (``process``), so it never holds up delivery to other
+    users. It must not touch the client or server; what it needs is produced
+    on the loop by `bind`, and the result is sent by `reply`. Handlers run in
+    a process must be picklable, as must their arguments and result.
+
+    Attributes:
+        commands: Maps upper case names to commands
+    """
+
+    def __init__(self):
+        self.commands: dict[str, Command] = {}
+        self.table: dict[str, Command] = {}
+        self.pool: Optional[ProcessPoolExecutor] = None
+
+    def command(
+        self, name: str, *params: Param, offload: Optional[str] = None, bind=None, reply=None, secret: bool = False
+    ):
+        """Decorator registering a function as the handler of a command
+
+        Args:
+            name (str): The command name. Case insensitive
+            params (Param): The declared arguments, required ones first
+            offload (str): ``thread`` or ``process`` to run the handler off the loop
+            bind (Callable): For offloaded commands, returns the leading handler
+                arguments given the client. May raise `CommandError`
+            reply (Callable): For offloaded commands, coroutine sending the
+                result to the client. Defaults to sending it as SERVER_INFO
+            secret (bool): Keep the arguments out of the log
+        """
+        if offload not in (None, THREAD, PROCESS):
+            raise ValueError("Unknown offload: {}".format(offload))
+
+        def register(handler):
+            command = Command(name.upper(), handler, params, offload, bind, reply, secret)
+            self.commands[command.name] = command
+            self.table[command.name] = self.table[command.name.lower()] = command
+            return handler
+
+        return register
+
+    def lookup(self, name: str) -> Optional[Command]:
+        """Return the command with the given name, in any case"""
+        command = self.table.get(name)
+        if command is None:
+            command = self.table.get(name.upper())
+        return command
+
+    async def dispatch(self, client, name: str, args: list):
+        """Run a command for a client
+
+        Raises:
+            CommandError: If the command is unknown, or failed in a way the user should be told
+        """
+        command = self.lookup(name)
+        if command is None:
+            raise CommandError("Ukendt kommando: {}".format(name))
+        values = command.parse(args)
+        started = time.perf_counter()
+        try:
+            if command.offload is None:
+                await command.handler(client, *values)
+            else:
+                await self.run_offloaded(command, client, values)
+        finally:
+            elapsed = time.perf_counter() - started
+            command.calls += 1
+            command.seconds += elapsed
+            command.slowest = max(command.slowest, elapsed)
+            if command.offload is None and elapsed > SLOW_COMMAND:
+                logger.warning("Command %s took %.3fs", command.name, elapsed)
+
+    async def run_offloaded(self, command: Command, client, values: list):
+        leading = tuple(command.bind(client)) if command.bind else ()
+        loop = asyncio.get_running_loop()
+        if command.offload == PROCESS:
+            if self.pool is None:
+                self.pool = ProcessPoolExecutor()
+            executor = self.pool
+        else:
+            executor = None
+        result = await loop.run_in_executor(executor, command.handler, *leading, *values)
+        if command.reply:
+            await command.reply(client, result)
+        elif result is not None:
+            await client.send(Protocol.SERVER_INFO, message=str(result))
+
+    def close(self):
+        """Shut down the process pool, if one was started"""
+        if self.pool is not None:
+            self.pool.shutdown(cancel_futures=True)
+            self.pool = None
@@ -0,0 +1,126 @@
+from typing import Any, Iterator, Optional
+
+
+def fold(name: str) -> str:
+    """Return the key a name is looked up by. Names are case insensitive"""
+    return name.casefold()
+
+
+class UserDirectory:
+    """Case insensitive index of the usernames in use.
+
+    Names keep the case they were registered with, but are looked up by their
+    case folded form, so ``Bob`` and ``bob`` are the same user. Every name is
+    mapped to an owner, which is the client holding it on a single process
+    server, and the id of the worker holding it in the `BusHub`.
+
+    When a requested name is taken, a numeric suffix is added. A counter per
+    requested base name remembers where the last search for a free suffix
+    stopped, so a thousand users asking for ``Guest`` cost one lookup each
+    instead of a scan over ``Guest1`` to ``Guest999``. The counter is dropped
+    once no name allocated from its base is in use.
+
+    Every method completes without awaiting, so a rename is never observed
+    half done.
+
+    Attributes:
+        entries:  Maps folded names to (name, owner, folded base name)
+        suffixes: Maps folded base names to the next suffix to try
+        derived:  Maps folded base names to the number of names in use allocated from them
+    """
+
+    def __init__(self):
+        self.entries: dict[str, tuple[str, Any, str]] = {}
+        self.suffixes: dict[str, int] = {}
+        self.derived: dict[str, int] = {}
+
+    def allocate(self, requested: str, owner: Any) -> str:
+        """Register `requested`, or the first free name with a numeric suffix after it
+
+        Args:
+            requested (str): The name asked for
+            owner: The client or worker the name belongs to
+
+        Returns:
+            (str) The registered name
+        """
+        base = fold(requested)
+        name = requested
+        if base in self.entries:
+            suffix = self.suffixes.get(base, 1)
+            while fold(requested + str(suffix)) in self.entries:
+                suffix += 1
+            self.suffixes[base] = suffix + 1
+            name = requested + str(suffix)
+        self.register(name, owner, base)
+        return name
+
+    def add(self, name: str, owner: Any) -> bool:
+        """Register a name exactly as given, e.g. one allocated by the `BusHub`
+
+        Returns:
+            (bool) Whether the name was free
+        """
+        if fold(name) in self.entries:
+            return False
+        self.register(name, owner, fold(name))
+        return True
+
+    def register(self, name: str, owner: Any, base: str):
+        self.entries[fold(name)] = (name, owner, base)
+        self.derived[base] = self.derived.get(base, 0) + 1
+
+    def rename(self, old: str, new: str, owner: Any) -> bool:
+        """Move `owner` from one name to another, if the new name is free
+
+        Changing only the case of a name is always allowed. Fails if `old` is
+        not held by `owner`.
+
+        Returns:
+            (bool) Whether the name was changed
+        """
+        if self.get(old) != owner:
+            return False
+        if fold(new) in self.entries and fold(new) != fold(old):
+            return False
+        self.release(old, owner)
+        self.register(new, owner, fold(new))
+        return True
+
+    def release(self, name: str, owner: Any = None) -> bool:
+        """Remove a name, if it is held by `owner` or no owner is given
+
+        Returns:
+            (bool) Whether the name was removed
+        """
+        key = fold(name)
+        entry = self.entries.get(key)
+        if entry is None or (owner is not None and entry[1] != owner):
+            return False
+        del self.entries[key]
+        base = entry[2]
+        self.derived[base] -= 1
+        if not self.derived[base]:
+            del self.derived[base]
+            self.suffixes.pop(base, None)
+        return True
+
+    def get(self, name: str) -> Optional[Any]:
+        """Return the owner of a name, or None if it is not in use"""
+        entry = self.entries.get(fold(name))
+        return entry[1] if entry else None
+
+    def canonical(self, name: str) -> Optional[str]:
+        """Return a name with the case it was registered with, or None if it is not in use"""
+        entry = self.entries.get(fold(name))
+        return entry[0] if entry else None
+
+    def items(self) -> Iterator[tuple[str, Any]]:
+        """Iterate over (name, owner) pairs"""
+        return ((name, owner) for name, owner, _ in self.entries.values())
+
+    def __contains__(self, name: str) -> bool:
+        return fold(name) in self.entries
+
+    def __len__(self):
+        return len(self.entries)
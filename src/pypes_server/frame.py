@@ -0,0 +1,371 @@
+import asyncio
+import heapq
+import socket
+from asyncio.streams import StreamWriter
+from collections import deque
+from typing import Any, Callable, Iterable, Optional
+
+from codec import JSON
+from logs import get_logger
+from protocol import Protocol
+
+logger = get_logger("frame")
+
+MAX_FRAME_SIZE = 0xFFF
+# Keep the transport buffer small, so backlog builds up in the FrameWriter queue
+TRANSPORT_HIGH_WATER = 0x10000
+
+# Overflow policies
+DROP_OLDEST = "drop-oldest"
+DISCONNECT = "disconnect"
+
+# Frames that may be dropped by the ``drop-oldest`` policy
+CHAT_TYPES = frozenset((Protocol.MESSAGE, Protocol.TELL, Protocol.HISTORY))
+
+
+class FrameError(Exception):
+    """Raised when a peer sends a frame that is oversized or cannot be decoded"""
+
+
+class Frame:
+    """An encoded protocol message.
+
+    Serializes a message object at most once per codec, along with its length
+    header, so the same bytes can be written to any number of clients. Used by
+    the server for broadcasts, where the payload is identical for every
+    recipient.
+
+    Attributes:
+        type:    The protocol message type
+        payload: The ``payload`` fields of the message
+        encoded: Maps codec names to the length header followed by the encoded message
+    """
+
+    __slots__ = ("type", "payload", "encoded")
+
+    def __init__(self, type: str, **payload):
+        """Create a new frame. Nothing is encoded until it is first written.
+
+        Args:
+            type (str): The protocol message type
+            payload (dict): each key/value-pair will be put in the ``payload`` field of the message
+        """
+        self.type = type
+        self.payload = payload
+        self.encoded: dict[str, bytes] = {}
+
+    def encode(self, codec=JSON) -> bytes:
+        """Return the frame encoded with `codec`, encoding it on first use
+
+        Args:
+            codec: The codec to encode the message object with
+
+        Returns:
+            The 4 byte little endian length header followed by the encoded message
+
+        Raises:
+            FrameError: If the encoded message exceeds the frame size limit,
+                or the codec cannot encode the payload
+        """
+        data = self.encoded.get(codec.name)
+        if data is None:
+            try:
+                body = codec.encode(self.type, self.payload)
+            except (ValueError, TypeError) as e:
+                raise FrameError("Cannot encode {}: {}".format(self, e)) from e
+            if len(body) > MAX_FRAME_SIZE:
+                raise FrameError("{} exceeds size limit".format(self))
+            data = self.encoded[codec.name] = len(body).to_bytes(4, "little") + body
+        return data
+
+    def __repr__(self):
+        return "<Frame {}>".format(self.type)
+
+
+class FrameWriter:
+    """Bounded outbound queue and writer task for a single stream.
+
+    Frames are queued without waiting, and a dedicated task hands everything
+    queued since its last pass to the transport in a single ``writelines``
+    call, so a burst of messages costs one flush rather than one per frame.
+
+    The transport buffer is kept small, so a peer that stops reading makes
+    frames pile up in the queue, where they are subject to the overflow policy
+    once the queue grows past `high_water` bytes:
+
+    * ``drop-oldest`` drops the oldest chat frames until the queue is back
+      under `low_water`.
+    * ``disconnect`` keeps every frame.
+
+    Control frames are never dropped. With either policy, a connection that
+    stays over `high_water` for `overflow_timeout` seconds is disconnected,
+    and one whose queue grows past `max_queued` bytes is disconnected at once,
+    so a stalled reader never holds more than `max_queued` bytes.
+
+    Attributes:
+        writer:  The stream that frames are flushed to
+        codec:   The codec frames are encoded with for this stream
+        cork:    Whether to cork the socket while a batch is being flushed
+        queued:  Bytes currently waiting in the queue
+        dropped: Number of chat frames dropped by the overflow policy
+        on_frame: Called with the type and size of every queued frame, e.g. to count them
+    """
+
+    def __init__(
+        self,
+        writer: StreamWriter,
+        nodelay: bool = True,
+        cork: bool = False,
+        high_water: int = 0x40000,
+        low_water: int = 0x10000,
+        overflow: str = DROP_OLDEST,
+        overflow_timeout: float = 10.0,
+        max_queued: Optional[int] = None,
+        on_frame: Optional[Callable[[str, int], None]] = None,
+    ):
+        """Initialize a frame writer.
+
+        Args:
+            writer (StreamWriter): The stream to write to
+            nodelay (bool): Set ``TCP_NODELAY`` on the socket. Batching already
+                avoids tiny writes, so waiting for Nagle's algorithm only adds latency.
+            cork (bool): Set ``TCP_CORK`` while flushing a batch, so the kernel
+                only sends full segments. Only supported on Linux.
+            high_water (int): Queue size in bytes at which the overflow policy kicks in
+            low_water (int): Queue size in bytes at which the connection counts as caught up
+            overflow (str): The overflow policy, ``drop-oldest`` or ``disconnect``
+            overflow_timeout (float): Seconds a connection may stay over
+                `high_water` before it is disconnected
+            max_queued (int): Queue size in bytes at which the connection is
+                disconnected at once. Defaults to twice `high_water`
+            on_frame (Callable): Called with the type and size of every queued frame
+        """
+        if overflow not in (DROP_OLDEST, DISCONNECT):
+            raise ValueError("Unknown overflow policy: {}".format(overflow))
+        self.writer = writer
+        self.codec = JSON
+        self.cork = cork and hasattr(socket, "TCP_CORK")
+        self.high_water = high_water
+        self.low_water = low_water
+        self.overflow = overflow
+        self.overflow_timeout = overflow_timeout
+        self.max_queued = 2 * high_water if max_queued is None else max_queued
+        self.on_frame = on_frame
+        self.queued = 0
+        self.dropped = 0
+        self.over_since: Optional[float] = None
+        # Chat and control frames are queued separately so the oldest chat
+        # frame can always be dropped in O(1). The counter restores their order.
+        self.counter = 0
+        self.chat: deque[tuple[int, bytes]] = deque()
+        self.control: deque[tuple[int, bytes]] = deque()
+        self.wakeup = asyncio.Event()
+        self.idle = asyncio.Event()
+        self.idle.set()
+        self.task: Optional[asyncio.Task] = None
+        self.sock = writer.get_extra_info("socket")
+        if self.sock is not None and self.sock.family in (socket.AF_INET, socket.AF_INET6):
+            self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, int(nodelay))
+        else:
+            self.cork = False
+        if writer.transport is not None:
+            writer.transport.set_write_buffer_limits(high=TRANSPORT_HIGH_WATER)
+
+    def write(self, frame: Frame):
+        """Queue a frame to be flushed by the writer task
+
+        Args:
+            frame (Frame): The frame to write
+
+        Raises:
+            ConnectionError: If the stream is already closing
+            FrameError: If the encoded frame exceeds the size limit
+        """
+        self.write_many((frame,))
+
+    def write_many(self, frames: Iterable[Frame]):
+        """Queue several frames at once, to be flushed together by the writer task
+
+        Args:
+            frames (Iterable[Frame]): The frames to write, in order
+
+        Raises:
+            ConnectionError: If the stream is already closing
+            FrameError: If an encoded frame exceeds the size limit
+        """
+        if self.writer.is_closing():
+            raise ConnectionResetError("Stream is closing")
+        for frame in frames:
+            data = frame.encode(self.codec)
+            self.counter += 1
+            if frame.type in CHAT_TYPES:
+                self.chat.append((self.counter, data))
+            else:
+                self.control.append((self.counter, data))
+            self.queued += len(data)
+            if self.on_frame is not None:
+                self.on_frame(frame.type, len(data))
+        self.idle.clear()
+        self.wakeup.set()
+        if self.task is None:
+            self.task = asyncio.get_running_loop().create_task(self.run())
+        if self.queued > self.high_water:
+            self.overflowed()
+        elif self.queued <= self.low_water:
+            self.over_since = None
+
+    def overflowed(self):
+        """Apply the overflow policy to a queue that has grown past `high_water`"""
+        if self.overflow == DROP_OLDEST:
+            while self.chat and self.queued > self.low_water:
+                _, data = self.chat.popleft()
+                self.queued -= len(data)
+                self.dropped += 1
+            if self.queued <= self.high_water:
+                return
+        if self.queued > self.max_queued:
+            logger.warning(
+                "Outbound queue to %s over %d bytes. Disconnecting.",
+                self.writer.get_extra_info("peername"),
+                self.max_queued,
+            )
+            self.abort()
+            return
+        now = asyncio.get_running_loop().time()
+        if self.over_since is None:
+            self.over_since = now
+        elif now - self.over_since > self.overflow_timeout:
+            logger.warning(
+                "Outbound queue to %s over %d bytes for %.1fs. Disconnecting.",
+                self.writer.get_extra_info("peername"),
+                self.high_water,
+                now - self.over_since,
+            )
+            self.abort()
+
+    def abort(self):
+        """Discard the queue and close the connection at once"""
+        self.close()
+        self.writer.transport.abort()
+
+    def take(self) -> list[bytes]:
+        """Remove and return every queued frame in the order they were written"""
+        if not self.chat:
+            batch = [data for _, data in self.control]
+        elif not self.control:
+            batch = [data for _, data in self.chat]
+        else:
+            batch = [data for _, data in heapq.merge(self.control, self.chat)]
+        self.chat.clear()
+        self.control.clear()
+        self.queued = 0
+        return batch
+
+    async def run(self):
+        """Flush queued frames to the transport until the stream closes"""
+        try:
+            while not self.writer.is_closing():
+                await self.wakeup.wait()
+                self.wakeup.clear()
+                batch = self.take()
+                self.over_since = None
+                if self.cork:
+                    self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_CORK, 1)
+                self.writer.writelines(batch)
+                if self.cork:
+                    self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_CORK, 0)
+                await self.writer.drain()
+                if not self.queued:
+                    self.idle.set()
+        except (ConnectionError, OSError) as e:
+            logger.info("Writer stopped: %s", e)
+        finally:
+            self.idle.set()
+
+    async def drain(self):
+        """Wait until every queued frame has been handed to the transport and drained
+
+        Raises:
+            ConnectionError: If the stream closed before the queue was flushed
+        """
+        await self.idle.wait()
+        if self.writer.is_closing():
+            raise ConnectionResetError("Stream is closing")
+
+    def close(self):
+        """Stop the writer task and discard anything still queued"""
+        if self.task is not None:
+            self.task.cancel()
+        self.take()
+        self.idle.set()
+
+
+class FrameDecoder:
+    """Incrementally decodes frames from a byte stream.
+
+    Data read from the socket is fed to the decoder as it arrives, regardless of
+    where frames begin and end. `decode` then returns every complete frame in
+    the buffer and keeps any trailing partial frame until more data arrives.
+    Message objects are decoded straight from views into the buffer, without
+    copying each frame out first.
+
+    Attributes:
+        max_size: The largest accepted frame size, excluding the header
+        codec:    The codec message objects are decoded with
+        on_frame: Called with the type and size of every decoded frame, e.g. to count them
+    """
+
+    def __init__(self, max_size: int = MAX_FRAME_SIZE, on_frame: Optional[Callable[[str, int], None]] = None):
+        """Initialize a decoder with an empty buffer.
+
+        Args:
+            max_size (int): The largest accepted frame size, excluding the header
+            on_frame (Callable): Called with the type and size, including the
+                header, of every decoded frame
+        """
+        self.max_size = max_size
+        self.on_frame = on_frame
+        self.codec = JSON
+        self.buffer = bytearray()
+
+    def feed(self, data: bytes):
+        """Append data received from the stream to the buffer"""
+        self.buffer += data
+
+    def decode(self, limit: Optional[int] = None) -> list[tuple[str, Any]]:
+        """Decode every complete frame in the buffer
+
+        Args:
+            limit (int): Decode at most this many frames and leave the rest in
+                the buffer. Used while the codec may still change, e.g. during
+                the handshake.
+
+        Returns:
+            A list of (type, data) tuples, which represents the extracted `type`
+            and `payload` fields of each decoded message object.
+
+        Raises:
+            FrameError: If a frame exceeds `max_size` or does not hold a valid
+                message object. The stream cannot be recovered after this.
+        """
+        messages = []
+        offset = 0
+        available = len(self.buffer)
+        with memoryview(self.buffer) as view:
+            while available - offset >= 4 and len(messages) != limit:
+                size = int.from_bytes(view[offset : offset + 4], "little")
+                if size > self.max_size:
+                    raise FrameError("Frame of {} bytes exceeds size limit".format(size))
+                end = offset + 4 + size
+                if end > available:
+                    break
+                try:
+                    message = self.codec.decode(view[offset + 4 : end])
+                except (ValueError, TypeError, KeyError) as e:
+                    raise FrameError("Malformed frame: {}".format(e)) from e
+                messages.append(message)
+                if self.on_frame is not None:
+                    self.on_frame(message[0], size + 4)
+                offset = end
+        del self.buffer[:offset]
+        return messages
@@ -0,0 +1,59 @@
+from collections import deque
+
+from frame import Frame
+
+
+class History:
+    """Bounded history of recent broadcasts.
+
+    Keeps the most recent broadcast frames, capped both by count and by the
+    total size of their JSON encoding. The frames are the same objects that
+    were broadcast, so a replay reuses encodings that are already cached
+    instead of serializing the messages again for every joiner.
+
+    Attributes:
+        max_frames: The largest number of frames kept
+        max_bytes:  The largest total encoded size kept
+        size:       The current total encoded size
+        evicted:    The highest sequence number evicted so far, 0 if none
+    """
+
+    def __init__(self, max_frames: int = 100, max_bytes: int = 0x10000):
+        """Initialize an empty history
+
+        Args:
+            max_frames (int): The largest number of frames kept. 0 disables the history
+            max_bytes (int): The largest total encoded size kept
+        """
+        self.max_frames = max_frames
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.evicted = 0
+        self.frames: deque[tuple[Frame, int]] = deque()
+
+    def append(self, frame: Frame):
+        """Record a broadcast frame, evicting the oldest ones if over either cap"""
+        if not self.max_frames:
+            return
+        size = len(frame.encode())
+        self.frames.append((frame, size))
+        self.size += size
+        while len(self.frames) > self.max_frames or self.size > self.max_bytes:
+            evicted, size = self.frames.popleft()
+            self.size -= size
+            self.evicted = max(self.evicted, evicted.payload.get("seq", 0))
+
+    def replay(self) -> list[Frame]:
+        """Return the recorded frames, oldest first"""
+        return [frame for frame, _ in self.frames]
+
+    def since(self, seq: int) -> list[Frame]:
+        """Return the recorded frames with a higher sequence number, oldest first"""
+        return [frame for frame, _ in self.frames if frame.payload.get("seq", 0) > seq]
+
+    def covers(self, seq: int) -> bool:
+        """Return whether every frame after sequence number `seq` is still recorded"""
+        return self.max_frames > 0 and self.evicted <= seq
+
+    def __len__(self):
+        return len(self.frames)
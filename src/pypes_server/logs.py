@@ -0,0 +1,124 @@
+import atexit
+import logging
+import logging.handlers
+import queue
+import sys
+from typing import Optional
+
+from ratelimit import TokenBucket
+
+# Parent of the logger of every subsystem, e.g. ``pypes.server``
+ROOT = "pypes"
+# Logger of the per message lines, sampled by `SampleFilter`
+MESSAGES = ROOT + ".messages"
+FORMAT = "%(asctime)s - %(name)s %(funcName)s:%(lineno)d\n[%(levelname)7s] %(message)s"
+
+
+def get_logger(subsystem: str) -> logging.Logger:
+    """Return the logger of a subsystem, whose level can be set with `set_level`"""
+    return logging.getLogger(ROOT + "." + subsystem)
+
+
+class SampleFilter(logging.Filter):
+    """Let through at most `rate` records per second, with bursts of `burst`.
+
+    Records over the limit are counted rather than formatted, and the count is
+    added to the next record let through, so the log shows that lines are
+    missing without the volume ever following the message rate.
+
+    Attributes:
+        bucket:     Tokens left for records
+        suppressed: Records dropped since the last one let through
+    """
+
+    def __init__(self, rate: float, burst: int):
+        super().__init__()
+        self.bucket = TokenBucket(rate, burst)
+        self.suppressed = 0
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if not self.bucket.take():
+            self.suppressed += 1
+            return False
+        if self.suppressed:
+            record.msg = "%s (%d lines suppressed)" % (record.msg, self.suppressed)
+            self.suppressed = 0
+        return True
+
+
+def setup(
+    level: int = logging.DEBUG,
+    levels: Optional[dict[str, int]] = None,
+    message_rate: float = 10.0,
+    fmt: str = FORMAT,
+) -> logging.handlers.QueueListener:
+    """Log through a queue to stderr, written by a listener thread
+
+    The event loop only puts records on an unbounded queue, so a slow stderr
+    never blocks it. May be called again, e.g. in a forked worker, whose copy
+    of the listener thread does not run; the previous handlers are replaced.
+
+    Args:
+        level (int): Level of the root logger
+        levels (dict): Levels of single subsystems, e.g. ``{"bus": logging.INFO}``
+        message_rate (float): Per message lines logged per second. 0 logs them all
+        fmt (str): Format of the lines written
+
+    Returns:
+        (QueueListener) The started listener. It is stopped at exit
+    """
+    records: queue.SimpleQueue = queue.SimpleQueue()
+    stream = logging.StreamHandler(sys.stderr)
+    stream.setFormatter(logging.Formatter(fmt))
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+    root.addHandler(logging.handlers.QueueHandler(records))
+    root.setLevel(level)
+    for subsystem, subsystem_level in (levels or {}).items():
+        set_level(subsystem, subsystem_level)
+    messages = logging.getLogger(MESSAGES)
+    for old in messages.filters[:]:
+        messages.removeFilter(old)
+    if message_rate:
+        messages.addFilter(SampleFilter(message_rate, max(1, int(message_rate * 2))))
+    listener = logging.handlers.QueueListener(records, stream, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
+
+
+def set_level(subsystem: str, level) -> str:
+    """Set the level of a subsystem's logger, or of all of them given ``*``
+
+    Args:
+        subsystem (str): The subsystem, e.g. ``server`` or ``messages``
+        level (Union[int, str]): The level, by number or name
+
+    Returns:
+        (str) The name of the level set
+
+    Raises:
+        ValueError: If the level is unknown
+    """
+    if isinstance(level, str):
+        name = level.upper()
+        level = logging.getLevelName(name)
+        if not isinstance(level, int):
+            raise ValueError("Unknown level: {}".format(name))
+    name = ROOT if subsystem in ("*", "") else ROOT + "." + subsystem.lower()
+    logging.getLogger(name).setLevel(level)
+    return logging.getLevelName(level)
+
+
+def parse_level(text: str) -> tuple[str, int]:
+    """Parse a ``[SUBSYSTEM=]LEVEL`` level, as given on the command line
+
+    Raises:
+        ValueError: If the level is unknown
+    """
+    subsystem, _, level = text.rpartition("=")
+    number = logging.getLevelName(level.strip().upper())
+    if not isinstance(number, int):
+        raise ValueError("Unknown level: {}".format(level))
+    return subsystem.strip().lower(), number
@@ -0,0 +1,78 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from typing import Coroutine, Optional
+
+from logs import get_logger
+
+logger = get_logger("loops")
+
+AUTO = "auto"
+UVLOOP = "uvloop"
+ASYNCIO = "asyncio"
+LOOPS = (AUTO, UVLOOP, ASYNCIO)
+
+
+def new_event_loop(name: str = AUTO) -> asyncio.AbstractEventLoop:
+    """Create an event loop of the requested implementation
+
+    ``uvloop`` is used if it is installed and either requested or ``auto`` is
+    given. Otherwise falls back to the standard library loop.
+
+    Args:
+        name (str): One of ``auto``, ``uvloop`` or ``asyncio``
+
+    Returns:
+        The new event loop
+    """
+    if name not in LOOPS:
+        raise ValueError("Unknown event loop: {}".format(name))
+    if name in (AUTO, UVLOOP):
+        try:
+            import uvloop
+
+            return uvloop.new_event_loop()
+        except ImportError:
+            if name == UVLOOP:
+                logger.warning("uvloop is not installed. Falling back to asyncio.")
+    return asyncio.new_event_loop()
+
+
+def describe(loop: asyncio.AbstractEventLoop) -> str:
+    """Return a short description of an event loop implementation"""
+    cls = type(loop)
+    return "{}.{}".format(cls.__module__, cls.__qualname__)
+
+
+def run(main: Coroutine, loop: str = AUTO, executor_workers: Optional[int] = None):
+    """Run a coroutine to completion on a new event loop
+
+    Like `asyncio.run`, but lets the caller pick the loop implementation and
+    the size of the default executor used by ``run_in_executor``.
+
+    Args:
+        main (Coroutine): The coroutine to run
+        loop (str): The loop implementation, see `new_event_loop`
+        executor_workers (int): Number of threads in the default executor.
+            Uses the standard library default if not given.
+
+    Returns:
+        The result of `main`
+    """
+    event_loop = new_event_loop(loop)
+    asyncio.set_event_loop(event_loop)
+    if executor_workers:
+        event_loop.set_default_executor(ThreadPoolExecutor(executor_workers))
+    logger.info("Using event loop %s", describe(event_loop))
+    try:
+        return event_loop.run_until_complete(main)
+    finally:
+        try:
+            tasks = asyncio.all_tasks(event_loop)
+            for task in tasks:
+                task.cancel()
+            event_loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+            event_loop.run_until_complete(event_loop.shutdown_asyncgens())
+            event_loop.run_until_complete(event_loop.shutdown_default_executor())
+        finally:
+            asyncio.set_event_loop(None)
+            event_loop.close()
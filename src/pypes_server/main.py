@@ -1,15 +1,286 @@
 #!/usr/bin/env python3
-import sys, logging, asyncio
-from server import Server
+import argparse
+import asyncio
+import logging
+import multiprocessing
+import os
+import signal
+import sys
+import tempfile
+
+import logs
+import loops
+import ratelimit
+from bus import BusHub
+from frame import DISCONNECT, DROP_OLDEST
+from server import PORT, Server
+
+logger = logs.get_logger("main")
+
+
+def server_options(options: argparse.Namespace) -> dict:
+    """Pick the `Server` arguments out of the parsed command line"""
+    rate_limits = dict(ratelimit.DEFAULT_LIMITS)
+    for typ, (rate, burst) in options.rate_limit:
+        if rate:
+            rate_limits[typ] = (rate, burst)
+        else:
+            rate_limits.pop(typ, None)
+    return dict(
+        max_connections=options.max_connections,
+        port=options.port,
+        backlog=options.backlog,
+        reuse_port=options.reuse_port,
+        nodelay=not options.no_nodelay,
+        cork=options.cork,
+        overflow=options.overflow,
+        history_frames=options.history_frames,
+        history_bytes=options.history_bytes,
+        log_dir=options.log_dir,
+        log_segment_bytes=options.log_segment_bytes,
+        log_fsync_interval=options.log_fsync_interval,
+        rate_limits=rate_limits,
+        rate_policy=options.rate_policy,
+        broadcast_rate=options.broadcast_rate,
+        broadcast_burst=options.broadcast_burst,
+        handshake_timeout=options.handshake_timeout,
+        ping_interval=options.ping_interval,
+        idle_timeout=options.idle_timeout,
+        resume_timeout=options.resume_timeout,
+        metrics_port=options.metrics_port,
+        admin_token=options.admin_token or os.environ.get("PYPES_ADMIN_TOKEN"),
+        profile_dir=options.profile_dir,
+        stall_threshold=options.stall_threshold,
+    )
+
+
+def setup_logging(options: argparse.Namespace):
+    """Start logging as given on the command line"""
+    logs.setup(logging.DEBUG, dict(options.log_level), options.message_log_rate)
+
+
+def run_worker(options: argparse.Namespace, worker: int, bus_path: str):
+    """Entry point of a worker process"""
+    # The listener thread of the parent is not running in a forked child
+    setup_logging(options)
+    kwargs = server_options(options)
+    kwargs["reuse_port"] = True
+    if kwargs["log_dir"]:
+        # Every worker sees every broadcast, but keeps its own log
+        kwargs["log_dir"] = os.path.join(kwargs["log_dir"], "worker-{}".format(worker))
+    if kwargs["metrics_port"]:
+        # Every worker has its own metrics, so each gets a port of its own
+        kwargs["metrics_port"] += worker
+    server = Server(options.ip, bus_path=bus_path, worker=worker, **kwargs)
+    try:
+        loops.run(server.begin_serving(), options.loop, options.executor_workers)
+    except (KeyboardInterrupt, asyncio.CancelledError):
+        pass
+
+
+def serve_workers(options: argparse.Namespace):
+    """Run worker processes sharing the server port, connected by a bus hub"""
+    hub = BusHub(os.path.join(tempfile.gettempdir(), "pypes-{}.sock".format(os.getpid())))
+    hub.listen()
+    workers = [
+        multiprocessing.Process(target=run_worker, args=(options, i, hub.path), daemon=True)
+        for i in range(options.workers)
+    ]
+    for worker in workers:
+        worker.start()
+    logger.info("Started %d workers", options.workers)
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    try:
+        loops.run(hub.serve(), options.loop)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for worker in workers:
+            worker.terminate()
+        hub.close()
+
+
+def parse_args(args):
+    parser = argparse.ArgumentParser(description="Pypes chat server")
+    parser.add_argument("ip", help="the address to host the server on")
+    parser.add_argument("--port", type=int, default=PORT, help="the port to listen on (default: %(default)s)")
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="number of worker processes sharing the port (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--max-connections",
+        type=int,
+        default=1000,
+        help="connections accepted per process. Further ones are sent a DROP (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--loop",
+        choices=loops.LOOPS,
+        default=loops.AUTO,
+        help="event loop implementation. auto uses uvloop if installed (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--executor-workers",
+        type=int,
+        help="threads in the default executor (default: asyncio's default)",
+    )
+    parser.add_argument(
+        "--backlog",
+        type=int,
+        default=100,
+        help="connections waiting to be accepted (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--reuse-port",
+        action="store_true",
+        help="set SO_REUSEPORT on the listening socket. Always set with --workers",
+    )
+    parser.add_argument("--no-nodelay", action="store_true", help="leave Nagle's algorithm on")
+    parser.add_argument("--cork", action="store_true", help="cork sockets while flushing")
+    parser.add_argument(
+        "--overflow",
+        choices=(DROP_OLDEST, DISCONNECT),
+        default=DROP_OLDEST,
+        help="what to do with clients that do not keep up (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--history-frames",
+        type=int,
+        default=100,
+        help="recent broadcasts replayed to new users. 0 disables (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--history-bytes",
+        type=int,
+        default=0x10000,
+        help="largest total size of the replayed broadcasts (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--log-dir",
+        help="keep a persistent chat log in this directory, for the HISTORY command",
+    )
+    parser.add_argument(
+        "--log-segment-bytes",
+        type=int,
+        default=0x1000000,
+        help="size at which the chat log starts a new segment file (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--log-fsync-interval",
+        type=float,
+        default=1.0,
+        help="largest number of seconds between chat log fsyncs (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--rate-limit",
+        type=ratelimit.parse_limit,
+        action="append",
+        default=[],
+        metavar="TYPE=RATE[/BURST]",
+        help="messages of TYPE each connection may send per second. A rate of 0 "
+        "removes the limit. May be repeated (default: {})".format(
+            " ".join(
+                "{}={:g}/{}".format(typ, rate, burst)
+                for typ, (rate, burst) in ratelimit.DEFAULT_LIMITS.items()
+            )
+        ),
+    )
+    parser.add_argument(
+        "--rate-policy",
+        choices=(ratelimit.THROTTLE, ratelimit.DISCONNECT),
+        default=ratelimit.THROTTLE,
+        help="what to do with clients over their rate limits (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--broadcast-rate",
+        type=float,
+        default=500.0,
+        help="broadcasts per second across all users of a process. 0 disables (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--broadcast-burst",
+        type=int,
+        default=1000,
+        help="broadcasts allowed in a burst above --broadcast-rate (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--handshake-timeout",
+        type=float,
+        default=10.0,
+        help="seconds a connection may take to complete the handshake. 0 disables (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--ping-interval",
+        type=float,
+        default=30.0,
+        help="seconds of silence after which a client is sent a PING. 0 disables (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--idle-timeout",
+        type=float,
+        default=90.0,
+        help="seconds of silence after which a client is disconnected. 0 disables (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--resume-timeout",
+        type=float,
+        default=60.0,
+        help="seconds a disconnected user's name, color and rooms are kept for "
+        "them to resume. 0 disables (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--metrics-port",
+        type=int,
+        help="serve metrics for Prometheus on this port on localhost. Workers use "
+        "consecutive ports from it (default: disabled)",
+    )
+    parser.add_argument(
+        "--admin-token",
+        help="token unlocking admin commands such as /stats. Read from "
+        "PYPES_ADMIN_TOKEN if not given (default: disabled)",
+    )
+    parser.add_argument(
+        "--profile-dir",
+        help="where /profile writes its captures (default: the temporary directory)",
+    )
+    parser.add_argument(
+        "--stall-threshold",
+        type=float,
+        default=0.25,
+        help="seconds the event loop may be blocked before the blocking stack is logged. "
+        "0 disables the lag monitor (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--log-level",
+        type=logs.parse_level,
+        action="append",
+        default=[],
+        metavar="[SUBSYSTEM=]LEVEL",
+        help="level of a subsystem's log, e.g. messages=WARNING, or of all of them "
+        "without SUBSYSTEM. May be repeated. Also settable at runtime with /loglevel "
+        "(default: DEBUG)",
+    )
+    parser.add_argument(
+        "--message-log-rate",
+        type=float,
+        default=10.0,
+        help="chat messages logged per second. The rest are counted. 0 logs all (default: %(default)s)",
+    )
+    return parser.parse_args(args)
 
 
 def main(args):
-    ip = args[1]
-    server = Server(ip, 50)
-    asyncio.run(server.begin_serving())
+    options = parse_args(args[1:])
+    setup_logging(options)
+    if options.workers > 1:
+        serve_workers(options)
+    else:
+        server = Server(options.ip, **server_options(options))
+        loops.run(server.begin_serving(), options.loop, options.executor_workers)
 
 
 if __name__ == "__main__":
-    fmt = "%(asctime)s - %(funcName)s:%(lineno)d\n[%(levelname)7s]"
-    logging.basicConfig(level=logging.DEBUG, format=fmt)
     main(sys.argv)
@@ -0,0 +1,230 @@
+import asyncio
+import bisect
+from asyncio.streams import StreamReader, StreamWriter
+from collections import defaultdict
+from typing import Callable, Iterable
+
+from logs import get_logger
+
+logger = get_logger("metrics")
+
+# Upper bounds in seconds of the latency histogram buckets
+LATENCY_BUCKETS = (
+    0.0001,
+    0.00025,
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+)
+PREFIX = "pypes_"
+
+
+class Histogram:
+    """Histogram with fixed bucket bounds.
+
+    Recording a value is a binary search over the bounds and an increment, so
+    it costs the same no matter how many values were recorded.
+
+    Attributes:
+        bounds: The upper bound of every bucket but the last, which is unbounded
+        counts: The number of values in each bucket
+        total:  The sum of all recorded values
+        count:  The number of recorded values
+    """
+
+    __slots__ = ("bounds", "counts", "total", "count")
+
+    def __init__(self, bounds: Iterable[float] = LATENCY_BUCKETS):
+        self.bounds = tuple(bounds)
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.total += value
+        self.count += 1
+
+    def quantile(self, q: float) -> float:
+        """Return the upper bound of the bucket holding the `q` quantile. Infinite if it is the last"""
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.bounds, self.counts):
+            seen += count
+            if seen >= rank and seen:
+                return bound
+        return float("inf")
+
+
+class Metrics:
+    """Counters and histograms of a server process.
+
+    Recording is kept to dict increments and histogram observations on the
+    hot path. Gauges such as the number of users are not tracked at all;
+    `gauges` is called to read them when the metrics are rendered.
+
+    Attributes:
+        frames_in:   Frames received, by message type
+        bytes_in:    Bytes received including length headers, by message type
+        frames_out:  Frames queued for sending, by message type
+        bytes_out:   Bytes queued for sending including length headers, by message type
+        events:      Counts of other events, such as rejected connections, by name
+        handshake:   Seconds from accepting a connection to welcoming the user
+        broadcast:   Seconds taken to queue a broadcast for every recipient
+        loop_lag:    Seconds event loop callbacks ran late
+        gauges:      Returns the current value of every gauge, by name
+    """
+
+    def __init__(self):
+        self.frames_in: defaultdict[str, int] = defaultdict(int)
+        self.bytes_in: defaultdict[str, int] = defaultdict(int)
+        self.frames_out: defaultdict[str, int] = defaultdict(int)
+        self.bytes_out: defaultdict[str, int] = defaultdict(int)
+        self.events: defaultdict[str, int] = defaultdict(int)
+        self.handshake = Histogram()
+        self.broadcast = Histogram()
+        self.loop_lag = Histogram()
+        self.gauges: Callable[[], dict[str, float]] = dict
+        self.commands: Iterable = ()
+
+    def frame_in(self, typ: str, size: int):
+        self.frames_in[typ] += 1
+        self.bytes_in[typ] += size
+
+    def frame_out(self, typ: str, size: int):
+        self.frames_out[typ] += 1
+        self.bytes_out[typ] += size
+
+    def render(self) -> str:
+        """Render every metric in the Prometheus text exposition format"""
+        lines = []
+
+        def family(name, kind, help_text):
+            lines.append("# HELP {}{} {}".format(PREFIX, name, help_text))
+            lines.append("# TYPE {}{} {}".format(PREFIX, name, kind))
+
+        for name, counts, help_text in (
+            ("frames_received_total", self.frames_in, "Frames received by message type"),
+            ("bytes_received_total", self.bytes_in, "Bytes received by message type"),
+            ("frames_sent_total", self.frames_out, "Frames queued for sending by message type"),
+            ("bytes_sent_total", self.bytes_out, "Bytes queued for sending by message type"),
+        ):
+            family(name, "counter", help_text)
+            for typ, value in sorted(counts.items()):
+                lines.append('{}{}{{type="{}"}} {}'.format(PREFIX, name, typ, value))
+        for event, value in sorted(self.events.items()):
+            family(event + "_total", "counter", "Number of " + event.replace("_", " "))
+            lines.append("{}{}_total {}".format(PREFIX, event, value))
+        for name, value in sorted(self.gauges().items()):
+            family(name, "gauge", name.replace("_", " ").capitalize())
+            lines.append("{}{} {}".format(PREFIX, name, value))
+        for name, histogram, help_text in (
+            ("handshake_seconds", self.handshake, "Time from accepting a connection to the welcome"),
+            ("broadcast_seconds", self.broadcast, "Time to queue a broadcast for every recipient"),
+            ("loop_lag_seconds", self.loop_lag, "Time event loop callbacks ran late"),
+        ):
+            family(name, "histogram", help_text)
+            seen = 0
+            for bound, count in zip(histogram.bounds + (float("inf"),), histogram.counts):
+                seen += count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                lines.append('{}{}_bucket{{le="{}"}} {}'.format(PREFIX, name, le, seen))
+            lines.append("{}{}_sum {}".format(PREFIX, name, histogram.total))
+            lines.append("{}{}_count {}".format(PREFIX, name, histogram.count))
+        family("command_calls_total", "counter", "Commands run by command")
+        family("command_seconds_total", "counter", "Time spent in commands by command")
+        for command in self.commands:
+            labels = '{{command="{}"}}'.format(command.name)
+            lines.append("{}command_calls_total{} {}".format(PREFIX, labels, command.calls))
+            lines.append("{}command_seconds_total{} {}".format(PREFIX, labels, command.seconds))
+        return "\n".join(lines) + "\n"
+
+    def summary(self) -> list[str]:
+        """Return a short human readable summary, one line per metric"""
+        lines = ["{}: {}".format(name, value) for name, value in sorted(self.gauges().items())]
+        lines += ["{}: {}".format(event, value) for event, value in sorted(self.events.items())]
+        for typ in sorted(set(self.frames_in) | set(self.frames_out)):
+            lines.append(
+                "{}: {} ind ({} B), {} ud ({} B)".format(
+                    typ,
+                    self.frames_in.get(typ, 0),
+                    self.bytes_in.get(typ, 0),
+                    self.frames_out.get(typ, 0),
+                    self.bytes_out.get(typ, 0),
+                )
+            )
+        for name, histogram in (
+            ("handshake", self.handshake),
+            ("broadcast", self.broadcast),
+            ("loop_lag", self.loop_lag),
+        ):
+            if histogram.count:
+                lines.append(
+                    "{}: n={} gns={:.2f}ms p50<={:g}ms p99<={:g}ms".format(
+                        name,
+                        histogram.count,
+                        histogram.total / histogram.count * 1000,
+                        histogram.quantile(0.5) * 1000,
+                        histogram.quantile(0.99) * 1000,
+                    )
+                )
+        for command in self.commands:
+            if command.calls:
+                lines.append(
+                    "/{}: {} kald, {:.1f}ms i alt, langsomste {:.1f}ms".format(
+                        command.name, command.calls, command.seconds * 1000, command.slowest * 1000
+                    )
+                )
+        return lines
+
+    async def serve(self, host: str, port: int) -> asyncio.AbstractServer:
+        """Start serving `render` over HTTP, for Prometheus to scrape
+
+        Every request gets the metrics, whatever its path. Meant to be bound
+        to a local address only.
+        """
+        return await asyncio.start_server(self.http_handler, host, port)
+
+    async def http_handler(self, reader: StreamReader, writer: StreamWriter):
+        try:
+            await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), 5)
+            body = self.render().encode()
+            writer.write(
+                b"HTTP/1.1 200 OK\r\n"
+                b"Content-Type: text/plain; version=0.0.4\r\n"
+                b"Content-Length: " + str(len(body)).encode() + b"\r\n"
+                b"Connection: close\r\n\r\n" + body
+            )
+            await writer.drain()
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError) as e:
+            logger.debug("Metrics request failed: %s", e)
+        finally:
+            writer.close()
+
+
+def split_lines(lines: list[str], limit: int) -> list[str]:
+    """Join lines into as few messages as possible, each at most `limit` bytes when encoded"""
+    messages: list[str] = []
+    current: list[str] = []
+    size = 0
+    for line in lines:
+        length = len(line.encode()) + 1
+        if current and size + length > limit:
+            messages.append("\n".join(current))
+            current, size = [], 0
+        current.append(line)
+        size += length
+    if current:
+        messages.append("\n".join(current))
+    return messages
@@ -0,0 +1,191 @@
+import asyncio
+import cProfile
+import io
+import os
+import pstats
+import sys
+import tempfile
+import threading
+import time
+import traceback
+from typing import Optional
+
+from logs import get_logger
+from metrics import Histogram
+
+logger = get_logger("profiling")
+
+# Longest capture the PROFILE command starts
+MAX_PROFILE_SECONDS = 300
+# Functions listed in the text report written next to a capture
+REPORT_LINES = 40
+
+
+class LoopMonitor:
+    """Measures how late the event loop runs callbacks, and finds what holds it up.
+
+    A callback is scheduled every `interval` seconds, and how late it runs is
+    recorded in `lag`. A lagging loop is busy with something else, so a
+    watchdog thread also checks that the callback keeps running. When it has
+    not run for `threshold` seconds, the watchdog logs the stack of the loop
+    thread, which shows the coroutine and the call that blocks it. Each stall
+    is logged once.
+
+    Attributes:
+        lag:       Seconds callbacks ran late
+        interval:  Seconds between callbacks
+        threshold: Seconds without a callback after which the loop is stalled
+        beat:      Monotonic time the callback last ran
+    """
+
+    def __init__(self, lag: Histogram, interval: float = 0.1, threshold: float = 0.25):
+        self.lag = lag
+        self.interval = interval
+        self.threshold = threshold
+        self.beat = time.monotonic()
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self.loop_thread: Optional[int] = None
+        self.handle: Optional[asyncio.TimerHandle] = None
+        self.stopped = threading.Event()
+        self.watchdog: Optional[threading.Thread] = None
+
+    def start(self):
+        """Start monitoring the running event loop"""
+        self.loop = asyncio.get_running_loop()
+        self.loop_thread = threading.get_ident()
+        self.beat = time.monotonic()
+        self.handle = self.loop.call_later(self.interval, self.tick, self.beat + self.interval)
+        self.stopped.clear()
+        self.watchdog = threading.Thread(target=self.watch, name="loop-watchdog", daemon=True)
+        self.watchdog.start()
+
+    def stop(self):
+        if self.handle is not None:
+            self.handle.cancel()
+            self.handle = None
+        self.stopped.set()
+        if self.watchdog is not None:
+            self.watchdog.join()
+            self.watchdog = None
+
+    def tick(self, expected: float):
+        now = time.monotonic()
+        self.lag.observe(max(0.0, now - expected))
+        self.beat = now
+        self.handle = self.loop.call_later(self.interval, self.tick, now + self.interval)
+
+    def watch(self):
+        """Body of the watchdog thread"""
+        reported = None
+        while not self.stopped.wait(self.threshold / 2):
+            beat = self.beat
+            stalled = time.monotonic() - beat
+            if stalled < self.threshold or beat == reported:
+                continue
+            reported = beat
+            frame = sys._current_frames().get(self.loop_thread)
+            task = asyncio.current_task(self.loop) if self.loop else None
+            where = "task {}".format(task.get_name()) if task else "a callback"
+            stack = "".join(traceback.format_stack(frame)) if frame else "(no stack)\n"
+            logger.warning("Event loop stalled for %.3fs in %s\n%s", stalled, where, stack.rstrip())
+
+
+class Profiler:
+    """cProfile captures of the event loop thread, started at runtime.
+
+    A capture profiles everything run on the loop for a number of seconds,
+    then writes a ``.pstats`` file, for ``python -m pstats`` or snakeviz, and
+    a text report of the most expensive functions next to it.
+
+    Attributes:
+        directory: Where captures are written
+        profile:   The capture in progress, if any
+        task:      The task running the last capture started with `start`
+    """
+
+    def __init__(self, directory: Optional[str] = None):
+        self.directory = directory or tempfile.gettempdir()
+        self.profile: Optional[cProfile.Profile] = None
+        self.handle: Optional[asyncio.TimerHandle] = None
+        self.waiter: Optional[asyncio.Future] = None
+        self.task: Optional[asyncio.Task] = None
+
+    @property
+    def running(self) -> bool:
+        return self.profile is not None
+
+    def start(self, seconds: float) -> asyncio.Task:
+        """Begin a capture, and write it from a task of its own, so the caller need not wait for it
+
+        The capture is running once this returns, so a second call fails even
+        before the task gets to run.
+
+        Raises:
+            RuntimeError: If a capture is already running
+        """
+        self.begin(seconds)
+        self.task = asyncio.get_running_loop().create_task(self.collect())
+        return self.task
+
+    async def capture(self, seconds: float) -> str:
+        """Profile the event loop for some seconds, or until `stop` is called
+
+        Must be called on the event loop, as cProfile only sees the thread it
+        is enabled on.
+
+        Returns:
+            (str) The path of the written ``.pstats`` file
+
+        Raises:
+            RuntimeError: If a capture is already running
+        """
+        self.begin(seconds)
+        return await self.collect()
+
+    def begin(self, seconds: float):
+        """Enable a new capture, ended by `stop` or after `seconds`
+
+        Raises:
+            RuntimeError: If a capture is already running
+        """
+        if self.profile is not None:
+            raise RuntimeError("A capture is already running")
+        loop = asyncio.get_running_loop()
+        self.profile = cProfile.Profile()
+        self.waiter = loop.create_future()
+        self.handle = loop.call_later(seconds, self.stop)
+        logger.info("Profiling the event loop for %gs", seconds)
+        self.profile.enable()
+
+    async def collect(self) -> str:
+        """Wait for the capture enabled by `begin` to end, and write it
+
+        Returns:
+            (str) The path of the written ``.pstats`` file
+        """
+        profile = self.profile
+        try:
+            await self.waiter
+        finally:
+            profile.disable()
+            self.handle.cancel()
+            self.profile = self.handle = self.waiter = None
+        path = os.path.join(
+            self.directory, "pypes-{}-{}.pstats".format(os.getpid(), time.strftime("%Y%m%d-%H%M%S"))
+        )
+        await asyncio.get_running_loop().run_in_executor(None, self.write, profile, path)
+        logger.info("Wrote profile to %s", path)
+        return path
+
+    def stop(self):
+        """End the running capture early. Does nothing if none is running"""
+        if self.waiter is not None and not self.waiter.done():
+            self.waiter.set_result(None)
+
+    @staticmethod
+    def write(profile: cProfile.Profile, path: str):
+        profile.dump_stats(path)
+        report = io.StringIO()
+        pstats.Stats(profile, stream=report).sort_stats(pstats.SortKey.CUMULATIVE).print_stats(REPORT_LINES)
+        with open(os.path.splitext(path)[0] + ".txt", "w") as f:
+            f.write(report.getvalue())
@@ -15,4 +15,7 @@ class Protocol:
     SERVER_BANNER  = "SERVER_BANNER"
     CLIENT_NAME    = "CLIENT_NAME"
     CLIENT_CMD     = "CLIENT_CMD"
-    TELL           = "TELL"
\ No newline at end of file
+    TELL           = "TELL"
+    HISTORY        = "HISTORY"
+    PING           = "PING"
+    PONG           = "PONG"
\ No newline at end of file
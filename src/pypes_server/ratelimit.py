@@ -0,0 +1,104 @@
+import time
+from typing import Optional
+
+from protocol import Protocol
+
+# What to do with a client that goes over its limits
+THROTTLE = "throttle"
+DISCONNECT = "disconnect"
+
+# Messages per second and burst size allowed per connection, by message type
+DEFAULT_LIMITS = {
+    Protocol.MESSAGE: (10.0, 20),
+    Protocol.TELL: (10.0, 20),
+    Protocol.COMMAND: (5.0, 10),
+    Protocol.PING: (1.0, 5),
+}
+
+
+class TokenBucket:
+    """Token bucket refilled lazily from the clock.
+
+    Holds up to `burst` tokens and gains `rate` tokens per second. Instead of
+    a timer adding tokens, the bucket works out how many it gained since it
+    was last used whenever a token is taken, so a check is O(1) and an idle
+    bucket costs nothing.
+
+    Attributes:
+        rate:   Tokens gained per second
+        burst:  The largest number of tokens held
+        tokens: Tokens left as of `stamp`
+        stamp:  The monotonic time `tokens` was last brought up to date
+    """
+
+    __slots__ = ("rate", "burst", "tokens", "stamp")
+
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.stamp = time.monotonic()
+
+    def take(self, now: Optional[float] = None) -> bool:
+        """Take a token if one is left
+
+        Args:
+            now (float): The current monotonic time, if the caller already has it
+
+        Returns:
+            (bool) Whether a token was taken
+        """
+        if now is None:
+            now = time.monotonic()
+        tokens = self.tokens + (now - self.stamp) * self.rate
+        self.stamp = now
+        if tokens > self.burst:
+            tokens = self.burst
+        if tokens < 1:
+            self.tokens = tokens
+            return False
+        self.tokens = tokens - 1
+        return True
+
+
+class RateLimiter:
+    """Inbound rate limits for a single connection, one bucket per message type.
+
+    Attributes:
+        buckets:   Maps message types to their bucket. Types without one are not limited
+        throttled: Whether the last frame was refused. Used to notify the
+                   client once per burst rather than once per refused frame
+    """
+
+    __slots__ = ("buckets", "throttled")
+
+    def __init__(self, limits: dict[str, tuple[float, int]]):
+        """Initialize a limiter
+
+        Args:
+            limits (dict): Maps message types to (rate per second, burst)
+        """
+        self.buckets = {typ: TokenBucket(rate, burst) for typ, (rate, burst) in limits.items()}
+        self.throttled = False
+
+    def allow(self, typ: str) -> bool:
+        """Return whether a frame of the given type is within the limits, and account for it"""
+        bucket = self.buckets.get(typ)
+        if bucket is None or bucket.take():
+            self.throttled = False
+            return True
+        return False
+
+
+def parse_limit(text: str) -> tuple[str, tuple[float, int]]:
+    """Parse a ``TYPE=RATE/BURST`` limit, as given on the command line
+
+    The burst defaults to twice the rate.
+
+    Raises:
+        ValueError: If the text is malformed
+    """
+    typ, _, limit = text.partition("=")
+    rate, _, burst = limit.partition("/")
+    rate = float(rate)
+    return typ.strip().upper(), (rate, int(burst) if burst else max(1, int(rate * 2)))
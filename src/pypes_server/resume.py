@@ -0,0 +1,56 @@
+import secrets
+
+# Random bytes in a resume token
+TOKEN_BYTES = 18
+# Largest number of missed broadcasts sent to a resumed session
+CATCH_UP_LIMIT = 1000
+# Largest number of chat log records read, across all rooms, to find them
+CATCH_UP_SCAN = 10000
+
+
+def new_token() -> str:
+    """Return a new unguessable resume token"""
+    return secrets.token_urlsafe(TOKEN_BYTES)
+
+
+class ParkedSession:
+    """The identity of a disconnected user, held so they can resume it.
+
+    When a user with a resume token disconnects, their name, color and rooms
+    are moved here, and the parked session takes their place in the user
+    directory, so nobody else can take the name in the meantime. A client
+    presenting the token within the grace period gets it all back, see
+    `Server.resume_session`.
+
+    The parked session sits on the server's `TimerWheel` until it expires,
+    when the name is released.
+
+    Attributes:
+        token:   The resume token
+        name:    The name of the user
+        color:   The color of the user
+        rooms:   The rooms the user was in
+        room:    The room messages without a `room` field went to
+        expires: Monotonic time the session is forgotten
+    """
+
+    __slots__ = ("server", "token", "name", "color", "rooms", "room", "expires")
+
+    def __init__(self, server, token: str, name: str, color: str, rooms: set, room: str, expires: float):
+        self.server = server
+        self.token = token
+        self.name = name
+        self.color = color
+        self.rooms = rooms
+        self.room = room
+        self.expires = expires
+
+    def check_deadlines(self, now: float):
+        """Expire the session once its grace period is over. Called by the server's `TimerWheel`"""
+        if now < self.expires:
+            return self.expires
+        self.server.expire_session(self)
+        return None
+
+    def __repr__(self):
+        return "<ParkedSession {}>".format(self.name)
@@ -0,0 +1,116 @@
+from typing import Optional
+
+from history import History
+
+DEFAULT_ROOM = "lobby"
+MAX_ROOM_NAME = 32
+
+
+class Room:
+    """A chat room and the users in it.
+
+    Attributes:
+        name:    The name of the room
+        members: The clients in the room that are connected to this process
+        history: Recent broadcasts to the room, replayed to users when they join
+    """
+
+    __slots__ = ("name", "members", "history")
+
+    def __init__(self, name: str, history: History):
+        self.name = name
+        self.members: set = set()
+        self.history = history
+
+    def __repr__(self):
+        return "<Room {} ({} members)>".format(self.name, len(self.members))
+
+
+class Rooms:
+    """Registry mapping room names to their members.
+
+    Rooms are created by the first join and removed when the last member
+    leaves, so joining and leaving are a set insertion or removal, and a
+    broadcast only touches the members of its room. Every user also keeps the
+    set of rooms they are in, so dropping a user costs the number of rooms
+    they joined rather than the number of rooms on the server.
+
+    Attributes:
+        rooms:          Maps room names to rooms with at least one member
+        history_frames: Number of recent broadcasts kept per room
+        history_bytes:  Largest total size of the broadcasts kept per room
+    """
+
+    def __init__(self, history_frames: int = 100, history_bytes: int = 0x10000):
+        """Initialize an empty registry
+
+        Args:
+            history_frames (int): Number of recent broadcasts kept per room. 0 disables the history
+            history_bytes (int): Largest total size of the broadcasts kept per room
+        """
+        self.rooms: dict[str, Room] = {}
+        self.history_frames = history_frames
+        self.history_bytes = history_bytes
+
+    @staticmethod
+    def normalize(name: str) -> Optional[str]:
+        """Return the canonical form of a room name, or None if it is invalid
+
+        Room names are case insensitive and may be given with a leading ``#``.
+        """
+        name = name.lstrip("#").casefold()
+        if not name or len(name) > MAX_ROOM_NAME or not name.isprintable() or " " in name:
+            return None
+        return name
+
+    def get(self, name: str) -> Optional[Room]:
+        """Return the room with the given canonical name, if it has any members"""
+        return self.rooms.get(name)
+
+    def join(self, user, name: str) -> Room:
+        """Add a user to a room, creating the room if needed
+
+        Args:
+            user (UserClient): The client joining
+            name (str): The canonical room name
+
+        Returns:
+            (Room) The joined room
+        """
+        room = self.rooms.get(name)
+        if room is None:
+            room = self.rooms[name] = Room(name, History(self.history_frames, self.history_bytes))
+        room.members.add(user)
+        user.rooms.add(name)
+        return room
+
+    def part(self, user, name: str) -> bool:
+        """Remove a user from a room, removing the room if it is now empty
+
+        Args:
+            user (UserClient): The client leaving
+            name (str): The canonical room name
+
+        Returns:
+            (bool) Whether the user was in the room
+        """
+        room = self.rooms.get(name)
+        if room is None or user not in room.members:
+            return False
+        room.members.discard(user)
+        user.rooms.discard(name)
+        if not room.members:
+            del self.rooms[name]
+        return True
+
+    def part_all(self, user):
+        """Remove a user from every room they are in"""
+        for name in list(user.rooms):
+            self.part(user, name)
+
+    def listing(self) -> list[tuple[str, int]]:
+        """Return the name and member count of every room, sorted by name"""
+        return sorted((name, len(room.members)) for name, room in self.rooms.items())
+
+    def __len__(self):
+        return len(self.rooms)
@@ -1,8 +1,24 @@
-import logging
+import asyncio
+import time
 from asyncio.streams import StreamReader, StreamWriter, start_server
+from typing import Iterable, Optional, Union
 
 import protocol
 import serverclient
+from bus import Bus, BusClient
+from chatlog import ChatLog
+from codec import CODECS
+from directory import UserDirectory
+from frame import DROP_OLDEST, Frame, FrameError
+from logs import get_logger
+from metrics import Metrics
+from profiling import LoopMonitor, Profiler
+from ratelimit import DEFAULT_LIMITS, THROTTLE, TokenBucket
+from resume import CATCH_UP_LIMIT, CATCH_UP_SCAN, ParkedSession, new_token
+from rooms import DEFAULT_ROOM, Room, Rooms
+from timers import TimerWheel
+
+logger = get_logger("server")
 
 PORT = 42069
 
@@ -68,64 +84,607 @@ class Server:
     or things that alter the state of the server.
 
     Attributes:
-        users(dict): A dictionary mapping names to client handlers
+        users(UserDirectory): Maps names to the client handlers connected to
+            this process, and to the parked sessions waiting to be resumed
+        rooms(Rooms): The rooms with members connected to this process
+        connections(int): Number of open client connections, including ones still in the handshake
+        timers(TimerWheel): Handshake, heartbeat and idle deadlines of every connection
+        metrics(Metrics): Counters and histograms of this process
+        monitor(LoopMonitor): Measures event loop lag and logs what stalls the loop
+        profiler(Profiler): Runs the captures started by PROFILE
+        chatlog(ChatLog): Every broadcast, kept on disk for the HISTORY command
+        seq(int): The sequence number the next broadcast is given
+        sessions(dict): Maps resume tokens to the connected client or parked
+            session they belong to
+        bus(BusClient): Connection to the other workers, when running as one of several
     """
 
-    def __init__(self, ip: str, max_connections: int = 50):
+    def __init__(
+        self,
+        ip: str,
+        max_connections: int = 50,
+        port: int = PORT,
+        nodelay: bool = True,
+        cork: bool = False,
+        high_water: int = 0x40000,
+        low_water: int = 0x10000,
+        overflow: str = DROP_OLDEST,
+        overflow_timeout: float = 10.0,
+        history_frames: int = 100,
+        history_bytes: int = 0x10000,
+        log_dir: Optional[str] = None,
+        log_segment_bytes: int = 0x1000000,
+        log_fsync_interval: float = 1.0,
+        rate_limits: Optional[dict[str, tuple[float, int]]] = None,
+        rate_policy: str = THROTTLE,
+        broadcast_rate: float = 500.0,
+        broadcast_burst: int = 1000,
+        handshake_timeout: float = 10.0,
+        ping_interval: float = 30.0,
+        idle_timeout: float = 90.0,
+        resume_timeout: float = 60.0,
+        metrics_port: Optional[int] = None,
+        admin_token: Optional[str] = None,
+        profile_dir: Optional[str] = None,
+        stall_threshold: float = 0.25,
+        backlog: int = 100,
+        reuse_port: bool = False,
+        bus_path: Optional[str] = None,
+        worker: int = 0,
+    ):
         """Initialize the server
 
         Args:
             ip (str): The address to host the server on
-            max_connections (int): Max number of users that can connect
+            max_connections (int): Max number of connections, including ones
+                still in the handshake. Further connections are sent a DROP and closed
+            port (int): The port to listen on
+            nodelay (bool): Set ``TCP_NODELAY`` on client sockets
+            cork (bool): Cork client sockets while flushing a batch of frames
+            high_water (int): Outbound queue size in bytes at which a client
+                counts as a slow consumer
+            low_water (int): Outbound queue size in bytes at which a slow
+                consumer counts as caught up
+            overflow (str): What to do with slow consumers. ``drop-oldest``
+                drops their oldest chat messages, ``disconnect`` keeps everything
+            overflow_timeout (float): Seconds a client may stay over
+                `high_water` before it is disconnected
+            history_frames (int): Number of recent broadcasts to a room replayed
+                to users joining it. 0 disables the history
+            history_bytes (int): Largest total size of the replayed broadcasts per room
+            log_dir (str): Directory to keep the persistent chat log in.
+                The log is disabled if not given
+            log_segment_bytes (int): Size at which the chat log starts a new segment file
+            log_fsync_interval (float): Largest number of seconds between chat log fsyncs
+            rate_limits (dict): Maps message types to the (rate per second,
+                burst) each connection may send them at. Defaults to `DEFAULT_LIMITS`
+            rate_policy (str): What to do with clients over their limits.
+                ``throttle`` drops their frames and tells them so,
+                ``disconnect`` drops the connection
+            broadcast_rate (float): Broadcasts per second allowed across all
+                users of this process. 0 disables the limit
+            broadcast_burst (int): Broadcasts allowed in a burst above `broadcast_rate`
+            handshake_timeout (float): Seconds a connection may take to complete
+                the handshake. 0 disables the deadline
+            ping_interval (float): Seconds of silence from a client after which
+                it is sent a PING. 0 disables the heartbeat
+            idle_timeout (float): Seconds of silence from a client after which
+                it is disconnected. 0 disables the deadline
+            resume_timeout (float): Seconds the name, color and rooms of a
+                disconnected user are kept for them to resume with their
+                token. 0 disables resuming
+            metrics_port (int): Serve metrics for Prometheus on this port on
+                localhost. Disabled if not given
+            admin_token (str): Token users give to the ADMIN command to get
+                access to admin commands such as STATS. Disabled if not given
+            profile_dir (str): Where PROFILE writes its captures. Defaults to
+                the temporary directory
+            stall_threshold (float): Seconds the event loop may be blocked
+                before the blocking stack is logged. 0 disables the monitor
+            backlog (int): Length of the queue of connections waiting to be accepted
+            reuse_port (bool): Set ``SO_REUSEPORT`` so several workers can
+                listen on the same port
+            bus_path (str): Path of the `BusHub` socket to connect to, when
+                running as one of several workers
+            worker (int): The id of this worker
         """
-        self.users: dict[str, serverclient.UserClient] = {}
-        self.host = (ip, PORT)
+        self.users = UserDirectory()
+        self.host = (ip, port)
+        self.max_connections = max_connections
+        self.connections = 0
+        self.timeouts = dict(
+            handshake=handshake_timeout,
+            ping=ping_interval,
+            idle=idle_timeout,
+            resume=resume_timeout,
+        )
+        self.timers = TimerWheel()
+        self.metrics = Metrics()
+        self.metrics.gauges = self.gauges
+        self.metrics.commands = serverclient.commands.commands.values()
+        self.metrics_port = metrics_port
+        self.admin_token = admin_token
+        self.profiler = Profiler(profile_dir)
+        self.monitor = LoopMonitor(self.metrics.loop_lag, threshold=stall_threshold) if stall_threshold else None
+        self.rooms = Rooms(history_frames, history_bytes)
+        self.log_options = dict(
+            directory=log_dir,
+            segment_bytes=log_segment_bytes,
+            fsync_interval=log_fsync_interval,
+        )
+        self.chatlog: Optional[ChatLog] = None
+        self.seq = 1
+        self.sessions: dict[str, Union[serverclient.UserClient, ParkedSession]] = {}
+        self.rate_limits = DEFAULT_LIMITS if rate_limits is None else rate_limits
+        self.rate_policy = rate_policy
+        self.broadcast_bucket = TokenBucket(broadcast_rate, broadcast_burst) if broadcast_rate else None
+        self.backlog = backlog
+        self.reuse_port = reuse_port
+        self.bus_path = bus_path
+        self.worker = worker
+        self.bus: Optional[BusClient] = None
+        self.writer_options = dict(
+            nodelay=nodelay,
+            cork=cork,
+            high_water=high_water,
+            low_water=low_water,
+            overflow=overflow,
+            overflow_timeout=overflow_timeout,
+            on_frame=self.metrics.frame_out,
+        )
 
     async def begin_serving(self):
         """Begin listening for incomming connections"""
-        logging.info("Starting server")
-        self.server = await start_server(self.client_handler, *self.host)
-        async with self.server:
-            await self.server.serve_forever()
+        logger.info("Starting server")
+        if self.log_options["directory"]:
+            self.chatlog = ChatLog(**self.log_options)
+            # Carry on from the log, so sequence numbers are never reused
+            self.seq = self.chatlog.next_seq
+        if self.bus_path:
+            self.bus = BusClient(self.bus_path, self.worker, self)
+            await self.bus.connect()
+        self.server = await start_server(
+            self.client_handler,
+            *self.host,
+            backlog=self.backlog,
+            reuse_port=self.reuse_port,
+        )
+        metrics_server = None
+        if self.metrics_port:
+            metrics_server = await self.metrics.serve("127.0.0.1", self.metrics_port)
+        self.timers.start()
+        if self.monitor:
+            self.monitor.start()
+        try:
+            async with self.server:
+                await self.server.serve_forever()
+        finally:
+            self.timers.stop()
+            if self.monitor:
+                self.monitor.stop()
+            self.profiler.stop()
+            if metrics_server:
+                metrics_server.close()
+            serverclient.commands.close()
+            if self.chatlog:
+                self.chatlog.close()
+
+    def gauges(self) -> dict[str, float]:
+        """Return the current value of every gauge, for `Metrics`"""
+        connected = self.connected_users()
+        queued = [user.out.queued for user in connected]
+        return dict(
+            users=len(connected),
+            parked_sessions=len(self.users) - len(connected),
+            connections=self.connections,
+            rooms=len(self.rooms),
+            timers=len(self.timers),
+            queued_bytes=sum(queued),
+            max_queued_bytes=max(queued, default=0),
+            dropped_frames=sum(user.out.dropped for user in connected),
+            chatlog_seq=self.chatlog.next_seq if self.chatlog else 0,
+            chatlog_dropped=self.chatlog.dropped if self.chatlog else 0,
+        )
+
+    def connected_users(self) -> list[serverclient.UserClient]:
+        """Return the users connected to this process, leaving out parked sessions"""
+        return [user for _, user in self.users.items() if not isinstance(user, ParkedSession)]
+
+    def next_seq(self) -> int:
+        """Return the sequence number for a new broadcast"""
+        seq = self.seq
+        self.seq += 1
+        return seq
+
+    def stop(self):
+        """Stop accepting connections, which ends `begin_serving`"""
+        self.server.close()
+
+    async def accept_user(self, user: serverclient.UserClient, requested: str) -> str:
+        """Assign a free name to a new user and add them to the user list
+
+        If the requested name is taken, a numeric suffix is added, see
+        `UserDirectory.allocate`. When running as a worker, the bus hub
+        allocates the name, so it is unique across all workers.
+
+        Args:
+            user (UserClient): The client to add
+            requested (str): The name the client asked for
+
+        Returns:
+            (str) The name assigned to the client
+        """
+        if self.bus:
+            name = (await self.bus.request(Bus.CLAIM, name=requested))["name"]
+            self.users.add(name, user)
+            return name
+        return self.users.allocate(requested, user)
+
+    async def rename_user(self, user: serverclient.UserClient, newname: str) -> bool:
+        """Change the name of a user, if the new name is available
+
+        Names are case insensitive, so a user may change the case of their own
+        name. The directory is updated in one step once the name is known to
+        be free, so no other user can see or claim the name in between.
+
+        Args:
+            user (UserClient): The client to rename
+            newname (str): The requested name
+
+        Returns:
+            (bool) Whether the user was renamed
+        """
+        if self.bus:
+            reply = await self.bus.request(Bus.RENAME, old=user.name, new=newname)
+            if not reply["ok"]:
+                return False
+            self.users.release(user.name, user)
+            self.users.add(newname, user)
+        elif not self.users.rename(user.name, newname, user):
+            return False
+        user.name = newname
+        return True
 
-    async def broadcast_message(self, message: str, sender: serverclient.UserClient):
-        """Broadcast a message to all users
+    def join_room(self, user: serverclient.UserClient, name: str) -> Room:
+        """Add a user to a room, and replay the room's recent broadcasts to them
+
+        Args:
+            user (UserClient): The client joining
+            name (str): The canonical room name, see `Rooms.normalize`
+
+        Returns:
+            (Room) The joined room
+        """
+        room = self.rooms.join(user, name)
+        user.out.write_many(room.history.replay())
+        return room
+
+    def part_room(self, user: serverclient.UserClient, name: str) -> bool:
+        """Remove a user from a room
+
+        Returns:
+            (bool) Whether the user was in the room
+        """
+        return self.rooms.part(user, name)
+
+    async def broadcast_message(self, message: str, sender: serverclient.UserClient, room: str) -> bool:
+        """Broadcast a message to the members of a room
+
+        The message is encoded once and the same frame is put in every
+        member's outbound queue without waiting for any of them to drain,
+        so a slow reader only ever delays itself. When running as a worker,
+        the message is also relayed to the other workers through the bus.
 
         Args:
             message (str): The message to broadcast
             sender (UserClient): The client that sent the message
+            room (str): The canonical name of the room
+
+        Returns:
+            (bool) False if the message was refused by the broadcast rate limit
+
+        Raises:
+            FrameError: If the message is too long to broadcast once the
+                sender, color, room and sequence number are added, or cannot
+                be encoded with one of the codecs
         """
-        payload = {"message": message, "sender": sender.name, "color": sender.color}
-        for user in self.users.values():
+        # The sequence number is only taken once the frame is known to encode
+        # with every codec a member may have negotiated, so no number is skipped
+        frame = Frame(
+            protocol.Protocol.MESSAGE,
+            message=message,
+            sender=sender.name,
+            color=sender.color,
+            room=room,
+            seq=self.seq,
+        )
+        for codec in CODECS.values():
+            frame.encode(codec)
+        if self.broadcast_bucket and not self.broadcast_bucket.take():
+            return False
+        self.next_seq()
+        self.deliver_frame(frame)
+        if self.bus:
+            self.bus.send(Bus.BROADCAST, type=frame.type, payload=frame.payload)
+        return True
+
+    def deliver(self, typ: str, payload: dict):
+        """Deliver a message relayed from another worker to the local members of its room
+
+        The message is given a sequence number of this process, as every
+        worker numbers its broadcasts on its own.
+        """
+        frame = Frame(typ, **dict(payload, seq=self.seq))
+        try:
+            for codec in CODECS.values():
+                frame.encode(codec)
+        except FrameError as e:
+            logger.warning("Failed to deliver relayed broadcast: %s", e)
+            return
+        self.next_seq()
+        self.deliver_frame(frame)
+
+    def deliver_frame(self, frame: Frame):
+        """Put a frame in the outbound queue of every member of its room connected to this process
+
+        The frame is also recorded in the room's history, to be replayed to
+        users joining it, and in the chat log.
+        """
+        if self.chatlog:
+            self.chatlog.append(frame)
+        room = self.rooms.get(frame.payload.get("room", DEFAULT_ROOM))
+        if room is None:
+            return
+        started = time.perf_counter()
+        room.history.append(frame)
+        for user in list(room.members):
             try:
-                await user.send(
-                    protocol.Protocol.MESSAGE,
-                    message=message,
-                    sender=sender.name,
-                    color=sender.color,
-                )
+                user.send_frame(frame)
             except ConnectionError:
-                logging.warning("Failed to broadcast to %s.", user)
+                logger.warning("Failed to broadcast to %s.", user)
                 self.drop_user(user)
+        self.metrics.broadcast.observe(time.perf_counter() - started)
+
+    async def tell(self, sender: serverclient.UserClient, target: str, message: str) -> bool:
+        """Send a private message from one user to another
+
+        Args:
+            sender (UserClient): The client that sent the message
+            target (str): The name of the recipient
+            message (str): The message to send
+
+        Returns:
+            (bool) Whether the recipient was found
+        """
+        payload = dict(message=message, sender=sender.name, color=sender.color)
+        if target in self.users:
+            return self.deliver_tell(target, payload)
+        if self.bus:
+            reply = await self.bus.request(Bus.TELL, target=target, payload=payload)
+            return reply["ok"]
+        return False
+
+    def deliver_tell(self, target: str, payload: dict) -> bool:
+        """Deliver a private message to a user connected to this process
+
+        Returns:
+            (bool) Whether the recipient was found
+        """
+        user = self.users.get(target)
+        if user is None or isinstance(user, ParkedSession):
+            return False
+        try:
+            user.send_frame(Frame(protocol.Protocol.TELL, **payload))
+            return True
+        except ConnectionError:
+            self.drop_user(user)
+            return False
 
     def broadcast_info(self, message):
         payload = {"message": message}
 
     def drop_user(self, user: serverclient.UserClient, reason: str = None):
-        """Drop a client"""
-        logging.info("Dropping user %s", user)
+        """Drop a client
+
+        A user holding a resume token is parked instead of forgotten, see
+        `park_session`.
+        """
+        logger.info("Dropping user %s", user)
         # user.drop(reason)
-        if user.name and user.name in self.users:
-            del self.users[user.name]
+        if self.park_session(user):
+            self.rooms.part_all(user)
+            return
+        self.rooms.part_all(user)
+        if user.name and self.users.release(user.name, user):
+            if self.bus:
+                self.bus.send(Bus.RELEASE, name=user.name)
+
+    def issue_token(self, user: serverclient.UserClient) -> Optional[str]:
+        """Give a user a new resume token, or None if resuming is disabled"""
+        if not self.timeouts["resume"]:
+            return None
+        user.token = new_token()
+        self.sessions[user.token] = user
+        return user.token
+
+    def park_session(self, user: serverclient.UserClient) -> bool:
+        """Keep the identity of a disconnected user, for them to resume with their token
+
+        The parked session takes over the user's name in the directory, so
+        it stays taken, and expires after the resume timeout.
+
+        Returns:
+            (bool) Whether the user was parked
+        """
+        if not user.token or self.sessions.get(user.token) is not user:
+            return False
+        del self.sessions[user.token]
+        if self.users.get(user.name) is not user:
+            return False
+        parked = ParkedSession(
+            self,
+            user.token,
+            user.name,
+            user.color,
+            set(user.rooms),
+            user.room,
+            time.monotonic() + self.timeouts["resume"],
+        )
+        self.users.release(user.name, user)
+        self.users.add(parked.name, parked)
+        self.sessions[parked.token] = parked
+        self.timers.add(parked, parked.expires)
+        logger.info("Parked session of %s", user.name)
+        return True
+
+    def expire_session(self, parked: ParkedSession):
+        """Forget a parked session that was not resumed in time, releasing its name"""
+        if self.sessions.get(parked.token) is parked:
+            del self.sessions[parked.token]
+        self.timers.discard(parked)
+        if self.users.release(parked.name, parked):
+            logger.info("Session of %s expired", parked.name)
+            if self.bus:
+                self.bus.send(Bus.RELEASE, name=parked.name)
+
+    def resume_session(self, user: serverclient.UserClient, token: str) -> Optional[ParkedSession]:
+        """Hand the identity of a parked session to a reconnecting user
+
+        If the token still belongs to a connected client, e.g. one whose
+        connection died without the server noticing yet, that client is
+        disconnected and its identity handed over.
+
+        The token is spent, the user is given a new one in the welcome.
+
+        Args:
+            user (UserClient): The client resuming
+            token (str): The resume token the client presented
+
+        Returns:
+            (ParkedSession) The resumed session, or None if the token is unknown or expired
+        """
+        old = self.sessions.get(token)
+        if isinstance(old, serverclient.UserClient):
+            old.abort("Session resumed from another connection", "superseded_connections")
+            self.drop_user(old)
+            old = self.sessions.get(token)
+        if not isinstance(old, ParkedSession):
+            return None
+        del self.sessions[token]
+        self.timers.discard(old)
+        self.users.release(old.name, old)
+        self.users.add(old.name, user)
+        user.name = old.name
+        user.color = old.color
+        logger.info("Resumed session of %s", old.name)
+        return old
+
+    async def catch_up(self, user: serverclient.UserClient, rooms: Iterable[str], after: Optional[int]):
+        """Put a resumed user back in their rooms, and send them the broadcasts they missed
+
+        The missed broadcasts are taken from the history of each room. Where a
+        history no longer reaches back to `after`, the gap up to its oldest
+        broadcast is read from the chat log. Broadcasts are numbered without
+        gaps, so the log records read must run on from `after` one by one. If
+        they do not, or there is no chat log, the user is told that some
+        broadcasts were lost.
+
+        The log is read before the user joins any room, and the rooms are
+        joined and the missed broadcasts queued in one step, so no live
+        broadcast gets ahead of them.
+
+        Args:
+            user (UserClient): The resumed client
+            rooms (Iterable): The canonical names of the rooms to rejoin
+            after (int): The sequence number of the last broadcast the client
+                got. If not given, the history of every room is replayed
+        """
+        rooms = set(rooms)
+        if after is None:
+            for name in rooms:
+                user.out.write_many(self.rooms.join(user, name).history.replay())
+            return
+        records = []
+        # The first sequence number not yet read from the log
+        reached = after + 1
+        complete = True
+        # The histories may move on while the log is read, so read until they have not
+        bound = self.missed_bound(rooms, after)
+        while complete and bound > reached and self.chatlog and reached - after <= CATCH_UP_SCAN:
+            try:
+                read = await asyncio.get_running_loop().run_in_executor(
+                    None, self.chatlog.after, reached - 1, min(bound - reached, CATCH_UP_SCAN)
+                )
+            except OSError as e:
+                logger.warning("Failed to read missed broadcasts from the chat log: %s", e)
+                break
+            if not read:
+                break
+            for seq, _, _ in read:
+                if seq != reached:
+                    complete = False
+                reached = seq + 1
+            records.extend(read)
+            bound = self.missed_bound(rooms, after)
+        complete = complete and reached >= bound
+        missed = {
+            seq: Frame(typ, **payload)
+            for seq, typ, payload in records
+            if payload.get("room", DEFAULT_ROOM) in rooms
+        }
+        for name in rooms:
+            for frame in self.rooms.join(user, name).history.since(after):
+                missed[frame.payload["seq"]] = frame
+        user.out.write_many([missed[seq] for seq in sorted(missed)[-CATCH_UP_LIMIT:]])
+        if not complete or len(missed) > CATCH_UP_LIMIT:
+            user.send_nowait(
+                protocol.Protocol.SERVER_INFO,
+                message="Nogle beskeder fra mens du var væk kunne ikke hentes",
+            )
+
+    def missed_bound(self, rooms: Iterable[str], after: int) -> int:
+        """Return the sequence number up to which broadcasts after `after` must be read from the chat log
+
+        That is the oldest broadcast in the history of any of the rooms that
+        no longer reaches back to `after`, or the next sequence number for a
+        room without members, whose broadcasts no history saw.
+        """
+        bound = after + 1
+        for name in rooms:
+            room = self.rooms.get(name)
+            if room is None:
+                bound = max(bound, self.seq)
+            elif not room.history.covers(after):
+                frames = room.history.since(after)
+                bound = max(bound, frames[0].payload["seq"] if frames else self.seq)
+        return bound
 
     async def client_handler(self, reader: StreamReader, writer: StreamWriter):
-        """Accept a connection and create a handler for the new client"""
+        """Accept a connection and create a handler for the new client
+
+        Connections beyond `max_connections` are sent a DROP with the reason
+        and closed, before any per-client state is created.
+        """
+        if self.connections >= self.max_connections:
+            logger.warning("Rejecting connection: %d connections open", self.connections)
+            self.metrics.events["rejected_connections"] += 1
+            writer.write(Frame(protocol.Protocol.DROP, message="Serveren er fuld").encode())
+            writer.close()
+            return
+        self.connections += 1
         client = None
         try:
             client = serverclient.UserClient(reader, writer, self)
+            deadline = client.check_deadlines(client.connected_at)
+            if deadline is not None:
+                self.timers.add(client, deadline)
             await client.handle()
         except:
             ...
         finally:
-            if client and client.name in self.users:
-                self.users.pop(client.name, None)
+            self.connections -= 1
+            if client:
+                self.timers.discard(client)
+                client.out.close()
+                self.drop_user(client)
+            writer.close()
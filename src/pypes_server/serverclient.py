@@ -1,10 +1,24 @@
-import json
-import logging
+import asyncio
+import hmac
+import time
 from asyncio.streams import StreamReader, StreamWriter
+from collections import deque
 from random import choice
-from typing import Any, Tuple
-
+from typing import Any, Optional, Tuple
+
+from codec import CODECS, JSON
+from commands import THREAD, CommandError, CommandRegistry, Param
+from frame import MAX_FRAME_SIZE, Frame, FrameDecoder, FrameError, FrameWriter
+from logs import get_logger, set_level
+from metrics import split_lines
+from profiling import MAX_PROFILE_SECONDS
 from protocol import Protocol
+from ratelimit import DISCONNECT, RateLimiter
+from rooms import DEFAULT_ROOM, Rooms
+
+logger = get_logger("client")
+# Lines per chat message, sampled so they never cost more than a few lines a second
+message_logger = get_logger("messages")
 
 palette = [
     "2f4f4f",
@@ -59,6 +73,12 @@ palette = [
     "ffc0cb",
 ]
 
+READ_SIZE = 0x10000
+# Largest number of messages returned by a single HISTORY command
+HISTORY_LIMIT = 100
+
+commands = CommandRegistry()
+
 # ?: just put these inside of the relevant handlers?
 
 welcome_text = """Velkommen til, {name}.
@@ -72,7 +92,23 @@ Kommandoer:
 HELP              - viser denne besked
 NAME <navn>       - Anmod om at skifte navn
 COLOR <farve>     - skift farven dit navn bliver vist med. farven angives som
-                    hexadecimal i formatet RRGGBB eller 0xRRGGBB"""
+                    hexadecimal i formatet RRGGBB eller 0xRRGGBB
+JOIN <rum>        - gå ind i et rum. Dine beskeder sendes til det senest
+                    valgte rum
+PART [rum]        - forlad et rum. Uden parameter forlades det valgte rum
+LIST              - vis alle rum og hvor mange der er i dem
+HISTORY [før] [antal]
+                  - vis op til <antal> ældre beskeder i det valgte rum, fra
+                    før beskednummer <før>. Uden parametre vises de seneste
+                    20 beskeder
+ADMIN <token>     - bliv administrator
+STATS             - vis serverens målinger. Kun for administratorer
+LOGLEVEL <del> <niveau>
+                  - sæt logniveau for en del af serveren, f.eks. messages
+                    eller * for alle. Kun for administratorer
+PROFILE [sekunder|stop]
+                  - profilér serveren i op til 300 sekunder (standard 10) og
+                    skriv resultatet til disk. Kun for administratorer"""
 
 
 class UserClient:
@@ -86,8 +122,22 @@ class UserClient:
     Attributes:
         reader: The incoming data stream
         writer: The outgoing data stream
+        out:    Queues and batches frames written to `writer`
+        decoder: Splits data read from `reader` into messages
+        inbox:  Messages that have been decoded but not yet handled
+        limiter: Rate limits on the messages this client sends
+        connected_at: Monotonic time the connection was accepted
+        last_seen: Monotonic time data was last received from the client
+        pinged: Whether a PING was sent since data was last received
+        refused: Whether the last message was refused by the server's
+            broadcast rate limit. The client is told once per burst
+        joined: Whether the handshake has completed
+        admin:  Whether the client has given the admin token
         name:   The username associated with this client
         color:  The color that this clients name has
+        rooms:  The names of the rooms this client is in
+        room:   The room that messages without a `room` field are sent to
+        token:  The resume token given in the welcome, if resuming is enabled
         server: A reference to the server object.
     """
 
@@ -101,41 +151,78 @@ class UserClient:
         """
         self.reader = reader
         self.writer = writer
+        self.out = FrameWriter(writer, **server.writer_options)
+        self.decoder = FrameDecoder(on_frame=server.metrics.frame_in)
+        self.inbox: deque[Tuple[str, Any]] = deque()
+        self.limiter = RateLimiter(server.rate_limits)
+        self.connected_at = self.last_seen = time.monotonic()
+        self.pinged = False
+        self.refused = False
+        self.joined = False
+        self.admin = False
         self.name: str = ""
         self.color: str = ""
+        self.rooms: set[str] = set()
+        self.room: Optional[str] = None
+        self.token: Optional[str] = None
         self.server: server.Server = server
 
+    def send_nowait(self, type, **kwargs):
+        """Send a message to the client without waiting for it to be flushed
+
+        The frame goes into this client's outbound queue, which is flushed by
+        its own writer task, see `FrameWriter`. Use this when delivering to
+        many clients at once, so that one slow peer does not hold up the rest.
+
+        Args:
+            type (str): The protocol message type
+            kwargs (dict): each key/value-pair will be put in the ``payload`` field of the sent message
+
+        Raises:
+            ConnectionError: If the connection is already closing
+        """
+        self.send_frame(Frame(type, **kwargs))
+
+    def send_frame(self, frame: Frame):
+        """Queue an already encoded frame for the client without waiting for it to be flushed
+
+        The frame goes into this client's outbound queue, which is flushed by
+        its own writer task, see `FrameWriter`.
+
+        Args:
+            frame (Frame): The frame to send
+
+        Raises:
+            ConnectionError: If the connection is already closing
+            FrameError: If the encoded frame exceeds the size limit
+        """
+        self.out.write(frame)
+
     async def send(self, type, **kwargs):
         """Send a message to the client
 
         Parse provided arguments to construct a message object.
-        Serialize to JSON and send it to the client.
+        Serialize to JSON and send it to the client, waiting for the transport
+        to drain.
 
         Args:
             type (str): The protocol message type
             kwargs (dict): each key/value-pair will be put in the ``payload`` field of the sent message
         """
         try:
-            message = {"type": type}
-            if kwargs:
-                message["payload"] = kwargs
-            serialized = json.dumps(message).encode("utf8")
-            size = len(serialized)
-            if size > 0xFFF:
-                # throw error. size limit exeeded
-                ...
-            self.writer.write(int.to_bytes(size, 4, "little"))
-            await self.writer.drain()
-            self.writer.write(serialized)
-            await self.writer.drain()
+            self.send_nowait(type, **kwargs)
+            await self.out.drain()
         except Exception as e:
-            logging.warning("We fked up: %s", e)
+            logger.warning("We fked up: %s", e)
 
-    async def recv(self, size) -> Tuple[str, Any]:
+    async def recv(self) -> Tuple[str, Any]:
         """Receive a message from the client.
 
-        Await a message from the client, parse the data as JSON, and deserialize
-        it into a python a dict with the form:
+        Return the next decoded message, reading from the stream only when no
+        complete frame is buffered. A single read can hold several pipelined
+        frames; those are returned by subsequent calls without touching the
+        stream. Each message object is deserialized into a python dict with the
+        form:
 
         .. code-block:: text
 
@@ -144,23 +231,26 @@ class UserClient:
                 'payload': <ADDITIONAL_DATA>
             }
 
-        Args:
-            size (int): Amount of bytes to read from the stream
-
         Returns:
             A (type, data) tuple, which represents the extracted `type` and
             `payload` fields of the received object.
+
+        Raises:
+            ConnectionError: If the client closed the connection
+            FrameError: If the client sent an oversized or malformed frame
         """
-        header = await self.reader.read(4)
-        size = int.from_bytes(header, "little")
-        if size > 0xFFF:
-            # drop connection. beyond size limit
-            ...
-        message = await self.reader.read(size)
-        deserialized = json.loads(message)
-        kind = deserialized["type"]
-        data = deserialized["payload"]
-        return kind, data
+        while not self.inbox:
+            # Until the handshake is done, decode one frame at a time, as the codec may still change
+            self.inbox.extend(self.decoder.decode(None if self.joined else 1))
+            if self.inbox:
+                break
+            data = await self.reader.read(READ_SIZE)
+            if not data:
+                raise ConnectionResetError("Connection closed by {}".format(self.name))
+            self.last_seen = time.monotonic()
+            self.pinged = False
+            self.decoder.feed(data)
+        return self.inbox.popleft()
 
     async def handle(self):
         """Start handling this client
@@ -172,19 +262,101 @@ class UserClient:
         """
         if not await self.perform_handshake():
             return
-        await self.writer.drain()
+        self.server.metrics.handshake.observe(time.monotonic() - self.connected_at)
+        await self.out.drain()
         await self.send(
             Protocol.SERVER_INFO, message=welcome_text.format(name=self.name)
         )
-        logging.info("Accepted client %s", self.name)
+        logger.info("Accepted client %s", self.name)
+        handlers = {
+            Protocol.MESSAGE: self.handle_message,
+            Protocol.TELL: self.handle_tell,
+            Protocol.COMMAND: self.handle_command,
+            Protocol.PING: self.handle_ping,
+        }
         while True:
-            typ, data = await self.recv(1024)
-            if typ == Protocol.MESSAGE:
-                await self.handle_message(data)
-            elif typ == Protocol.TELL:
-                await self.handle_tell(data)
-            elif typ == Protocol.COMMAND:
-                await self.handle_command(data)
+            typ, data = await self.recv()
+            if not self.limiter.allow(typ):
+                await self.throttle(typ)
+                continue
+            handler = handlers.get(typ)
+            if handler is not None:
+                await handler(data)
+
+    def check_deadlines(self, now: float) -> Optional[float]:
+        """Enforce the handshake deadline and the heartbeat. Called by the server's `TimerWheel`
+
+        A client that has not completed the handshake in time, or has sent
+        nothing for the idle timeout, is disconnected. A client that has been
+        silent for the ping interval is sent a PING, which it should answer
+        with a PONG. Any data from the client counts as a sign of life.
+
+        Args:
+            now (float): The current monotonic time
+
+        Returns:
+            The monotonic time of the next deadline, or None if there is none
+        """
+        timeouts = self.server.timeouts
+        if not self.joined and timeouts["handshake"]:
+            deadline = self.connected_at + timeouts["handshake"]
+            if now >= deadline:
+                self.abort("Handshake timed out")
+                return None
+            return deadline
+        deadlines = []
+        if timeouts["idle"]:
+            deadline = self.last_seen + timeouts["idle"]
+            if now >= deadline:
+                self.abort("Idle timeout")
+                return None
+            deadlines.append(deadline)
+        if timeouts["ping"]:
+            deadline = self.last_seen + timeouts["ping"]
+            if self.pinged:
+                # Look again later in case the client answers and goes quiet again
+                deadline = now + timeouts["ping"]
+            elif now >= deadline:
+                self.pinged = True
+                try:
+                    self.send_nowait(Protocol.PING)
+                except ConnectionError:
+                    return None
+                deadline = now + timeouts["ping"]
+            deadlines.append(deadline)
+        return min(deadlines, default=None)
+
+    def abort(self, reason: str, event: str = "timeouts"):
+        """Close the connection at once, discarding anything not yet sent
+
+        Unlike a regular close, this does not wait for the peer to read,
+        which a dead peer never will.
+
+        Args:
+            reason (str): Why the connection is closed, for the log
+            event (str): The metrics event counted for it
+        """
+        logger.info("Disconnecting %s: %s", self.name or self.writer.get_extra_info("peername"), reason)
+        self.server.metrics.events[event] += 1
+        self.writer.transport.abort()
+
+    async def throttle(self, typ: str):
+        """Deal with a message refused by the rate limits, according to the server's policy
+
+        With the ``throttle`` policy the message is dropped, and the client is
+        told once until a message gets through again.
+
+        Raises:
+            ConnectionResetError: With the ``disconnect`` policy
+        """
+        self.server.metrics.events["throttled_frames"] += 1
+        if self.server.rate_policy == DISCONNECT:
+            logger.warning("Disconnecting %s for exceeding the rate limit for %s", self.name, typ)
+            raise ConnectionResetError("{} exceeded the rate limit for {}".format(self.name, typ))
+        if not self.limiter.throttled:
+            self.limiter.throttled = True
+            logger.info("Throttling %s", self.name)
+            await self.send(Protocol.SERVER_INFO, message="Du sender for hurtigt. Beskeder bliver droppet")
 
     async def handle_command(self, data):
         """Handle a COMMAND message sent from the client.
@@ -195,44 +367,56 @@ class UserClient:
         data. The structure is essentially the same as the (type, payload)
         format used for message objects.
 
+        Commands are looked up in the `commands` registry. If a command fails
+        in a way the user should know about, the reason is sent as SERVER_INFO.
+
         Args:
             data (dict): The {'cmd': ..., 'args': ...} command object
         """
-        cmd = data.get("cmd").upper()
-        args = data.get("args")
-        logging.info("handling command %s with args %s", cmd, args)
-        if cmd == "HELP":
-            await self.send(Protocol.SERVER_INFO, message=help_text)
-        elif cmd == "NAME":
-            newname = args[0]
-            if newname in self.server.users:
-                await self.send(Protocol.SERVER_INFO, message="Navn optaget")
-                return
-            self.server.users[newname] = self
-            del self.server.users[self.name]
-            self.name = newname
-        elif cmd == "COLOR":
-            try:
-                clr = args[0]
-                int(clr, 16)
-                self.color = clr
-            except:
-                await self.send(Protocol.SERVER_INFO, message="ugyldigt format")
-                return
+        cmd = data.get("cmd")
+        args = data.get("args") or []
+        command = commands.lookup(str(cmd))
+        logger.info("handling command %s with args %s", cmd, "[redacted]" if command and command.secret else args)
+        try:
+            await commands.dispatch(self, str(cmd), args if isinstance(args, list) else [args])
+        except CommandError as e:
+            await self.send(Protocol.SERVER_INFO, message=str(e))
+
+    async def handle_ping(self, data):
+        """Answer a PING from the client with a PONG"""
+        self.send_nowait(Protocol.PONG)
 
     async def handle_message(self, data):
         """handle a MESSAGE message.
 
-        Handles a message sent from the client. Simply extract the message from
-        the provided object, and forward it to the `Server` for broadcasting.
-        MESSAGE does not require arguments.
+        Handles a message sent from the client. Extract the message from the
+        provided object, and forward it to the `Server` for broadcasting to a
+        room the client is in. MESSAGE does not require arguments.
 
         Args:
-            data (dict): The payload. Expected to just contain a {'message': ...} object
+            data (dict): The payload. Expected to contain a {'message': ...}
+                object, and optionally the `room` to send to. Defaults to the
+                room the client joined last
         """
         message = data["message"]
-        logging.info("[{} MESSAGE]: {}".format(self.name, message))
-        await self.server.broadcast_message(message, self)
+        if not isinstance(message, str) or not isinstance(data.get("room") or "", str):
+            await self.send(Protocol.SERVER_INFO, message="Beskeden skal være tekst")
+            return
+        room = Rooms.normalize(data["room"]) if data.get("room") else self.room
+        if room not in self.rooms:
+            await self.send(Protocol.SERVER_INFO, message="Du er ikke i det rum")
+            return
+        message_logger.info("[%s MESSAGE]: %s", self.name, message)
+        try:
+            broadcast = await self.server.broadcast_message(message, self, room)
+        except FrameError:
+            await self.send(Protocol.SERVER_INFO, message="Beskeden er for lang og blev ikke sendt")
+            return
+        if broadcast:
+            self.refused = False
+        elif not self.refused:
+            self.refused = True
+            await self.send(Protocol.SERVER_INFO, message="Serveren er travl. Beskeder bliver droppet")
 
     async def handle_tell(self, data):
         """handle a TELL message.
@@ -245,13 +429,12 @@ class UserClient:
         """
         message = data["message"]
         recepient = data["target"]
-        logging.info("[{} TELL]: {}".format(self.name, message))
-        target = self.server.users.get(recepient)
-        if target:
-            payload = dict(message=message, sender=self.name, color=self.color)
-            target.send(Protocol.TELL, **payload)
-            # TODO: this is not going to work
-            await self.send(Protocol.TELL, **payload)
+        if not isinstance(message, str) or not isinstance(recepient, str):
+            await self.send(Protocol.SERVER_INFO, message="Beskeden skal være tekst")
+            return
+        message_logger.info("[%s TELL]: %s", self.name, message)
+        if await self.server.tell(self, recepient, message):
+            await self.send(Protocol.TELL, message=message, sender=self.name, color=self.color)
         else:
             await self.send(Protocol.SERVER_INFO, message="User not found")
 
@@ -265,6 +448,22 @@ class UserClient:
         client with the name they were assigned. The client can be assigned a
         different name, if the requested name was already taken.
 
+        The handshake also negotiates the codec used for the rest of the
+        session. HELLO lists the codecs the server supports, and the client may
+        pick one with the `codec` field of its NAME. Clients that do not ask for
+        a codec stay on JSON. The handshake itself is always JSON.
+
+        Right after the welcome, the client joins the default room, and the
+        room's recent broadcasts are replayed to it in a single batch.
+
+        The welcome carries a resume token and the sequence number of the last
+        broadcast. A client that reconnects may give the token, and the
+        sequence number of the last broadcast it got, in the `token` and `seq`
+        fields of its NAME. If the session is still parked, the client gets
+        back its name, color and rooms, and is sent only the broadcasts it
+        missed, see `Server.catch_up`. The welcome then has `resumed` set.
+        An unknown or expired token gives a regular handshake.
+
         +-----------------+------------+------------------+
         | Server          |  direction |  Client          |
         +=================+============+==================+
@@ -281,25 +480,43 @@ class UserClient:
         retry_count = 0
         while True:
             try:
-                await self.send(Protocol.SERVER_HELLO)
-                typ, data = await self.recv(1024)
+                await self.send(Protocol.SERVER_HELLO, codecs=list(CODECS))
+                typ, data = await self.recv()
                 if not typ == Protocol.CLIENT_NAME:
                     raise Exception("Invalid response type. Expected 'NAME'")
-                name = data["name"]
-                # TODO: This entire thing could be a `Server.accept_user(name)` or something
-                suffix = 0
-                while name in self.server.users:
-                    suffix += 1
-                    name = data["name"] + str(suffix)
-                self.name = name
-                self.server.users[self.name] = self
-                self.color = choice(palette)
-                await self.send(Protocol.SERVER_WELCOME, name=self.name)
+                parked = None
+                if data.get("token"):
+                    parked = self.server.resume_session(self, str(data["token"]))
+                if parked is None:
+                    self.name = await self.server.accept_user(self, data["name"])
+                    self.color = choice(palette)
+                codec = CODECS.get(data.get("codec"), JSON)
+                welcome = dict(name=self.name, color=self.color, codec=codec.name, seq=self.server.seq - 1)
+                token = self.server.issue_token(self)
+                if token:
+                    welcome["token"] = token
+                if parked is not None:
+                    welcome["resumed"] = True
+                await self.send(Protocol.SERVER_WELCOME, **welcome)
+                # Everything after the welcome is encoded with the negotiated codec
+                self.out.codec = self.decoder.codec = codec
+                if parked is None:
+                    self.server.join_room(self, DEFAULT_ROOM)
+                    self.room = DEFAULT_ROOM
+                else:
+                    after = data.get("seq")
+                    await self.server.catch_up(self, parked.rooms, after if isinstance(after, int) else None)
+                    self.room = parked.room
+                self.joined = True
                 return True
+            except (ConnectionError, FrameError) as e:
+                logger.warning("[%s]Handshake failed: %s. dropping client.", self, e)
+                self.writer.close()
+                return False
             except Exception as e:
-                logging.warning("[%s]Handshake failed: %s", self, e)
+                logger.warning("[%s]Handshake failed: %s", self, e)
                 if retry_count <= 3:
-                    logging.info(
+                    logger.info(
                         "[%s]Attempting handshake again. Attempt %s/3",
                         self,
                         retry_count,
@@ -307,6 +524,178 @@ class UserClient:
                     retry_count += 1
                     continue
                 else:
-                    logging.info("[%s]Retry limit reached. dropping client.", self)
+                    logger.info("[%s]Retry limit reached. dropping client.", self)
                     self.writer.close()
                     return False
+
+
+def hex_color(text: str) -> str:
+    """Validate a hexadecimal RRGGBB or 0xRRGGBB color"""
+    int(text, 16)
+    return text
+
+
+def message_count(text: str) -> int:
+    """Parse a positive number of messages, capped at `HISTORY_LIMIT`"""
+    value = int(text)
+    if value < 1:
+        raise ValueError(text)
+    return min(value, HISTORY_LIMIT)
+
+
+@commands.command("HELP")
+async def help_command(client: UserClient):
+    await client.send(Protocol.SERVER_INFO, message=help_text)
+
+
+@commands.command("NAME", Param("navn"))
+async def name_command(client: UserClient, newname: str):
+    if not await client.server.rename_user(client, newname):
+        raise CommandError("Navn optaget")
+
+
+@commands.command("COLOR", Param("farve", hex_color))
+async def color_command(client: UserClient, clr: str):
+    client.color = clr
+
+
+@commands.command("JOIN", Param("rum"))
+async def join_command(client: UserClient, name: str):
+    room = Rooms.normalize(name)
+    if room is None:
+        raise CommandError("ugyldigt rum")
+    if room not in client.rooms:
+        client.server.join_room(client, room)
+    client.room = room
+    await client.send(Protocol.SERVER_INFO, message="Du er nu i #{}".format(room))
+
+
+@commands.command("PART", Param("rum", default=None))
+async def part_command(client: UserClient, name: Optional[str]):
+    room = Rooms.normalize(name) if name else client.room
+    if room is None or not client.server.part_room(client, room):
+        raise CommandError("Du er ikke i det rum")
+    if client.room == room:
+        client.room = next(iter(client.rooms), None)
+    await client.send(Protocol.SERVER_INFO, message="Du forlod #{}".format(room))
+
+
+@commands.command("LIST")
+async def list_command(client: UserClient):
+    rooms = "\n".join(
+        "#{} ({})".format(name, members) for name, members in client.server.rooms.listing()
+    )
+    await client.send(Protocol.SERVER_INFO, message=rooms or "Der er ingen rum")
+
+
+def bind_history(client: UserClient):
+    """Pick the chat log and room for HISTORY on the event loop"""
+    if not client.server.chatlog:
+        raise CommandError("Historik er ikke slået til")
+    if client.room is None:
+        raise CommandError("Du er ikke i et rum")
+    return client.server.chatlog, client.room
+
+
+async def send_history(client: UserClient, records: list):
+    """Send the broadcasts read by HISTORY as HISTORY messages, oldest first"""
+    frames = []
+    for seq, typ, payload in records:
+        frame = Frame(Protocol.HISTORY, **dict(payload, seq=seq))
+        try:
+            # The sequence number can push a message right at the limit over it
+            frame.encode(client.out.codec)
+        except FrameError:
+            continue
+        frames.append(frame)
+    client.out.write_many(frames)
+    await client.out.drain()
+
+
+@commands.command(
+    "HISTORY",
+    Param("før", int, None),
+    Param("antal", message_count, 20),
+    offload=THREAD,
+    bind=bind_history,
+    reply=send_history,
+)
+def history_command(chatlog, room: str, before: Optional[int], count: int) -> list:
+    """Read older broadcasts to a room from the chat log
+
+    Every broadcast is sent as a HISTORY message carrying its sequence number
+    in `seq`. The client can page further back by passing the lowest sequence
+    number it got as the first argument. Runs in a thread, as it reads from disk.
+    """
+    if before is None:
+        before = chatlog.next_seq
+    return chatlog.before(before, count, room)
+
+
+@commands.command("ADMIN", Param("token"), secret=True)
+async def admin_command(client: UserClient, token: str):
+    expected = client.server.admin_token
+    if not expected or not hmac.compare_digest(token.encode(), expected.encode()):
+        logger.warning("Failed admin login by %s", client.name)
+        raise CommandError("Forkert token")
+    client.admin = True
+    await client.send(Protocol.SERVER_INFO, message="Du er nu administrator")
+
+
+def require_admin(client: UserClient):
+    if not client.admin:
+        raise CommandError("Kun for administratorer")
+
+
+@commands.command("STATS")
+async def stats_command(client: UserClient):
+    require_admin(client)
+    # Leave room for the frame header and the rest of the message object
+    for message in split_lines(client.server.metrics.summary(), MAX_FRAME_SIZE - 64):
+        await client.send(Protocol.SERVER_INFO, message=message)
+
+
+@commands.command("LOGLEVEL", Param("del"), Param("niveau"))
+async def log_level_command(client: UserClient, subsystem: str, level: str):
+    require_admin(client)
+    try:
+        name = set_level(subsystem, level)
+    except ValueError:
+        raise CommandError("ugyldigt format: niveau")
+    logger.warning("%s set the log level of %s to %s", client.name, subsystem, name)
+    await client.send(Protocol.SERVER_INFO, message="Log for {} er nu {}".format(subsystem, name))
+
+
+@commands.command("PROFILE", Param("sekunder", default="10"))
+async def profile_command(client: UserClient, seconds: str):
+    require_admin(client)
+    profiler = client.server.profiler
+    if seconds.lower() == "stop":
+        if not profiler.running:
+            raise CommandError("Der kører ingen profilering")
+        profiler.stop()
+        return
+    try:
+        duration = float(seconds)
+    except ValueError:
+        raise CommandError("ugyldigt format: sekunder")
+    if not 0 < duration <= MAX_PROFILE_SECONDS:
+        raise CommandError("Brug mellem 0 og {} sekunder".format(MAX_PROFILE_SECONDS))
+    if profiler.running:
+        raise CommandError("Der kører allerede en profilering")
+    profiler.start(duration).add_done_callback(lambda task: profile_done(client, task))
+    await client.send(Protocol.SERVER_INFO, message="Profilerer i {:g} sekunder".format(duration))
+
+
+def profile_done(client: UserClient, task: asyncio.Task):
+    """Tell the admin who started a capture where it was written"""
+    if task.cancelled():
+        return
+    if task.exception():
+        message = "Profilering fejlede: {}".format(task.exception())
+    else:
+        message = "Profil skrevet til {}".format(task.result())
+    try:
+        client.send_nowait(Protocol.SERVER_INFO, message=message)
+    except ConnectionError:
+        pass
@@ -0,0 +1,88 @@
+import asyncio
+import math
+import time
+from typing import Any, Optional
+
+from logs import get_logger
+
+logger = get_logger("timers")
+
+
+class TimerWheel:
+    """Hashed timer wheel for deadlines shared by many items.
+
+    Time is split into ticks of `resolution` seconds, and the wheel has one
+    slot per tick. An item is placed in the slot of the tick its deadline
+    falls in, and a single loop callback visits one slot per tick. Adding and
+    removing an item is O(1), and a tick only touches the items that are due.
+
+    Items must implement ``check_deadlines(now) -> Optional[float]``, called
+    with the current monotonic time when their slot comes up. It does
+    whatever has expired and returns the next deadline, or None to leave the
+    wheel. Deadlines further away than a full turn are checked early and
+    simply put back. Items can therefore push their deadlines out, e.g. on
+    activity, by updating their own state without touching the wheel.
+
+    Attributes:
+        resolution: Seconds per tick
+        slots:      One set of items per tick
+        position:   Index of the slot visited last
+        where:      Maps items to the index of their slot
+    """
+
+    def __init__(self, resolution: float = 1.0, size: int = 128):
+        """Initialize an empty wheel
+
+        Args:
+            resolution (float): Seconds per tick. Deadlines fire up to this late
+            size (int): Number of slots, covering ``size * resolution`` seconds per turn
+        """
+        self.resolution = resolution
+        self.slots: list[set] = [set() for _ in range(size)]
+        self.position = 0
+        self.where: dict[Any, int] = {}
+        self.handle: Optional[asyncio.TimerHandle] = None
+
+    def start(self):
+        """Start ticking on the running event loop"""
+        self.handle = asyncio.get_running_loop().call_later(self.resolution, self.tick)
+
+    def stop(self):
+        if self.handle is not None:
+            self.handle.cancel()
+            self.handle = None
+
+    def add(self, item, deadline: float):
+        """Schedule an item to be checked at a monotonic time, replacing any earlier schedule"""
+        self.discard(item)
+        ticks = math.ceil((deadline - time.monotonic()) / self.resolution)
+        ticks = min(max(ticks, 1), len(self.slots) - 1)
+        index = (self.position + ticks) % len(self.slots)
+        self.slots[index].add(item)
+        self.where[item] = index
+
+    def discard(self, item):
+        """Remove an item from the wheel, if it is on it"""
+        index = self.where.pop(item, None)
+        if index is not None:
+            self.slots[index].discard(item)
+
+    def tick(self):
+        """Check the items of the next slot and schedule the next tick"""
+        self.position = (self.position + 1) % len(self.slots)
+        due = self.slots[self.position]
+        self.slots[self.position] = set()
+        now = time.monotonic()
+        for item in due:
+            del self.where[item]
+            try:
+                deadline = item.check_deadlines(now)
+            except Exception:
+                logger.exception("Failed to check deadlines of %s", item)
+                continue
+            if deadline is not None:
+                self.add(item, deadline)
+        self.handle = asyncio.get_running_loop().call_later(self.resolution, self.tick)
+
+    def __len__(self):
+        return len(self.where)
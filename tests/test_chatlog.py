@@ -0,0 +1,180 @@
+import threading
+import time
+
+import pytest
+
+import chatlog
+from chatlog import ChatLog
+from frame import Frame
+
+
+def message(seq, room="lobby"):
+    return Frame("MESSAGE", message="message {}".format(seq), sender="Bob", color="ffffff", room=room, seq=seq)
+
+
+def seqs(records):
+    return [seq for seq, _, _ in records]
+
+
+@pytest.fixture
+def open_log(tmp_path):
+    logs = []
+
+    def open_log(**options):
+        log = ChatLog(str(tmp_path), fsync_interval=0.01, **options)
+        logs.append(log)
+        return log
+
+    yield open_log
+    for log in logs:
+        log.close()
+
+
+def write(log, numbers, room="lobby"):
+    for seq in numbers:
+        log.append(message(seq, room))
+    # Wait for the writer thread, so the records can be read
+    log.close()
+
+
+# Sequence numbers with a gap at 4 and 8, as when a broadcast fails to encode
+GAPPED = [1, 2, 3, 5, 6, 7, 9, 10]
+
+
+@pytest.mark.parametrize("segment_bytes", [0x1000000, 200])
+def test_before_with_gaps(open_log, segment_bytes):
+    log = open_log(segment_bytes=segment_bytes)
+    write(log, GAPPED)
+    assert seqs(log.before(5, 10)) == [1, 2, 3]
+    assert seqs(log.before(4, 10)) == [1, 2, 3]
+    assert seqs(log.before(9, 2)) == [6, 7]
+    assert seqs(log.before(100, 3)) == [7, 9, 10]
+    assert seqs(log.before(1, 10)) == []
+
+
+@pytest.mark.parametrize("segment_bytes", [0x1000000, 200])
+def test_after_with_gaps(open_log, segment_bytes):
+    log = open_log(segment_bytes=segment_bytes)
+    write(log, GAPPED)
+    assert seqs(log.after(0, 100)) == GAPPED
+    assert seqs(log.after(3, 2)) == [5, 6]
+    assert seqs(log.after(4, 10)) == [5, 6, 7, 9, 10]
+    assert seqs(log.after(7, 10)) == [9, 10]
+    assert seqs(log.after(10, 10)) == []
+
+
+def test_rotation(open_log):
+    log = open_log(segment_bytes=200)
+    write(log, range(1, 31))
+    assert len(log.segments) > 2
+    assert seqs(log.before(31, 100)) == list(range(1, 31))
+    assert seqs(log.after(0, 100)) == list(range(1, 31))
+    # Across the boundary of every segment
+    for base in log.segments[1:]:
+        assert seqs(log.before(base + 1, 2)) == [base - 1, base]
+        assert seqs(log.after(base - 2, 2)) == [base - 1, base]
+
+
+def test_rooms(open_log):
+    log = open_log()
+    for seq in range(1, 11):
+        log.append(message(seq, "ops" if seq % 2 else "lobby"))
+    log.close()
+    assert seqs(log.before(11, 3, "ops")) == [5, 7, 9]
+    assert seqs(log.after(0, 100, ("lobby",))) == [2, 4, 6, 8, 10]
+
+
+@pytest.mark.parametrize("segment_bytes", [0x1000000, 200])
+def test_restart_continues_after_last_record(open_log, segment_bytes):
+    log = open_log(segment_bytes=segment_bytes)
+    write(log, GAPPED)
+    log = open_log(segment_bytes=segment_bytes)
+    assert log.next_seq == 11
+    log.append(message(log.next_seq))
+    log.close()
+    log = open_log(segment_bytes=segment_bytes)
+    assert log.next_seq == 12
+    assert seqs(log.after(9, 10)) == [10, 11]
+
+
+def test_restart_trims_partial_record(open_log, tmp_path):
+    log = open_log()
+    write(log, [1, 2, 3])
+    (segment,) = tmp_path.glob("*.log")
+    with open(segment, "ab") as f:
+        f.write(b"\x04\x00\x00")
+    log = open_log()
+    assert log.next_seq == 4
+    assert seqs(log.before(10, 10)) == [1, 2, 3]
+
+
+def test_numbers_without_seq(open_log):
+    log = open_log()
+    assert [log.append(Frame("MESSAGE", message="hi")) for _ in range(3)] == [1, 2, 3]
+    log.close()
+    assert seqs(log.before(10, 10)) == [1, 2, 3]
+
+
+def test_restart_drops_index_entries_past_the_log(open_log, tmp_path):
+    log = open_log()
+    write(log, [1, 2, 3])
+    (index,) = tmp_path.glob("*.idx")
+    with open(index, "ab") as f:
+        f.write((1 << 20).to_bytes(8, "little") + b"\x00\x00\x00")
+    log = open_log()
+    assert log.next_seq == 4
+    assert seqs(log.after(0, 10)) == [1, 2, 3]
+
+
+def test_restart_indexes_records_without_entries(open_log, tmp_path):
+    log = open_log()
+    write(log, [1, 2, 3, 5])
+    (index,) = tmp_path.glob("*.idx")
+    with open(index, "r+b") as f:
+        f.truncate(8)
+    log = open_log()
+    assert log.next_seq == 6
+    assert seqs(log.after(0, 10)) == [1, 2, 3, 5]
+    assert seqs(log.before(5, 2)) == [2, 3]
+
+
+@pytest.mark.parametrize("segment_bytes", [0x1000000, 200])
+def test_restart_rebuilds_missing_index(open_log, tmp_path, segment_bytes):
+    log = open_log(segment_bytes=segment_bytes)
+    write(log, GAPPED)
+    for index in tmp_path.glob("*.idx"):
+        index.unlink()
+    log = open_log(segment_bytes=segment_bytes)
+    assert log.next_seq == 11
+    assert seqs(log.after(0, 100)) == GAPPED
+    assert seqs(log.before(9, 2)) == [6, 7]
+
+
+def test_append_after_writer_failed(open_log, monkeypatch):
+    log = open_log()
+
+    def fail(*args):
+        raise OSError("disk full")
+
+    monkeypatch.setattr(log, "flush", fail)
+    log.append(message(1))
+    log.thread.join(5)
+    assert log.failed
+    assert log.append(message(2)) == 2
+    assert log.dropped == 1
+    log.close()
+
+
+def test_append_drops_when_writer_behind(open_log, monkeypatch):
+    monkeypatch.setattr(chatlog, "MAX_QUEUED", 2)
+    log = open_log()
+    written = threading.Event()
+    monkeypatch.setattr(log, "flush", lambda *args: written.wait(5))
+    log.append(message(1))
+    # The writer thread is stuck on the first frame, so only two more fit in the queue
+    while not log.queue.empty():
+        time.sleep(0.001)
+    for seq in range(2, 6):
+        log.append(message(seq))
+    assert log.dropped == 2
+    written.set()
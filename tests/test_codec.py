@@ -0,0 +1,67 @@
+import os
+
+import pytest
+
+from codec import CODECS, JSON, BinaryCodec, JsonCodec
+
+ROOT = os.path.join(os.path.dirname(__file__), "..", "src")
+
+MESSAGES = [
+    ("PING", None),
+    ("MESSAGE", {"message": "hej", "sender": "Bob", "color": "ffffff", "room": "lobby", "seq": 7}),
+    ("MESSAGE", {"message": "æøå 漢字 🙂"}),
+    ("COMMAND", {"cmd": "JOIN", "args": ["ops", "x"]}),
+    ("SERVER_WELCOME", {"name": "Bob", "codec": "binary", "resumed": True, "token": None}),
+    # Types and keys missing from the tables are escaped
+    ("CUSTOM", {"unknown_key": -(1 << 63), "nested": {"float": 1.5, "list": [1, "a", None, False]}}),
+]
+
+
+@pytest.mark.parametrize("codec", list(CODECS.values()), ids=list(CODECS))
+@pytest.mark.parametrize("typ, payload", MESSAGES)
+def test_round_trip(codec, typ, payload):
+    data = codec.encode(typ, payload)
+    assert codec.decode(memoryview(data)) == (typ, payload)
+
+
+def test_binary_is_smaller():
+    typ, payload = MESSAGES[1]
+    assert len(CODECS["binary"].encode(typ, payload)) < len(JSON.encode(typ, payload))
+
+
+@pytest.mark.parametrize(
+    "payload",
+    [{"seq": 1 << 63}, {"seq": -(1 << 63) - 1}, {"message": "x" * 0x10000}, {"args": [0] * 0x10000}, {"x": object()}],
+)
+def test_binary_rejects_values_that_do_not_fit(payload):
+    with pytest.raises(ValueError):
+        BinaryCodec().encode("MESSAGE", payload)
+
+
+@pytest.mark.parametrize(
+    "data",
+    [
+        b"\x01\x00",
+        # An int, a string and an escaped name cut short
+        b"\x01\x00\x03\x05\x00",
+        b"\x01\x00\x05\x05\x00ab",
+        b"\x01\x09\x05",
+        b"\xff\x05ab",
+    ],
+)
+def test_binary_rejects_truncated_frames(data):
+    with pytest.raises(ValueError):
+        BinaryCodec().decode(memoryview(data))
+
+
+def test_json_rejects_invalid_frames():
+    with pytest.raises(ValueError):
+        JsonCodec().decode(memoryview(b"{not json"))
+
+
+def test_client_and_server_codecs_match():
+    # The client keeps its own copy of the codec, which must stay in sync
+    with open(os.path.join(ROOT, "pypes_server", "codec.py")) as server, open(
+        os.path.join(ROOT, "pypes_client", "codec.py")
+    ) as client:
+        assert server.read() == client.read()
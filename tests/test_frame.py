@@ -0,0 +1,79 @@
+import json
+
+import pytest
+
+from codec import CODECS, JSON
+from frame import MAX_FRAME_SIZE, Frame, FrameDecoder, FrameError
+
+BINARY = CODECS["binary"]
+
+
+def frame(typ, payload=None, codec=JSON):
+    data = codec.encode(typ, payload)
+    return len(data).to_bytes(4, "little") + data
+
+
+def test_decodes_pipelined_frames():
+    decoder = FrameDecoder()
+    decoder.feed(frame("PING") + frame("MESSAGE", {"message": "a"}) + frame("MESSAGE", {"message": "b"}))
+    assert decoder.decode() == [("PING", None), ("MESSAGE", {"message": "a"}), ("MESSAGE", {"message": "b"})]
+    assert decoder.decode() == []
+    assert not decoder.buffer
+
+
+def test_waits_for_split_frames():
+    data = frame("MESSAGE", {"message": "split"}) + frame("PING")
+    decoder = FrameDecoder()
+    # Fed a byte at a time, through both the header and the body
+    decoded = []
+    for i in range(len(data)):
+        decoder.feed(data[i : i + 1])
+        decoded += decoder.decode()
+    assert decoded == [("MESSAGE", {"message": "split"}), ("PING", None)]
+
+
+def test_limit_leaves_the_rest_for_another_codec():
+    # As in the handshake: the NAME is JSON, and what follows it is binary
+    decoder = FrameDecoder()
+    decoder.feed(frame("CLIENT_NAME", {"name": "Bob", "codec": "binary"}) + frame("MESSAGE", {"message": "hi"}, BINARY))
+    assert decoder.decode(1) == [("CLIENT_NAME", {"name": "Bob", "codec": "binary"})]
+    decoder.codec = BINARY
+    assert decoder.decode(1) == [("MESSAGE", {"message": "hi"})]
+    assert decoder.decode(1) == []
+
+
+def test_rejects_oversized_frames():
+    decoder = FrameDecoder()
+    # Rejected from the header alone, before the body arrives
+    decoder.feed((MAX_FRAME_SIZE + 1).to_bytes(4, "little"))
+    with pytest.raises(FrameError):
+        decoder.decode()
+
+
+@pytest.mark.parametrize("body", [b"{not json", json.dumps({"payload": {}}).encode(), b"[1, 2]"])
+def test_rejects_malformed_frames(body):
+    decoder = FrameDecoder()
+    decoder.feed(len(body).to_bytes(4, "little") + body)
+    with pytest.raises(FrameError):
+        decoder.decode()
+
+
+def test_counts_decoded_frames():
+    seen = []
+    decoder = FrameDecoder(on_frame=lambda typ, size: seen.append((typ, size)))
+    data = frame("PING")
+    decoder.feed(data)
+    decoder.decode()
+    assert seen == [("PING", len(data))]
+
+
+def test_frame_encodes_once_per_codec():
+    message = Frame("MESSAGE", message="hi", seq=1)
+    assert message.encode() is message.encode()
+    assert message.encode(BINARY) == frame("MESSAGE", {"message": "hi", "seq": 1}, BINARY)
+
+
+@pytest.mark.parametrize("payload", [{"message": "x" * MAX_FRAME_SIZE}, {"message": 1 << 64}])
+def test_frame_rejects_what_does_not_fit(payload):
+    with pytest.raises(FrameError):
+        Frame("MESSAGE", **payload).encode(BINARY)
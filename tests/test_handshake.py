@@ -0,0 +1,57 @@
+import asyncio
+
+from codec import CODECS, JSON
+from frame import FrameDecoder
+from server import Server
+
+BINARY = CODECS["binary"]
+
+
+def frame(typ, payload=None, codec=JSON):
+    data = codec.encode(typ, payload)
+    return len(data).to_bytes(4, "little") + data
+
+
+async def serve():
+    """Start a server on a free port and return it with the port"""
+    server = Server("127.0.0.1", port=0, stall_threshold=0)
+    task = asyncio.get_running_loop().create_task(server.begin_serving())
+    while not hasattr(server, "server"):
+        await asyncio.sleep(0.01)
+    return server, task, server.server.sockets[0].getsockname()[1]
+
+
+async def read_until(reader, decoder, typ):
+    """Read messages until one of the given type arrives, and return its payload"""
+    while True:
+        for message_type, payload in decoder.decode(1):
+            if message_type == typ:
+                return payload
+        data = await asyncio.wait_for(reader.read(0x10000), 5)
+        assert data, "Connection closed by the server"
+        decoder.feed(data)
+
+
+def test_frame_pipelined_behind_name_uses_negotiated_codec():
+    async def run():
+        server, task, port = await serve()
+        try:
+            reader, writer = await asyncio.open_connection("127.0.0.1", port)
+            decoder = FrameDecoder()
+            assert "binary" in (await read_until(reader, decoder, "SERVER_HELLO"))["codecs"]
+            # Sent in one write, without waiting for the welcome
+            writer.write(
+                frame("CLIENT_NAME", {"name": "Bob", "codec": "binary"})
+                + frame("MESSAGE", {"message": "pipelined"}, BINARY)
+            )
+            welcome = await read_until(reader, decoder, "SERVER_WELCOME")
+            assert welcome["codec"] == "binary"
+            decoder.codec = BINARY
+            message = await read_until(reader, decoder, "MESSAGE")
+            assert (message["message"], message["sender"], message["seq"]) == ("pipelined", "Bob", 1)
+            writer.close()
+        finally:
+            server.stop()
+            await asyncio.gather(task, return_exceptions=True)
+
+    asyncio.run(run())
@@ -0,0 +1,21 @@
+import asyncio
+import os
+
+import pytest
+
+from profiling import Profiler
+
+
+def test_second_start_fails_before_first_task_runs(tmp_path):
+    async def main():
+        profiler = Profiler(str(tmp_path))
+        task = profiler.start(5)
+        assert profiler.running
+        with pytest.raises(RuntimeError):
+            profiler.start(5)
+        profiler.stop()
+        return await task
+
+    path = asyncio.run(main())
+    assert os.path.dirname(path) == str(tmp_path)
+    assert os.path.exists(path)